@@ -0,0 +1,200 @@
+"""
+Refusing calls a server is too busy to serve in time, so that under
+overload some calls fail straight away instead of all of them timing out.
+
+A handler given an L{AdmissionController} as its C{admission} attribute
+refuses calls with a L{ServerBusy} Fault when too many calls are in
+progress, when too many calls of the method are (see
+L{concurrency_limit}), or when the reactor is falling behind. Methods
+decorated with L{priority}, such as health checks, are always let in.
+"""
+from twisted.internet import reactor, task
+
+from txjsonrpc import jsonrpclib
+
+
+def priority(method):
+    """
+    Decorator letting every call of a method in, however busy the server
+    is.
+    """
+    method.priority = True
+    return method
+
+
+def concurrency_limit(limit):
+    """
+    Decorator capping the number of calls of a method in progress at once:
+    further calls are refused with a L{ServerBusy} Fault until some finish.
+    The cap only applies to handlers with an L{AdmissionController}.
+    """
+    def inner(method):
+        method.concurrencyLimit = limit
+        return method
+    return inner
+
+
+class ServerBusy(jsonrpclib.Fault):
+    """
+    The server is too busy to take a call, which may be tried again after
+    retryAfter seconds.
+    """
+
+    def __init__(self, retryAfter, reason="too many calls in progress"):
+        jsonrpclib.Fault.__init__(
+            self, jsonrpclib.SERVER_BUSY,
+            "Server busy (%s), retry after %s seconds" % (reason, retryAfter))
+        self.retryAfter = retryAfter
+
+
+class LagMonitor(object):
+    """
+    Measure how far behind the reactor is, from how late a call scheduled
+    every interval seconds runs.
+
+    @ivar lag: The lateness, in seconds, of the last of those calls.
+    """
+
+    def __init__(self, interval=0.1, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+        self.lag = 0
+        self._last = None
+        self._loop = None
+
+    @property
+    def running(self):
+        return self._loop is not None
+
+    def start(self):
+        self._last = self.clock.seconds()
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = self.clock
+        self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+    def _tick(self):
+        now = self.clock.seconds()
+        self.lag = max(0, now - self._last - self.interval)
+        self._last = now
+
+    def currentLag(self):
+        """
+        Return the lag, counting how late the next measurement already is
+        if the reactor hasn't got round to it.
+        """
+        if self._last is None:
+            return self.lag
+        return max(self.lag,
+                   self.clock.seconds() - self._last - self.interval)
+
+
+class AdmissionController(object):
+    """
+    Decide which calls a server takes on.
+
+    A call is refused with a L{ServerBusy} Fault if maxInFlight calls are
+    already in progress, if the limit its method was given with
+    L{concurrency_limit} is reached, or if the reactor is more than maxLag
+    seconds behind. Methods decorated with L{priority} are let in
+    regardless. Refused calls are told to try again after retryAfter
+    seconds.
+
+    @ivar inFlight: The number of calls in progress.
+    @ivar admitted: The number of calls let in.
+    @ivar rejected: The number of calls refused.
+    """
+
+    def __init__(self, maxInFlight=None, maxLag=None, retryAfter=1,
+                 lagInterval=0.1, clock=reactor):
+        """
+        @type maxInFlight: C{int} or None
+        @param maxInFlight: The most calls in progress at once, or None for
+        no limit.
+
+        @type maxLag: C{int} or C{float} or None
+        @param maxLag: The most seconds the reactor may be behind before
+        calls are refused, or None not to measure it.
+
+        @type lagInterval: C{int} or C{float}
+        @param lagInterval: How often, in seconds, the lag is measured.
+        """
+        self.maxInFlight = maxInFlight
+        self.maxLag = maxLag
+        self.retryAfter = retryAfter
+        self.clock = clock
+        self.monitor = LagMonitor(lagInterval, clock)
+        self.inFlight = self.admitted = self.rejected = 0
+        self._methods = {}
+        self._shutdownTrigger = None
+
+    def start(self):
+        """
+        Start measuring the lag of the reactor, if there is a maxLag. This
+        is done when the first call is made, and stopped when the reactor
+        shuts down.
+        """
+        if self.maxLag is None or self.monitor.running:
+            return
+        self.monitor.start()
+        # A clock which is only a clock, as in tests, never shuts down.
+        addTrigger = getattr(self.clock, "addSystemEventTrigger", None)
+        if self._shutdownTrigger is None and addTrigger is not None:
+            self._shutdownTrigger = addTrigger("before", "shutdown",
+                                               self.stop)
+
+    def stop(self):
+        self.monitor.stop()
+
+    def admit(self, functionPath, function):
+        """
+        Let in a call of function, published as functionPath, or raise a
+        L{ServerBusy} Fault. The call must be given to L{release} when it
+        finishes.
+        """
+        self.start()
+        if not getattr(function, "priority", False):
+            reason = self._refusal(functionPath, function)
+            if reason is not None:
+                self.rejected += 1
+                raise ServerBusy(self.retryAfter, reason)
+        self.inFlight += 1
+        self.admitted += 1
+        self._methods[functionPath] = self._methods.get(functionPath, 0) + 1
+
+    def _refusal(self, functionPath, function):
+        """
+        Return why a call of function is refused, or None if it isn't.
+        """
+        if self.maxInFlight is not None and self.inFlight >= self.maxInFlight:
+            return "too many calls in progress"
+        limit = getattr(function, "concurrencyLimit", None)
+        if limit is not None and self._methods.get(functionPath, 0) >= limit:
+            return "too many calls of %s in progress" % (functionPath,)
+        if (self.maxLag is not None and
+            self.monitor.currentLag() > self.maxLag):
+            return "overloaded"
+        return None
+
+    def release(self, result, functionPath):
+        """
+        Count a call of functionPath as finished, returning its result.
+        """
+        self.inFlight -= 1
+        count = self._methods[functionPath] - 1
+        if count:
+            self._methods[functionPath] = count
+        else:
+            del self._methods[functionPath]
+        return result
+
+    def stats(self):
+        """
+        Return the counters of the controller, as a dict.
+        """
+        return {"inFlight": self.inFlight, "admitted": self.admitted,
+                "rejected": self.rejected, "lag": self.monitor.lag}
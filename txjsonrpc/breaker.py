@@ -0,0 +1,226 @@
+"""
+Protecting a client from a server which is failing or overloaded, by
+refusing calls straight away instead of piling them up.
+
+A proxy can be given a L{CircuitBreaker}, which stops calls being sent to
+a server most of whose recent calls failed or were slow, and a
+L{ConcurrencyLimiter}, which caps the number of calls waiting for the
+server at a limit adapted to how it copes. Calls they refuse fail with a
+L{CallRejected} without having been sent:
+
+    proxy = Proxy(url)
+    proxy.breaker = CircuitBreaker()
+    proxy.limiter = ConcurrencyLimiter()
+
+Faults don't count as failures, as the server answered them, except for
+C{SERVER_BUSY} ones; cancelled calls don't count at all.
+"""
+import collections
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from txjsonrpc import jsonrpclib
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CallRejected(Exception):
+    """
+    A call was refused by the client, without being sent.
+    """
+
+
+class CircuitOpen(CallRejected):
+    """
+    A call was refused because the circuit breaker of its server is open.
+    """
+
+
+class ConcurrencyLimitExceeded(CallRejected):
+    """
+    A call was refused because too many calls are waiting for the server.
+    """
+
+
+def _outcome(result):
+    """
+    Return whether result, the result of a call, is a failure of the
+    server, or None if it doesn't say anything about the server.
+    """
+    if not isinstance(result, failure.Failure):
+        return False
+    if result.check(defer.CancelledError, CallRejected):
+        return None
+    if result.check(jsonrpclib.Fault):
+        # Only a server too busy to take the call is failing.
+        return result.value.faultCode == jsonrpclib.SERVER_BUSY
+    return True
+
+
+class CircuitBreaker(object):
+    """
+    Stop sending calls to a server whose recent calls mostly failed or were
+    slow.
+
+    The breaker is closed to begin with. It opens when, out of the last
+    window calls (and at least minCalls), the fraction which failed reaches
+    failureRate, or the fraction which took longer than slowCallTime
+    seconds reaches slowCallRate. Calls made while it is open fail with
+    L{CircuitOpen}. After resetTimeout seconds it is half-open: up to
+    halfOpenCalls calls are sent to try the server, closing the breaker if
+    they all succeed and opening it again as soon as one fails.
+
+    @ivar state: L{CLOSED}, L{OPEN} or L{HALF_OPEN}.
+    @ivar rejected: The number of calls refused.
+    @ivar opened: The number of times the breaker opened.
+    """
+
+    def __init__(self, failureRate=0.5, slowCallRate=1.0, slowCallTime=None,
+                 window=100, minCalls=10, resetTimeout=30, halfOpenCalls=1,
+                 clock=reactor):
+        self.failureRate = failureRate
+        self.slowCallRate = slowCallRate
+        self.slowCallTime = slowCallTime
+        self.minCalls = minCalls
+        self.resetTimeout = resetTimeout
+        self.halfOpenCalls = halfOpenCalls
+        self.clock = clock
+        self.state = CLOSED
+        self.rejected = self.opened = 0
+        self._outcomes = collections.deque(maxlen=window)
+        self._openedAt = None
+        self._trials = self._trialsPassed = 0
+
+    def start(self):
+        """
+        Check that a call may be sent, raising L{CircuitOpen} if not.
+
+        @return: the time the call starts, to be given to L{finish}.
+        """
+        if (self.state == OPEN and
+            self.clock.seconds() >= self._openedAt + self.resetTimeout):
+            self.state = HALF_OPEN
+            self._trials = self._trialsPassed = 0
+        if (self.state == OPEN or
+            (self.state == HALF_OPEN and
+             self._trials >= self.halfOpenCalls)):
+            self.rejected += 1
+            raise CircuitOpen("Circuit breaker open")
+        if self.state == HALF_OPEN:
+            self._trials += 1
+        return self.clock.seconds()
+
+    def finish(self, result, started):
+        """
+        Take the result of a call started at started into account.
+        """
+        failed = _outcome(result)
+        slow = (self.slowCallTime is not None and
+                self.clock.seconds() - started > self.slowCallTime)
+        if self.state == HALF_OPEN:
+            if failed is None:
+                self._trials -= 1
+            elif failed or slow:
+                self._open()
+            else:
+                self._trialsPassed += 1
+                if self._trialsPassed >= self.halfOpenCalls:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+        elif self.state == CLOSED and failed is not None:
+            self._outcomes.append((failed, slow))
+            self._check()
+        return result
+
+    def _check(self):
+        calls = len(self._outcomes)
+        if calls < self.minCalls:
+            return
+        failures = len([o for o in self._outcomes if o[0]])
+        slow = len([o for o in self._outcomes if o[1]])
+        if (failures >= self.failureRate * calls or
+            slow >= self.slowCallRate * calls):
+            self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened += 1
+        self._openedAt = self.clock.seconds()
+        self._outcomes.clear()
+
+    def stats(self):
+        """
+        Return the state and counters of the breaker, as a dict.
+        """
+        outcomes = list(self._outcomes)
+        return {"state": self.state, "rejected": self.rejected,
+                "opened": self.opened, "calls": len(outcomes),
+                "failures": len([o for o in outcomes if o[0]]),
+                "slow": len([o for o in outcomes if o[1]])}
+
+
+class ConcurrencyLimiter(object):
+    """
+    Cap the number of calls waiting for a server, adapting the cap to how
+    it copes (additive increase, multiplicative decrease): each call which
+    succeeds while at least half of the limit is in use raises it by one,
+    and each call which fails, or takes longer than latencyThreshold
+    seconds, multiplies it by backoff. Calls made when the limit is reached
+    fail with L{ConcurrencyLimitExceeded}.
+
+    @ivar limit: The current limit.
+    @ivar inFlight: The number of calls waiting for the server.
+    @ivar rejected: The number of calls refused.
+    """
+
+    def __init__(self, initialLimit=20, minLimit=1, maxLimit=1000,
+                 backoff=0.9, latencyThreshold=None, clock=reactor):
+        self.limit = initialLimit
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.backoff = backoff
+        self.latencyThreshold = latencyThreshold
+        self.clock = clock
+        self.inFlight = 0
+        self.rejected = 0
+
+    def start(self):
+        """
+        Count a call, raising L{ConcurrencyLimitExceeded} if there are too
+        many already.
+
+        @return: the time the call starts, to be given to L{finish}.
+        """
+        if self.inFlight >= int(self.limit):
+            self.rejected += 1
+            raise ConcurrencyLimitExceeded(
+                "%d calls in progress" % (self.inFlight,))
+        self.inFlight += 1
+        return self.clock.seconds()
+
+    def finish(self, result, started):
+        """
+        Take the result of a call started at started into account.
+        """
+        inFlight = self.inFlight
+        self.inFlight -= 1
+        failed = _outcome(result)
+        if failed is None:
+            return result
+        if failed or (self.latencyThreshold is not None and
+                      self.clock.seconds() - started > self.latencyThreshold):
+            self.limit = max(self.minLimit, self.limit * self.backoff)
+        elif inFlight * 2 >= self.limit:
+            self.limit = min(self.maxLimit, self.limit + 1)
+        return result
+
+    def stats(self):
+        """
+        Return the limit and counters of the limiter, as a dict.
+        """
+        return {"limit": int(self.limit), "inFlight": self.inFlight,
+                "rejected": self.rejected}
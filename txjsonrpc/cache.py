@@ -0,0 +1,349 @@
+"""
+Caching the results of JSON-RPC methods which give the same answer to the
+same params for a while, and sharing them between identical calls made at
+the same time.
+"""
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from twisted.web.iweb import IBodyProducer
+
+from txjsonrpc import jsonrpclib
+
+
+def _paramsKey(args, kwargs):
+    """
+    Return the canonical encoding of the params of a call, or None if they
+    can't be encoded.
+    """
+    try:
+        return jsonrpclib.json.dumps(
+            [args, kwargs], sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+
+
+def cached(ttl=None, maxsize=128, maxBytes=None):
+    """
+    Decorator caching the results of a method, keyed by its params.
+
+    A result is kept, already encoded, for ttl seconds (or until it is
+    evicted) and sent back as it is to calls with the same params. Faults
+    and other failures aren't cached, and neither are calls whose params
+    include anything which isn't JSON, such as the request given to a
+    method decorated with C{with_request}.
+
+    Every handler has a cache of its own for the method, a L{ResultCache}
+    returned by L{getCache}, so that handlers of the same class (say, one
+    per database) don't answer each other's calls. The copies of a handler
+    made for netstring connections share its cache.
+    """
+    def inner(method):
+        method.cacheOptions = (ttl, maxsize, maxBytes)
+        return method
+    return inner
+
+
+def getCache(function):
+    """
+    Return the L{ResultCache} of function, a method decorated with
+    L{cached}, or None if it wasn't.
+    """
+    options = getattr(function, "cacheOptions", None)
+    if options is None:
+        return None
+    return _callState(function, "cache", lambda: ResultCache(*options))
+
+
+def _callState(function, kind, create):
+    """
+    Return the state of the given kind kept for the calls of function,
+    made with create() the first time it is needed.
+
+    The state of a method is kept by the handler it is bound to, so that
+    every handler has its own, and that of a plain function by the
+    function itself.
+    """
+    handler = getattr(function, "__self__", None)
+    if handler is None:
+        states, key = function.__dict__.setdefault("_callState", {}), kind
+    else:
+        states = getattr(handler, "_callState", None)
+        if states is None:
+            states = handler._callState = {}
+        key = (kind, function.__func__)
+    state = states.get(key)
+    if state is None:
+        state = states[key] = create()
+    return state
+
+
+class ResultCache(object):
+    """
+    A cache of encoded results, evicting the least recently used ones when
+    there are more than maxsize of them or they take up more than maxBytes.
+
+    @ivar hits: The number of calls answered from the cache.
+    @ivar misses: The number of calls which weren't.
+    @ivar evictions: The number of results dropped to make room.
+    @ivar size: The number of bytes the cached results take up.
+    """
+
+    def __init__(self, ttl=None, maxsize=128, maxBytes=None, clock=reactor):
+        """
+        @type ttl: C{int} or C{float} or None
+        @param ttl: The number of seconds a result is kept, or None to keep
+        it until it is evicted.
+
+        @type maxsize: C{int} or None
+        @param maxsize: The most results kept, or None for no limit.
+
+        @type maxBytes: C{int} or None
+        @param maxBytes: The most bytes the results are allowed to take up,
+        or None for no limit.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxBytes = maxBytes
+        self.clock = clock
+        self.hits = self.misses = self.evictions = self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def makeKey(self, args, kwargs):
+        """
+        Return the canonical encoding of params, or None if they can't be
+        encoded.
+        """
+        return _paramsKey(args, kwargs)
+
+    def get(self, key):
+        """
+        Return the encoded result cached for key, or None.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        encoded, expires = entry
+        if expires is not None and expires <= self.clock.seconds():
+            self.size -= len(key) + len(encoded)
+            return None
+        # Put it back as the most recently used.
+        self._entries[key] = entry
+        return encoded
+
+    def put(self, key, encoded):
+        """
+        Cache encoded, an encoded result, under key, evicting the least
+        recently used results if there isn't room for it.
+        """
+        self._remove(key)
+        size = len(key) + len(encoded)
+        if self.maxBytes is not None and size > self.maxBytes:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock.seconds() + self.ttl
+        self._entries[key] = (encoded, expires)
+        self.size += size
+        while ((self.maxsize is not None and
+                len(self._entries) > self.maxsize) or
+               (self.maxBytes is not None and self.size > self.maxBytes)):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(key) + len(entry[0])
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Drop the result cached for a call with args and kwargs.
+        """
+        key = self.makeKey(list(args), kwargs)
+        if key is not None:
+            self._remove(key)
+
+    def clear(self):
+        """
+        Drop every cached result.
+        """
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        Return the counters of the cache, as a dict.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "entries": len(self._entries),
+                "bytes": self.size}
+
+    def call(self, codec, call, function, *args, **kwargs):
+        """
+        Return a Deferred which fires with the cached result for args and
+        kwargs, as L{jsonrpclib.RawJSON}, or get a result with call(function,
+        *args, **kwargs) and cache it, encoded with codec.
+        """
+        key = self.makeKey(list(args), kwargs)
+        if key is None:
+            return call(function, *args, **kwargs)
+        encoded = self.get(key)
+        if encoded is not None:
+            self.hits += 1
+            return defer.succeed(jsonrpclib.RawJSON(encoded))
+        self.misses += 1
+        d = call(function, *args, **kwargs)
+        d.addCallback(self._store, key, codec)
+        return d
+
+    def _store(self, result, key, codec):
+        if isinstance(result, jsonrpclib.Fault):
+            return result
+        try:
+            encoded = jsonrpclib._encodeResult(result, codec)
+        except Exception:
+            # Not something which can be encoded ahead of time.
+            return result
+        self.put(key, encoded)
+        return jsonrpclib.RawJSON(encoded)
+
+
+def coalesced(method):
+    """
+    Decorator making calls of a method share the result of an identical
+    call, one with the same params, which is already in progress instead
+    of running the method again. Each caller still gets its own response.
+
+    As with L{cached}, calls whose params include anything which isn't JSON
+    are never shared, and neither are calls of different handlers. The
+    calls in progress of a handler's method are an L{InFlightCalls},
+    returned by L{getInFlightCalls}.
+
+    A result which can only be read once can't be shared as it is: an
+    iterator is turned into a list for the callers to share, and a body
+    producer goes to the first caller, the method being called again for
+    each of the others.
+    """
+    method.coalesced = True
+    return method
+
+
+def getInFlightCalls(function):
+    """
+    Return the L{InFlightCalls} of function, a method decorated with
+    L{coalesced}, or None if it wasn't.
+    """
+    if not getattr(function, "coalesced", False):
+        return None
+    return _callState(function, "inFlight", InFlightCalls)
+
+
+class InFlightCalls(object):
+    """
+    The calls of a method which are in progress, keyed by their params.
+
+    @ivar coalesced: The number of calls which shared the result of another
+    one instead of being made.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def call(self, call, function, *args, **kwargs):
+        """
+        Return a Deferred which fires with the result of the identical call
+        in progress, or of call(function, *args, **kwargs) if there is
+        none.
+
+        Cancelling the Deferred only cancels the call once every caller
+        waiting for it has cancelled.
+        """
+        key = _paramsKey(list(args), kwargs)
+        if key is None:
+            return call(function, *args, **kwargs)
+        shared = self._calls.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            return shared.wait()
+        def again():
+            return defer.maybeDeferred(call, function, *args, **kwargs)
+        shared = self._calls[key] = _SharedCall(self, key, again)
+        waiter = shared.wait()
+        shared.start(again())
+        return waiter
+
+    def _finished(self, key, shared):
+        if self._calls.get(key) is shared:
+            del self._calls[key]
+
+
+class _SharedCall(object):
+    """
+    One call in progress, and the Deferreds of the callers waiting for its
+    result.
+
+    again makes the call anew, for the callers which can't share a result
+    with the first one.
+    """
+
+    def __init__(self, inFlight, key, again):
+        self.inFlight = inFlight
+        self.key = key
+        self.again = again
+        self.waiters = []
+        self.deferred = None
+        self._repeated = {}
+
+    def wait(self):
+        waiter = defer.Deferred(self._cancelWaiter)
+        self.waiters.append(waiter)
+        return waiter
+
+    def start(self, d):
+        self.deferred = d
+        d.addBoth(self._fire)
+
+    def _fire(self, result):
+        self.inFlight._finished(self.key, self)
+        waiters, self.waiters = self.waiters, []
+        if len(waiters) > 1 and jsonrpclib._isIterator(result):
+            try:
+                result = list(result)
+            except:
+                result = failure.Failure()
+        elif len(waiters) > 1 and IBodyProducer.providedBy(result):
+            waiters[0].callback(result)
+            for waiter in waiters[1:]:
+                self._repeat(waiter)
+            return
+        for waiter in waiters:
+            waiter.callback(result)
+
+    def _repeat(self, waiter):
+        """
+        Make the call again for waiter.
+        """
+        d = self._repeated[waiter] = self.again()
+
+        def done(result):
+            del self._repeated[waiter]
+            return result
+        d.addBoth(done).chainDeferred(waiter)
+
+    def _cancelWaiter(self, waiter):
+        if waiter in self._repeated:
+            self._repeated[waiter].cancel()
+            return
+        self.waiters.remove(waiter)
+        if not self.waiters and self.deferred is not None:
+            self.deferred.cancel()
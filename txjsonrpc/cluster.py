@@ -0,0 +1,457 @@
+"""
+Spreading JSON-RPC calls over several servers, without a load balancer in
+front of them.
+
+A L{ClusterProxy} is given one proxy for each server, such as a
+L{txjsonrpc.web.jsonrpc.Proxy} or a L{txjsonrpc.netstring.jsonrpc.Proxy},
+and sends each call through one of them, picked by its policy:
+
+    proxy = ClusterProxy([Proxy(url) for url in urls], LeastOutstanding())
+    d = proxy.callRemote("lookup", key)
+
+Servers which keep failing are left out for a while, and calls which
+couldn't reach their server at all are sent to another one.
+"""
+import bisect
+import collections
+import hashlib
+import itertools
+import random
+
+from twisted.internet import defer, error, reactor
+from twisted.python import failure, log
+
+from txjsonrpc import jsonrpclib
+from txjsonrpc.breaker import CallRejected
+from txjsonrpc.jsonrpc import BaseProxy
+
+
+def _endpointName(proxy):
+    """
+    Return a name for the server proxy sends calls to.
+    """
+    host = getattr(proxy, "host", None)
+    if host is None:
+        return repr(proxy)
+    return "%s:%s%s" % (host, proxy.port, getattr(proxy, "path", ""))
+
+
+class Endpoint(object):
+    """
+    One of the servers of a L{ClusterProxy}.
+
+    @ivar proxy: The proxy calls to the server are sent through.
+    @ivar name: The name of the server, such as C{"host:port/path"}.
+    @ivar outstanding: The number of calls sent to it which haven't been
+    answered yet.
+    @ivar failures: The number of calls in a row which it failed.
+    @ivar ejectedUntil: The time until which it is left out, or None.
+    """
+
+    def __init__(self, proxy, name=None):
+        if name is None:
+            name = _endpointName(proxy)
+        self.proxy = proxy
+        self.name = name
+        self.outstanding = 0
+        self.failures = 0
+        self.ejectedUntil = None
+
+    def __repr__(self):
+        return "<Endpoint %s>" % (self.name,)
+
+
+class RoundRobin(object):
+    """
+    Send calls to each server in turn.
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, endpoints, method, args):
+        """
+        Return the endpoint, one of endpoints, which a call of method with
+        args is sent to.
+        """
+        return endpoints[next(self._counter) % len(endpoints)]
+
+
+class LeastOutstanding(RoundRobin):
+    """
+    Send each call to the server with the fewest calls in progress, taking
+    turns between servers with as few.
+    """
+
+    def choose(self, endpoints, method, args):
+        start = next(self._counter) % len(endpoints)
+        endpoints = endpoints[start:] + endpoints[:start]
+        return min(endpoints, key=lambda endpoint: endpoint.outstanding)
+
+
+class PowerOfTwoChoices(object):
+    """
+    Send each call to the one with fewer calls in progress of two servers
+    picked at random. This is nearly as good as L{LeastOutstanding}, but
+    doesn't send every call to a server which has just come back.
+    """
+
+    def __init__(self, random=random):
+        self.random = random
+
+    def choose(self, endpoints, method, args):
+        if len(endpoints) == 1:
+            return endpoints[0]
+        first, second = self.random.sample(endpoints, 2)
+        if second.outstanding < first.outstanding:
+            return second
+        return first
+
+
+class ConsistentHash(object):
+    """
+    Send calls with the same key to the same server, the key being the
+    param at position argument (or all of the params, if there aren't
+    that many). When a server is left out, only the keys it was given move
+    to other servers.
+    """
+
+    def __init__(self, argument=0, replicas=100):
+        """
+        @type argument: C{int}
+        @param argument: The position of the key among the params.
+
+        @type replicas: C{int}
+        @param replicas: The number of points each server has on the hash
+        ring. More points spread the keys more evenly.
+        """
+        self.argument = argument
+        self.replicas = replicas
+        self._names = frozenset()
+        self._ring = None
+
+    def _hash(self, string):
+        return int(hashlib.md5(string).hexdigest()[:16], 16)
+
+    def _getRing(self, endpoints):
+        """
+        Return the hash ring, as the sorted list of its points and the list
+        of the names of the servers they belong to.
+
+        The ring has the points of every server seen so far, so that it is
+        only built again when a new one turns up, not whenever some servers
+        are left out.
+        """
+        names = frozenset([endpoint.name for endpoint in endpoints])
+        if not names <= self._names:
+            self._names |= names
+            ring = []
+            for name in self._names:
+                for i in range(self.replicas):
+                    ring.append((self._hash("%s-%d" % (name, i)), name))
+            ring.sort()
+            self._ring = ([point for point, name in ring],
+                          [name for point, name in ring])
+        return self._ring
+
+    def choose(self, endpoints, method, args):
+        if self.argument < len(args):
+            key = args[self.argument]
+        else:
+            key = args
+        key = jsonrpclib.json.dumps(key, sort_keys=True)
+        points, names = self._getRing(endpoints)
+        byName = dict((endpoint.name, endpoint) for endpoint in endpoints)
+        # Walk clockwise from the key to the first point of a server which
+        # is one of endpoints.
+        start = bisect.bisect(points, self._hash(key))
+        for i in xrange(start, start + len(points)):
+            endpoint = byName.get(names[i % len(points)])
+            if endpoint is not None:
+                return endpoint
+
+
+class Hedging(object):
+    """
+    When to send a second copy of a call of an idempotent method to another
+    server: once the first hasn't been answered within the given percentile
+    of the latencies of recent calls.
+
+    Each call adds budget to an allowance of hedged calls, capped at
+    maxTokens, and each hedged call takes one from it, so hedging never
+    adds more than a budget fraction of extra calls.
+
+    @ivar calls: The number of calls made.
+    @ivar hedged: The number of those a second copy was sent for.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, window=1000,
+                 minSamples=20, maxTokens=10):
+        """
+        @type percentile: C{int} or C{float}
+        @param percentile: The percentile of recent latencies after which
+        a call is hedged.
+
+        @type budget: C{float}
+        @param budget: The most extra calls hedging may add, as a fraction
+        of the calls made.
+
+        @type window: C{int}
+        @param window: The number of recent latencies kept.
+
+        @type minSamples: C{int}
+        @param minSamples: The number of latencies needed before any call is
+        hedged.
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.minSamples = minSamples
+        self.maxTokens = maxTokens
+        self.latencies = collections.deque(maxlen=window)
+        # The same latencies, kept sorted for picking the percentile.
+        self._sorted = []
+        self.tokens = 0.0
+        self.calls = self.hedged = 0
+
+    def record(self, latency):
+        """
+        Add the latency, in seconds, of a call answered by a server.
+        """
+        if len(self.latencies) == self.latencies.maxlen:
+            oldest = self.latencies[0]
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self.latencies.append(latency)
+        bisect.insort(self._sorted, latency)
+
+    def delay(self):
+        """
+        Count a call, and return the number of seconds after which it is
+        hedged, or None if there aren't enough latencies yet.
+        """
+        self.calls += 1
+        self.tokens = min(self.tokens + self.budget, self.maxTokens)
+        if len(self.latencies) < self.minSamples:
+            return None
+        latencies = self._sorted
+        i = int(len(latencies) * self.percentile / 100.0)
+        return latencies[min(i, len(latencies) - 1)]
+
+    def allow(self):
+        """
+        Return whether a call may be hedged, taking it out of the budget if
+        so.
+        """
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.hedged += 1
+        return True
+
+
+class _ClusterCall(object):
+    """
+    One call made through a L{ClusterProxy}, and the calls made to servers
+    for it.
+    """
+
+    def __init__(self, cluster, method, args, kwargs):
+        self.cluster = cluster
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.deferred = defer.Deferred(self._cancel)
+        self.tried = []
+        self.attempts = []
+        self.finished = False
+        self._hedge = None
+
+    def start(self):
+        """
+        Send the call, and hedge it later if its method is hedged.
+        """
+        self.send()
+        hedging = self.cluster.hedging.get(self.method)
+        if hedging is None or self.finished:
+            return
+        delay = hedging.delay()
+        if delay is not None:
+            self._hedge = self.cluster.clock.callLater(
+                delay, self._hedgeCall, hedging)
+
+    def _hedgeCall(self, hedging):
+        self._hedge = None
+        if (len(self.tried) < len(self.cluster.endpoints) and
+            hedging.allow()):
+            self.send()
+
+    def send(self):
+        """
+        Send the call to a server it hasn't been sent to yet.
+
+        @return: whether there was one.
+        """
+        endpoint = self.cluster._choose(self.method, self.args, self.tried)
+        if endpoint is None:
+            return False
+        self.tried.append(endpoint)
+        d = self.cluster._send(endpoint, self.method, self.args, self.kwargs)
+        self.attempts.append(d)
+        d.addBoth(self._answered, d)
+        return True
+
+    def _answered(self, result, d):
+        self.attempts.remove(d)
+        if self.finished:
+            # Another server answered first, or the call was cancelled.
+            return None
+        if (isinstance(result, failure.Failure) and
+            not result.check(jsonrpclib.Fault)):
+            if (result.check(error.ConnectError, CallRejected) and
+                self.send()):
+                # The call never reached the server, so it's safe to send
+                # it to another one.
+                return None
+            if self.attempts:
+                return None
+        elif (isinstance(result, failure.Failure) and
+              result.value.faultCode == jsonrpclib.SERVER_BUSY and
+              self.send()):
+            # The server refused the call without running it.
+            return None
+        self._finish()
+        self.deferred.callback(result)
+
+    def _finish(self):
+        self.finished = True
+        if self._hedge is not None:
+            self._hedge.cancel()
+            self._hedge = None
+        for d in self.attempts[:]:
+            d.cancel()
+
+    def _cancel(self, ignored):
+        self._finish()
+
+
+class ClusterProxy(BaseProxy):
+    """
+    A proxy making calls to one of several servers running the same
+    service, picked by a policy: L{RoundRobin} (the default),
+    L{LeastOutstanding}, L{PowerOfTwoChoices} or L{ConsistentHash}.
+
+    The health of the servers is tracked from the calls made to them: a
+    server failing C{maxFailures} calls in a row (with anything but a
+    Fault, which is a proper answer) is left out for C{ejectTime} seconds.
+    It then gets calls again, but is left out again straight away if the
+    first of them fails. If every server is left out, they are all used.
+
+    A call which fails because the connection to its server couldn't be
+    made, or which the circuit breaker or concurrency limiter of its
+    server's proxy refused (see L{BaseProxy}), or which the server refused
+    with a C{SERVER_BUSY} Fault, is sent to another server, as it can't
+    have been run. Calls which may have reached their server aren't, as
+    they might not be safe to repeat.
+
+    Calls of idempotent methods can be hedged with L{hedgeCalls}: if the
+    server hasn't answered after a while, the call is sent to another one
+    as well. The first answer is used, and the other call is cancelled.
+
+    The keyword arguments of calls, such as timeout, are passed on to the
+    proxy of the server. Coalescing and caching (see L{BaseProxy}) apply to
+    the whole cluster.
+    """
+    maxFailures = 3
+    ejectTime = 30
+
+    def __init__(self, proxies, policy=None, clock=reactor):
+        """
+        @type proxies: C{list}
+        @param proxies: The proxies of the servers, or L{Endpoint}s.
+
+        @param policy: The policy picking the server of each call.
+        """
+        BaseProxy.__init__(self)
+        if not proxies:
+            raise ValueError("A cluster needs at least one endpoint")
+        if policy is None:
+            policy = RoundRobin()
+        self.endpoints = [proxy if isinstance(proxy, Endpoint)
+                          else Endpoint(proxy) for proxy in proxies]
+        self.policy = policy
+        self.clock = clock
+        self.hedging = {}
+
+    def hedgeCalls(self, method, percentile=95, budget=0.05, **kwargs):
+        """
+        Hedge the calls of method, which must be safe to run twice. See
+        L{Hedging} for the parameters.
+
+        @return: the L{Hedging} of the method, also kept in C{hedging}.
+        """
+        hedging = self.hedging[method] = Hedging(
+            percentile, budget, **kwargs)
+        return hedging
+
+    def _isAvailable(self, endpoint):
+        if endpoint.ejectedUntil is None:
+            return True
+        if endpoint.ejectedUntil > self.clock.seconds():
+            return False
+        log.msg("Readmitting JSON-RPC endpoint %s" % (endpoint.name,))
+        endpoint.ejectedUntil = None
+        # On probation: one more failure and it's out again.
+        endpoint.failures = self.maxFailures - 1
+        return True
+
+    def _choose(self, method, args, exclude=()):
+        """
+        Return the endpoint a call of method with args is sent to, leaving
+        out those in exclude, or None if there are none left.
+        """
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint not in exclude]
+        available = [endpoint for endpoint in candidates
+                     if self._isAvailable(endpoint)]
+        if not available:
+            available = candidates
+        if not available:
+            return None
+        return self.policy.choose(available, method, args)
+
+    def _send(self, endpoint, method, args, kwargs):
+        endpoint.outstanding += 1
+        d = endpoint.proxy.callRemote(method, *args, **kwargs)
+        d.addBoth(self._answered, endpoint, method, self.clock.seconds())
+        return d
+
+    def _answered(self, result, endpoint, method, started):
+        endpoint.outstanding -= 1
+        if (not isinstance(result, failure.Failure) or
+            result.check(jsonrpclib.Fault)):
+            endpoint.failures = 0
+            hedging = self.hedging.get(method)
+            if hedging is not None:
+                hedging.record(self.clock.seconds() - started)
+        elif not result.check(defer.CancelledError, CallRejected):
+            self._failed(endpoint, result)
+        return result
+
+    def _failed(self, endpoint, reason):
+        endpoint.failures += 1
+        if (endpoint.failures >= self.maxFailures and
+            endpoint.ejectedUntil is None):
+            log.msg("Ejecting JSON-RPC endpoint %s for %s seconds: %s" % (
+                endpoint.name, self.ejectTime, reason.getErrorMessage()))
+            endpoint.ejectedUntil = self.clock.seconds() + self.ejectTime
+
+    def _callRemote(self, method, *args, **kwargs):
+        call = _ClusterCall(self, method, args, kwargs)
+        call.start()
+        return call.deferred
+
+    def notify(self, method, *args, **kwargs):
+        """
+        Send a notification to one of the servers.
+        """
+        endpoint = self._choose(method, args)
+        return endpoint.proxy.notify(method, *args, **kwargs)
@@ -1,7 +1,138 @@
-from twisted.internet import defer, protocol
-from twisted.python import reflect
+import base64
+import binascii
+import itertools
+import os
 
-from txjsonrpc import jsonrpclib
+from twisted.internet import defer, protocol, reactor
+from twisted.python import failure, reflect
+
+from txjsonrpc import jsonrpclib, processpool, threadpool
+from txjsonrpc.breaker import CallRejected
+from txjsonrpc.cache import (
+    InFlightCalls, ResultCache, getCache, getInFlightCalls)
+
+
+def timeout(seconds):
+    """
+    Decorator giving a method a timeout: if a call takes longer than seconds
+    to finish, its Deferred is cancelled and it fails with a
+    C{REQUEST_TIMEOUT} Fault. This takes the place of the server's own
+    timeout for the method.
+    """
+    def inner(method):
+        method.timeout = seconds
+        return method
+    return inner
+
+
+def getTimeout(function, default=None, requested=None):
+    """
+    Return how many seconds a call of function may take, or None if there
+    is no limit: the shorter of the timeout the function was given with
+    L{timeout} (or default if it wasn't) and requested, the time the client
+    is prepared to wait.
+    """
+    limits = [seconds
+              for seconds in (getattr(function, "timeout", default), requested)
+              if seconds is not None]
+    if limits:
+        return min(limits)
+    return None
+
+
+def callFunction(function, *args, **kwargs):
+    """
+    Call a function published by a handler, returning a Deferred which
+    fires with its result. It runs in a worker process if it was decorated
+    with L{processpool.in_process}, in a thread if it was decorated with
+    L{threadpool.in_thread}, and in the reactor thread otherwise. If it was
+    decorated with L{cache.cached}, its cached result may be used instead;
+    if it was decorated with L{cache.coalesced}, the result of an identical
+    call in progress may be.
+    """
+    return _callWithCodec(None, function, *args, **kwargs)
+
+
+def _callWithCodec(codec, function, *args, **kwargs):
+    """
+    Call function as L{callFunction} does, caching its result encoded with
+    codec, the codec of the server the call was made to.
+    """
+    resultCache = getCache(function)
+    if resultCache is not None:
+        return resultCache.call(
+            codec, _callShared, function, *args, **kwargs)
+    return _callShared(function, *args, **kwargs)
+
+
+def _callShared(function, *args, **kwargs):
+    inFlight = getInFlightCalls(function)
+    if inFlight is not None:
+        return inFlight.call(_callFunction, function, *args, **kwargs)
+    return _callFunction(function, *args, **kwargs)
+
+
+def _callFunction(function, *args, **kwargs):
+    if getattr(function, "in_process", False):
+        return processpool.getProcessPool(function).callInProcess(
+            function, *args, **kwargs)
+    return threadpool.maybeDeferToThread(function, *args, **kwargs)
+
+
+def _cancelAfter(d, seconds, clock, onTimeoutCancel):
+    """
+    Cancel d if it hasn't fired after seconds, passing the result it then
+    gets to onTimeoutCancel along with seconds.
+
+    This is what C{Deferred.addTimeout} does in recent versions of Twisted,
+    for the older ones which don't have it.
+
+    @return: d
+    """
+    timedOut = []
+
+    def timeItOut():
+        timedOut.append(True)
+        d.cancel()
+    delayedCall = clock.callLater(seconds, timeItOut)
+
+    def cbFired(result):
+        if delayedCall.active():
+            delayedCall.cancel()
+        if timedOut:
+            return onTimeoutCancel(result, seconds)
+        return result
+    return d.addBoth(cbFired)
+
+
+def _timeoutError(result, timeout):
+    """
+    Turn the cancellation of a call which timed out into a
+    L{defer.TimeoutError}.
+    """
+    if (isinstance(result, failure.Failure) and
+        result.check(defer.CancelledError)):
+        raise defer.TimeoutError("timed out after %s seconds" % (timeout,))
+    return result
+
+
+def addTimeout(d, seconds, clock=reactor):
+    """
+    Cancel the Deferred of a call if it hasn't fired after seconds, making
+    it fail with a C{REQUEST_TIMEOUT} Fault.
+
+    @return: d
+    """
+    if seconds is None:
+        return d
+
+    def onTimeoutCancel(result, timeout):
+        if (isinstance(result, failure.Failure) and
+            result.check(defer.CancelledError)):
+            raise jsonrpclib.Fault(jsonrpclib.REQUEST_TIMEOUT,
+                                   "timed out after %s seconds" % (timeout,))
+        return result
+    return _cancelAfter(d, seconds, clock, onTimeoutCancel)
 
 
 class BaseSubhandler:
@@ -9,14 +140,44 @@ class BaseSubhandler:
     Sub-handlers for prefixed methods (e.g., system.listMethods)
     can be added with putSubHandler. By default, prefixes are
     separated with a '.'. Override self.separator to change this.
+
+    Functions are looked up in a dispatch table, built the first time one
+    is needed, which maps the full path of every function published by the
+    handler and its sub-handlers to the function. Changing the sub-handlers
+    of any handler rebuilds the tables; anything else which changes the
+    functions a handler publishes should call _clearDispatchTable.
+
+    Methods decorated with L{txjsonrpc.threadpool.in_thread} run in the
+    threadPool of their handler, a L{txjsonrpc.threadpool.ThreadPool}; if
+    it is None, they share the default pool. Giving a sub-handler a pool of
+    its own keeps its slow functions from holding up the others. Likewise,
+    methods decorated with L{txjsonrpc.processpool.in_process} run in the
+    processPool of their handler, a L{txjsonrpc.processpool.ProcessPool}.
+
+    The admission of the handler requests are made to, a
+    L{txjsonrpc.admission.AdmissionController}, refuses calls the server is
+    too busy for. If it is None, every call is let in.
     """
     separator = '.'
+    threadPool = None
+    processPool = None
+    admission = None
+    callTimeout = None
+
+    _dispatchTable = None
+    _dispatchGeneration = None
+    # Bumped whenever sub-handlers are changed, making every table stale.
+    _handlersGeneration = 0
 
     def __init__(self):
         self.subHandlers = {}
+        # What the decorators in txjsonrpc.cache keep for calls of this
+        # handler's methods, shared with copies of the handler.
+        self._callState = {}
 
     def putSubHandler(self, prefix, handler):
         self.subHandlers[prefix] = handler
+        BaseSubhandler._handlersGeneration += 1
 
     def getSubHandler(self, prefix):
         return self.subHandlers.get(prefix, None)
@@ -24,6 +185,30 @@ class BaseSubhandler:
     def getSubHandlerPrefixes(self):
         return self.subHandlers.keys()
 
+    def _callAdmitted(self, functionPath, function, requestedTimeout, call):
+        """
+        Make a call of function, published as functionPath, once admission
+        lets it in, returning the Deferred call() returns. The call times
+        out after the time L{getTimeout} gives for it and requestedTimeout,
+        and gives its place back to admission when it finishes, or if call
+        raises.
+
+        This is what the servers do with every call they are asked for.
+        """
+        if self.admission is not None:
+            self.admission.admit(functionPath, function)
+        try:
+            d = call()
+        except:
+            if self.admission is not None:
+                self.admission.release(None, functionPath)
+            raise
+        d = addTimeout(d, getTimeout(
+            function, self.callTimeout, requestedTimeout))
+        if self.admission is not None:
+            d.addBoth(self.admission.release, functionPath)
+        return d
+
     def _getFunction(self, functionPath):
         """
         Given a string, return a function, or raise jsonrpclib.NoSuchFunction.
@@ -37,6 +222,20 @@ class BaseSubhandler:
         If functionPath contains self.separator, the sub-handler for
         the initial prefix is used to search for the remaining path.
         """
+        entry = self._getDispatchTable().get(functionPath)
+        if entry is None:
+            return self._lookupFunction(functionPath)
+        function, bind = entry
+        if bind:
+            return function.__get__(self, self.__class__)
+        return function
+
+    def _lookupFunction(self, functionPath):
+        """
+        Look functionPath up the slow way, for the functions which aren't in
+        the dispatch table, and to raise the right error for the ones which
+        don't exist.
+        """
         if functionPath.find(self.separator) != -1:
             prefix, functionPath = functionPath.split(self.separator, 1)
             handler = self.getSubHandler(prefix)
@@ -56,6 +255,51 @@ class BaseSubhandler:
         else:
             return f
 
+    def _getDispatchTable(self):
+        """
+        Return the dispatch table of this handler, building it if it's
+        missing or out of date.
+        """
+        if self._dispatchGeneration != BaseSubhandler._handlersGeneration:
+            self._dispatchTable = self._buildDispatchTable()
+            self._dispatchGeneration = BaseSubhandler._handlersGeneration
+        return self._dispatchTable
+
+    def _clearDispatchTable(self):
+        """
+        Make the dispatch tables of this handler, and of the handlers it is
+        a sub-handler of, be rebuilt the next time they are used.
+        """
+        BaseSubhandler._handlersGeneration += 1
+
+    def _buildDispatchTable(self):
+        """
+        Map the full path of every function published by this handler and
+        its sub-handlers to a (function, bind) pair.
+
+        The methods of this handler are kept unbound, with bind set, and
+        are bound to the handler they are looked up on. A copy of the
+        handler, such as a netstring protocol made for a connection, can
+        then share the table instead of building its own.
+
+        The functions of a sub-handler which overrides _getFunction are left
+        out, so that it is still asked for them.
+        """
+        table = {'__dir__': _unbound(self, self._listFunctions)}
+        for name in self._listFunctions():
+            f = getattr(self, "jsonrpc_%s" % name, None)
+            if callable(f):
+                table[name] = _unbound(self, f)
+        for prefix, handler in self.subHandlers.items():
+            if not _usesDispatchTable(handler):
+                continue
+            prefix += self.separator
+            for name, (f, bind) in handler._getDispatchTable().items():
+                if bind:
+                    f = f.__get__(handler, handler.__class__)
+                table[prefix + name] = (f, False)
+        return table
+
     def _listFunctions(self):
         """
         Return a list of the names of all jsonrpc methods.
@@ -63,34 +307,169 @@ class BaseSubhandler:
         return reflect.prefixedMethodNames(self.__class__, 'jsonrpc_')
 
 
+def _unbound(handler, f):
+    """
+    Return the dispatch table entry of f, a function of handler.
+    """
+    if getattr(f, "__self__", None) is handler:
+        return f.__func__, True
+    return f, False
+
+
+def _usesDispatchTable(handler):
+    """
+    Return whether handler looks its functions up with the dispatch table
+    of L{BaseSubhandler}.
+    """
+    if not isinstance(handler, BaseSubhandler):
+        return False
+    method = getattr(handler.__class__, "_getFunction", None)
+    return (getattr(method, "__func__", method)
+            is BaseSubhandler.__dict__["_getFunction"])
+
+
+class CounterIdGenerator(object):
+    """
+    Generate request ids which are consecutive integers.
+    """
+
+    def __init__(self, start=1):
+        self._counter = itertools.count(start)
+
+    def __call__(self):
+        return next(self._counter)
+
+
+class PrefixedIdGenerator(CounterIdGenerator):
+    """
+    Generate request ids which are consecutive integers after a string
+    prefix, e.g. "c0ffee-1", "c0ffee-2", ...
+
+    The default prefix is random, so that ids from different generators
+    don't collide.
+    """
+
+    def __init__(self, prefix=None, start=1):
+        CounterIdGenerator.__init__(self, start)
+        if prefix is None:
+            prefix = binascii.hexlify(os.urandom(4)) + "-"
+        self.prefix = prefix
+
+    def __call__(self):
+        return "%s%d" % (self.prefix, next(self._counter))
+
+
+class RandomIdGenerator(object):
+    """
+    Generate compact random request ids, which are unique without any
+    coordination between generators or processes.
+    """
+
+    def __init__(self, size=12):
+        """
+        @param size: The number of random bytes in an id. The ids themselves
+        are base64 encoded, so are 4/3 as long.
+        """
+        self.size = size
+
+    def __call__(self):
+        return base64.urlsafe_b64encode(os.urandom(self.size)).rstrip("=")
+
+
 class BaseQueryFactory(protocol.ClientFactory):
 
     deferred = None
     protocol = None
 
-    # XXX add an "id" parameter
-    id = 0
-    def __init__(self, method, version=jsonrpclib.VERSION_PRE1, *args):
-        # XXX pass the "id" parameter here
+    id = 1
+    notification = False
+    codec = None
+    timeout = None
+    # Whether the timeout is sent to the server as a "timeout" member of the
+    # request, rather than by the transport.
+    timeoutMember = False
+    _payload = None
+    # Abandons sending the query, or waiting for its response: set by
+    # whatever is sending it.
+    _abort = None
+
+    def __init__(self, method, version=jsonrpclib.VERSION_PRE1, *args,
+                 **kwargs):
         self.version = version
-        self.id = self.id + 1
-        self.payload = self._buildVersionedPayload(method, args)
-        self.deferred = defer.Deferred()
+        if kwargs.get("id") is not None:
+            self.id = kwargs["id"]
+        self.method, self.args = method, args
+        self.deferred = defer.Deferred(self._cancel)
+
+    def _cancel(self, deferred):
+        """
+        Stop the query when its Deferred is cancelled, dropping the
+        connection it is being sent over if the connection is its own.
+        """
+        self.deferred = None
+        if self._abort is not None:
+            abort, self._abort = self._abort, None
+            abort()
+
+    def startedConnecting(self, connector):
+        self._abort = connector.disconnect
+
+    def isCancelled(self):
+        """
+        Whether the query no longer needs sending, its Deferred having been
+        cancelled (or having fired).
+        """
+        return self.deferred is None
+
+    def _getPayload(self):
+        # The payload is only built once it is needed, so that proxies can
+        # give the factories they create their ids.
+        if self._payload is None:
+            self._payload = self._buildVersionedPayload(self.method, self.args)
+        return self._payload
+
+    def _setPayload(self, payload):
+        self._payload = payload
+
+    payload = property(_getPayload, _setPayload)
 
     def _buildVersionedPayload(self, *args):
+        timeout = None
+        if self.timeoutMember:
+            timeout = self.timeout
         if self.version == jsonrpclib.VERSION_PRE1:
-            return jsonrpclib._preV1Request(*args)
+            return jsonrpclib._preV1Request(*args, codec=self.codec)
         elif self.version == jsonrpclib.VERSION_1:
-            return jsonrpclib._v1Request(*args, id=self.id)
+            return jsonrpclib._v1Request(*args, id=self.id, codec=self.codec,
+                                         timeout=timeout)
         elif self.version == jsonrpclib.VERSION_2:
-            return jsonrpclib._v2Request(*args, id=self.id)
+            return jsonrpclib._v2Request(*args, id=self.id, codec=self.codec,
+                                         timeout=timeout)
 
     def parseResponse(self, contents):
+        self._handleResponse(self._loads, contents)
+
+    def _loads(self, contents):
+        return jsonrpclib.loads(contents, codec=self.codec)
+
+    def parseDecodedResponse(self, response):
+        """
+        Like parseResponse, for a response which has already been decoded
+        from JSON.
+        """
+        self._handleResponse(jsonrpclib.checkFault, response)
+
+    def _handleResponse(self, decode, response):
         if not self.deferred:
             return
+        if self.notification:
+            # Whatever came back, there is no result for a notification.
+            self.deferred.callback(None)
+            self.deferred = None
+            return
         try:
             # Convert the response from JSON-RPC to python.
-            result = jsonrpclib.loads(contents)
+            result = decode(response)
             if self.version != jsonrpclib.VERSION_PRE1:
                 result = result["result"]
             elif isinstance(result, list):
@@ -110,17 +489,260 @@ class BaseQueryFactory(protocol.ClientFactory):
     clientConnectionLost = clientConnectionFailed
 
     def badStatus(self, status, message):
-        self.deferred.errback(ValueError(status, message))
-        self.deferred = None
+        if self.deferred is not None:
+            self.deferred.errback(ValueError(status, message))
+            self.deferred = None
+
+
+class BaseBatchQueryFactory(BaseQueryFactory):
+    """
+    Send several queries as a single JSON-RPC 2.0 batch request, and hand
+    each of them its own response from the batch response.
+    """
+
+    def __init__(self, queries):
+        self.version = jsonrpclib.VERSION_2
+        self.queries = queries
+        for query in queries:
+            query._abort = self._queryCancelled
+
+    def _queryCancelled(self):
+        """
+        Drop the connection once every query in the batch is cancelled.
+        """
+        if not self.isCancelled():
+            return
+        if self._abort is not None:
+            abort, self._abort = self._abort, None
+            abort()
+
+    def _getPayload(self):
+        if self._payload is None:
+            self._payload = "[%s]" % (
+                ", ".join([query.payload for query in self.queries]),)
+        return self._payload
+
+    payload = property(_getPayload, BaseQueryFactory._setPayload)
+
+    def _getTimeout(self):
+        """
+        The longest timeout of the calls in the batch, which the server is
+        told for the whole batch, or None if any of them has none.
+        """
+        timeouts = [query.timeout for query in self.queries
+                    if not query.notification]
+        if not timeouts or None in timeouts:
+            return None
+        return max(timeouts)
+
+    timeout = property(_getTimeout)
+
+    def _isNotification(self):
+        for query in self.queries:
+            if not query.notification:
+                return False
+        return True
+
+    notification = property(_isNotification)
+
+    def isCancelled(self):
+        for query in self.queries:
+            if not query.isCancelled():
+                return False
+        return True
+
+    def parseResponse(self, contents):
+        if self.notification:
+            # A batch of notifications gets no response at all.
+            self._notified(self.queries)
+            return
+        try:
+            responses = jsonrpclib.getCodec(self.codec).decode(contents)
+        except Exception as error:
+            self._failQueries(error)
+        else:
+            self.parseDecodedResponse(responses)
+
+    def parseDecodedResponse(self, responses):
+        if not isinstance(responses, list):
+            # The batch as a whole was refused.
+            try:
+                jsonrpclib.checkFault(responses)
+            except Exception as error:
+                self._failQueries(error)
+            else:
+                self._failQueries(ValueError("Invalid batch response"))
+            return
+        queries = dict([(query.id, query) for query in self.queries
+                        if not query.notification])
+        for response in responses:
+            if isinstance(response, dict):
+                query = queries.pop(response.get("id"), None)
+                if query is not None:
+                    query.parseDecodedResponse(response)
+        self._failQueries(ValueError("No response in batch"),
+                          queries.values())
+        self._notified(self.queries)
+
+    def _notified(self, queries):
+        for query in queries:
+            if query.notification:
+                query.parseDecodedResponse(None)
+
+    def _failQueries(self, error, queries=None):
+        if queries is None:
+            queries = self.queries
+        for query in queries:
+            if query.deferred is not None:
+                query.deferred.errback(error)
+                query.deferred = None
+
+    def clientConnectionFailed(self, connector, reason):
+        for query in self.queries:
+            query.clientConnectionFailed(connector, reason)
+
+    clientConnectionLost = clientConnectionFailed
+
+    def badStatus(self, status, message):
+        for query in self.queries:
+            if query.deferred is not None:
+                query.badStatus(status, message)
 
 
 class BaseProxy:
     """
     A Proxy base class for making remote JSON-RPC calls.
+
+    When a batchWindow is given, JSON-RPC 2.0 calls are not sent straight
+    away: all of the calls made within batchWindow seconds of the first one
+    (with 0 meaning the same reactor iteration) are sent together as a
+    single batch request, by _sendQuery, once the window closes or
+    maxBatchSize calls have been collected.
+
+    Calls are encoded, and their responses decoded, with codec: the name of
+    a codec registered with L{jsonrpclib.registerCodec}, or a codec itself.
+    None means the process default set by L{jsonrpclib.setDefaultCodec}.
+
+    Calls which aren't answered within callTimeout seconds, or the number
+    given as the timeout keyword argument of a call, are cancelled and fail with
+    a L{defer.TimeoutError}; the server is told how long it has, too.
+    Cancelling the Deferred of a call drops its connection, unless the
+    connection is shared with other calls.
+
+    When coalesce is set, a call made while an identical one (the same
+    method, params and keyword arguments) is still waiting for its result
+    isn't sent: it gets the result of the one in progress. The callers then
+    share the same result object, so they shouldn't modify it. The results
+    of methods known to be idempotent can be cached as well, with
+    L{cacheResults}.
+
+    A L{txjsonrpc.breaker.CircuitBreaker} given as breaker and a
+    L{txjsonrpc.breaker.ConcurrencyLimiter} given as limiter make calls
+    fail straight away, without being sent, while the server is failing or
+    has too many calls waiting for it.
     """
-    def __init__(self, version=jsonrpclib.VERSION_PRE1, factoryClass=None):
+    maxBatchSize = 100
+    coalesce = False
+    breaker = None
+    limiter = None
+
+    def __init__(self, version=jsonrpclib.VERSION_PRE1, factoryClass=None,
+                 idGenerator=None, batchWindow=None, codec=None,
+                 callTimeout=None):
         self.version = version
         self.factoryClass = factoryClass
+        self.codec = codec
+        self.callTimeout = callTimeout
+        if idGenerator is None:
+            idGenerator = CounterIdGenerator()
+        self.idGenerator = idGenerator
+        self.batchWindow = batchWindow
+        self._batch = []
+        self._batchCall = None
+        self.caches = {}
+        self._inFlight = {}
+
+    def cacheResults(self, method, ttl=None, maxsize=128, maxBytes=None):
+        """
+        Cache the results of the remote method method, which must give the
+        same result to the same params for a while, so that calls with the
+        same params are answered without being sent. Faults aren't cached.
+
+        See L{txjsonrpc.cache.ResultCache} for the parameters.
+
+        @return: the L{txjsonrpc.cache.ResultCache} of the method, also
+        kept in C{caches}.
+        """
+        resultCache = self.caches[method] = ResultCache(
+            ttl, maxsize, maxBytes)
+        return resultCache
+
+    def callRemote(self, method, *args, **kwargs):
+        """
+        Call the remote method method with args.
+
+        @return: a Deferred which fires with its result.
+        """
+        resultCache = self.caches.get(method)
+        if resultCache is None:
+            return self._callCoalesced(method, *args, **kwargs)
+        key = resultCache.makeKey(list(args), {})
+        if key is None:
+            return self._callCoalesced(method, *args, **kwargs)
+        encoded = resultCache.get(key)
+        if encoded is not None:
+            resultCache.hits += 1
+            return defer.succeed(
+                jsonrpclib.getCodec(self.codec).decode(encoded))
+        resultCache.misses += 1
+        return self._callCoalesced(method, *args, **kwargs)
+
+    def _callCoalesced(self, method, *args, **kwargs):
+        if not self.coalesce:
+            return self._callAndCache(method, *args, **kwargs)
+        inFlight = self._inFlight.get(method)
+        if inFlight is None:
+            inFlight = self._inFlight[method] = InFlightCalls()
+        return inFlight.call(self._callAndCache, method, *args, **kwargs)
+
+    def _callAndCache(self, method, *args, **kwargs):
+        d = self._callGuarded(method, *args, **kwargs)
+        resultCache = self.caches.get(method)
+        if resultCache is not None:
+            key = resultCache.makeKey(list(args), {})
+            if key is not None:
+                d.addCallback(self._cacheResult, resultCache, key)
+        return d
+
+    def _callGuarded(self, method, *args, **kwargs):
+        """
+        Send a call, unless the breaker or the limiter refuse it.
+        """
+        started = []
+        try:
+            for guard in (self.breaker, self.limiter):
+                if guard is not None:
+                    started.append((guard, guard.start()))
+        except CallRejected:
+            d = defer.fail()
+        else:
+            d = self._callRemote(method, *args, **kwargs)
+        for guard, time in started:
+            d.addBoth(guard.finish, time)
+        return d
+
+    def _cacheResult(self, result, resultCache, key):
+        resultCache.put(key, jsonrpclib.getCodec(self.codec).encode(result))
+        return result
+
+    def _callRemote(self, method, *args, **kwargs):
+        """
+        Send a call of method with args to the server. Override in
+        subclasses.
+
+        @return: a Deferred which fires with its result.
+        """
+        raise NotImplementedError()
 
     def _getVersion(self, keywords):
         version = keywords.get("version")
@@ -134,6 +756,84 @@ class BaseProxy:
             factoryClass = self.factoryClass
         return factoryClass
 
+    def _getTimeout(self, keywords):
+        timeout = keywords.get("timeout")
+        if timeout is None:
+            timeout = self.callTimeout
+        return timeout
+
+    def _setTimeout(self, factory, timeout):
+        """
+        Cancel the call made by factory if it hasn't been answered within
+        timeout seconds, making it fail with a L{defer.TimeoutError}.
+        """
+        if timeout is not None:
+            factory.timeout = timeout
+            _cancelAfter(factory.deferred, timeout, reactor, _timeoutError)
+
+    def _buildFactory(self, factoryClass, *args):
+        """
+        Create a factory for a call, giving it the next request id.
+        """
+        factory = factoryClass(*args)
+        factory.id = self.idGenerator()
+        factory.codec = self.codec
+        return factory
+
+    def _buildNotificationFactory(self, factoryClass, *args):
+        """
+        Create a factory for a notification, which has no id.
+        """
+        factory = factoryClass(*args)
+        factory.id = None
+        factory.notification = True
+        factory.codec = self.codec
+        return factory
+
+    def _submitQuery(self, factory):
+        """
+        Send the query made by factory, or hold it back for the next batch.
+        """
+        if (self.batchWindow is None or
+            factory.version != jsonrpclib.VERSION_2):
+            self._sendQuery(factory)
+            return
+        self._batch.append(factory)
+        if len(self._batch) >= self.maxBatchSize:
+            self._flushBatch()
+        elif self._batchCall is None:
+            self._batchCall = reactor.callLater(
+                self.batchWindow, self._flushBatch)
+
+    def _flushBatch(self):
+        if self._batchCall is not None and self._batchCall.active():
+            self._batchCall.cancel()
+        self._batchCall = None
+        # Calls cancelled while waiting for the batch are left out.
+        batch = [factory for factory in self._batch
+                 if not factory.isCancelled()]
+        self._batch = []
+        if len(batch) == 1:
+            self._sendQuery(batch[0])
+        elif batch:
+            factory = self._buildBatchFactory(batch)
+            factory.codec = self.codec
+            self._sendQuery(factory)
+
+    def _buildBatchFactory(self, queries):
+        """
+        Create a factory sending queries as a single batch. Override in
+        subclasses.
+        """
+        raise NotImplementedError()
+
+    def _sendQuery(self, factory):
+        """
+        Send the query made by factory to the server. Override in
+        subclasses.
+        """
+        raise NotImplementedError()
+
 
 class Introspection(BaseSubhandler):
     """
@@ -199,6 +899,21 @@ class Introspection(BaseSubhandler):
     jsonrpc_methodSignature.signature = [['array', 'string'],
                                         ['string', 'string']]
 
+    def jsonrpc_cacheStats(self, method):
+        """
+        Return the hits, misses, evictions, entries and bytes of the result
+        cache of the given method. If its results aren't cached, the empty
+        string is returned.
+        """
+        method = self._jsonrpc_parent._getFunction(method)
+        resultCache = getCache(method)
+        if resultCache is None:
+            return ''
+        return resultCache.stats()
+
+    jsonrpc_cacheStats.signature = [['struct', 'string'],
+                                    ['string', 'string']]
+
 
 def addIntrospection(jsonrpc):
     """
@@ -2,6 +2,7 @@
 Requires simplejson; can be downloaded from
 http://cheeseshop.python.org/pypi/simplejson
 """
+import types
 import xmlrpclib
 from datetime import datetime
 
@@ -10,6 +11,11 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 # From xmlrpclib.
 SERVER_ERROR = xmlrpclib.SERVER_ERROR
@@ -23,6 +29,8 @@ INTERNAL_ERROR = xmlrpclib.INTERNAL_ERROR
 
 # Custom errors.
 METHOD_NOT_CALLABLE = -32604
+REQUEST_TIMEOUT = -32001
+SERVER_BUSY = -32002
 
 # Version constants.
 VERSION_PRE1 = 0
@@ -40,6 +48,37 @@ class NoSuchFunction(Fault):
     """
 
 
+class RawJSON(object):
+    """
+    JSON which has already been encoded, such as a response relayed from
+    another server, to be sent as it is.
+
+    A RawJSON returned as the result of a call is spliced into the response
+    without being decoded and encoded again. One nested inside another
+    result still works, but is decoded first.
+    """
+    __slots__ = ("encoded",)
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+    def __repr__(self):
+        return "RawJSON(%r)" % (self.encoded,)
+
+
+def _isIterator(result):
+    """
+    Return whether result is an iterator, such as a generator, rather than
+    a list or other value which is encoded in one go.
+    """
+    if isinstance(result, types.GeneratorType):
+        return True
+    if isinstance(result, (basestring, list, tuple, dict)):
+        return False
+    return (getattr(result, "next", None) is not None and
+            getattr(result, "__iter__", None) is not None)
+
+
 class JSONRPCEncoder(json.JSONEncoder):
     """
     Provide custom serializers for JSON-RPC.
@@ -47,10 +86,125 @@ class JSONRPCEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime):
             return obj.strftime("%Y%m%dT%H:%M:%S")
+        if isinstance(obj, RawJSON):
+            return json.loads(obj.encoded)
+        if _isIterator(obj):
+            return list(obj)
         raise TypeError("%r is not JSON serializable" % (obj,))
 
 
-def dumps(obj, **kwargs):
+class StdlibCodec(object):
+    """
+    Encode and decode JSON with the standard library's json module (or
+    simplejson, where json isn't available).
+
+    Codecs are registered by name with L{registerCodec}. Any extra keyword
+    arguments given to L{dumps} and L{loads} are passed on to them.
+    """
+    name = "json"
+
+    def encode(self, obj, **kwargs):
+        return json.dumps(obj, cls=JSONRPCEncoder, **kwargs)
+
+    def decode(self, string, **kwargs):
+        return json.loads(string, **kwargs)
+
+
+class UJSONCodec(StdlibCodec):
+    """
+    Encode and decode JSON with ujson.
+
+    ujson can't be given a fallback serializer, so anything it doesn't
+    know how to serialize, such as a C{datetime}, is handed to the standard
+    library instead, as are calls with extra keyword arguments.
+    """
+    name = "ujson"
+
+    def encode(self, obj, **kwargs):
+        if not kwargs:
+            try:
+                return ujson.dumps(obj, escape_forward_slashes=False)
+            except (TypeError, OverflowError):
+                pass
+        return StdlibCodec.encode(self, obj, **kwargs)
+
+    def decode(self, string, **kwargs):
+        if kwargs:
+            return StdlibCodec.decode(self, string, **kwargs)
+        return ujson.loads(string)
+
+
+codecs = {}
+defaultCodec = None
+
+
+def registerCodec(codec):
+    """
+    Make codec available under its name to L{getCodec} and everything which
+    takes a codec.
+    """
+    codecs[codec.name] = codec
+
+
+def setDefaultCodec(codec):
+    """
+    Use codec, a registered codec's name or a codec, for all of the JSON
+    encoding and decoding in the process which isn't given a codec of its
+    own.
+    """
+    global defaultCodec
+    defaultCodec = getCodec(codec)
+
+
+def getCodec(codec=None):
+    """
+    Return the codec registered under the name codec, or the default codec
+    if codec is None. Anything else is assumed to be a codec itself.
+    """
+    if codec is None:
+        return defaultCodec
+    if isinstance(codec, basestring):
+        try:
+            return codecs[codec]
+        except KeyError:
+            raise ValueError("No such JSON codec: %r" % (codec,))
+    return codec
+
+
+registerCodec(StdlibCodec())
+if ujson is not None:
+    registerCodec(UJSONCodec())
+setDefaultCodec("json")
+
+
+def _encodeResult(result, codec):
+    if isinstance(result, RawJSON):
+        return result.encoded
+    return getCodec(codec).encode(result)
+
+
+def _encodeId(id, codec):
+    if id is None:
+        return "null"
+    return getCodec(codec).encode(id)
+
+
+def responseEnvelope(id=None, version=VERSION_2, codec=None):
+    """
+    Return the text which goes before and after the encoded result in a
+    successful response, the same as encoding the whole response would
+    give.
+    """
+    if version == VERSION_2:
+        return ('{"jsonrpc": "2.0", "result": ',
+                ', "id": %s}' % (_encodeId(id, codec),))
+    elif version == VERSION_1:
+        return ('{"id": %s, "result": ' % (_encodeId(id, codec),),
+                ', "error": null}')
+    return '', ''
+
+
+def dumps(obj, codec=None, **kwargs):
     try:
         version = kwargs.pop("version")
     except KeyError:
@@ -59,6 +213,13 @@ def dumps(obj, **kwargs):
         id = kwargs.pop("id")
     except KeyError:
         id = None
+    if not kwargs and not isinstance(obj, Exception):
+        # Only the result and id of a successful response need encoding:
+        # they are spliced into the constant envelope.
+        if version in (VERSION_1, VERSION_2) or (
+            version == VERSION_PRE1 and obj):
+            prefix, suffix = responseEnvelope(id, version, codec)
+            return prefix + _encodeResult(obj, codec) + suffix
     if isinstance(obj, Exception):
         result = None
         if version!=VERSION_2:
@@ -86,11 +247,18 @@ def dumps(obj, **kwargs):
             obj = {"jsonrpc": "2.0", "result": result, "id": id}
     else:
         obj = {"result": result, "error": error, "id": id}
-    return json.dumps(obj, cls=JSONRPCEncoder, **kwargs)
+    return getCodec(codec).encode(obj, **kwargs)
+
 
+def loads(string, codec=None, **kws):
+    return checkFault(getCodec(codec).decode(string, **kws))
 
-def loads(string, **kws):
-    unmarshalled = json.loads(string, **kws)
+
+def checkFault(unmarshalled):
+    """
+    Raise the Fault carried by an already decoded JSON-RPC response, or
+    return the response unchanged if it doesn't carry one.
+    """
     # XXX there's going to need to be some version-conditional code here...
     # for versions greater than VERSION_PRE1, we'll have to check for the
     # "error" key, not the "fault" key... and then raise if "fault" is not
@@ -106,14 +274,33 @@ def loads(string, **kws):
 
 
 class SimpleParser(object):
+    """
+    Decode a JSON-RPC message fed to it in pieces.
+
+    The pieces are only joined, once, when the parser is closed, so feeding
+    a large message in many small pieces takes time proportional to its
+    size.
+    """
 
-    buffer = ''
+    def __init__(self, codec=None):
+        self.codec = codec
+        self._chunks = []
 
     def feed(self, data):
-        self.buffer += data
+        self._chunks.append(data)
 
     def close(self):
-        self.data = loads(self.buffer)
+        chunks, self._chunks = self._chunks, []
+        if len(chunks) == 1:
+            data = chunks[0]
+        else:
+            data = ''.join(chunks)
+        del chunks
+        # An empty body is all a server sends back for a notification.
+        if data:
+            self.data = loads(data, codec=self.codec)
+        else:
+            self.data = None
 
 
 class SimpleUnmarshaller(object):
@@ -124,14 +311,43 @@ class SimpleUnmarshaller(object):
     def getid(self):
         return self.parser.data.get("id")
 
+    def gettimeout(self):
+        """
+        Return the number of seconds the client is prepared to wait for the
+        call, or None if it didn't say.
+        """
+        return parseTimeout(self.parser.data.get("timeout"))
+
+    def getversion(self):
+        version = self.parser.data.get("jsonrpc")
+        if version:
+            return int(float(version))
+        elif "id" in self.parser.data:
+            return VERSION_1
+        return VERSION_PRE1
+
     def close(self):
         if isinstance(self.parser.data, dict):
             return self.parser.data.get("params")
         return self.parser.data
 
 
-def getparser():
-    parser = SimpleParser()
+def parseTimeout(value):
+    """
+    Return the timeout, in seconds, given by a client as value, or None if
+    it isn't a valid one.
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if value != value or value < 0:
+        return None
+    return value
+
+
+def getparser(codec=None):
+    parser = SimpleParser(codec)
     marshaller = SimpleUnmarshaller()
     marshaller.parser = parser
     return parser, marshaller
@@ -150,22 +366,27 @@ class Transport(xmlrpclib.Transport):
         return getparser()
 
 
-def _preV1Request(method="", params=[], *args):
-    return dumps({"method": method, "params": params})
+def _preV1Request(method="", params=[], codec=None, *args):
+    return dumps({"method": method, "params": params}, codec=codec)
 
 
-def _v1Request(method="", params=[], id="", *args):
-    return dumps(
-        {"method": method, "params": params, "id": id})
+def _v1Request(method="", params=[], id="", codec=None, timeout=None, *args):
+    request = {"method": method, "params": params, "id": id}
+    if timeout is not None:
+        request["timeout"] = timeout
+    return dumps(request, codec=codec)
 
 
 def _v1Notification(method="", params=[], *args):
     return _v1Request(method=method, params=params, id=None)
 
 
-def _v2Request(method="", params=[], id="", *args):
-    return dumps({
-        "jsonrpc": "2.0", "method": method, "params": params, "id": id})
+def _v2Request(method="", params=[], id="", codec=None, timeout=None, *args):
+    request = {
+        "jsonrpc": "2.0", "method": method, "params": params, "id": id}
+    if timeout is not None:
+        request["timeout"] = timeout
+    return dumps(request, codec=codec)
 
 
 def _v2Notification(method="", params=[], *args):
@@ -184,14 +405,8 @@ class ServerProxy(xmlrpclib.ServerProxy):
     def __request(self, *args):
         """
         Call a method on the remote server.
-
-        XXX Is there any way to indicate that we'd want a notification request
-        instead of a regular request?
         """
         request = self._getVersionedRequest(*args)
-        # XXX do a check here for id; if null, skip the response
-        # XXX in order to do this effectively, we might have to change the
-        # request functions to objects, so that we can get at an id attribute
         response = self.__transport.request(
             self.__host,
             self.__handler,
@@ -202,6 +417,22 @@ class ServerProxy(xmlrpclib.ServerProxy):
             response = response[0]
         return response
 
+    def notify(self, method, *args):
+        """
+        Send a notification to the remote server: call method with args,
+        without a result coming back.
+
+        Pre-1.0 JSON-RPC has no notifications, so with VERSION_PRE1 this
+        makes a regular call and discards its result.
+        """
+        request = self._getVersionedNotification(method, args)
+        self.__transport.request(
+            self.__host,
+            self.__handler,
+            request,
+            verbose=self.__verbose
+            )
+
     def _getVersionedRequest(self, *args):
         if self.version == VERSION_PRE1:
             return _preV1Request(*args)
@@ -209,3 +440,11 @@ class ServerProxy(xmlrpclib.ServerProxy):
             return _v1Request(*args)
         elif self.version == VERSION_2:
             return _v2Request(*args)
+
+    def _getVersionedNotification(self, *args):
+        if self.version == VERSION_PRE1:
+            return _preV1Request(*args)
+        elif self.version == VERSION_1:
+            return _v1Notification(*args)
+        elif self.version == VERSION_2:
+            return _v2Notification(*args)
@@ -7,13 +7,22 @@ API Stability: semi-stable
 
 Maintainer: U{Duncan McGreggor <mailto:oubiwann@adytum.us>}
 """
+import copy
+import inspect
+from collections import deque
+
 from twisted.internet import defer, protocol, reactor
 from twisted.protocols import basic
 from twisted.python import log
 
 from txjsonrpc import jsonrpclib
+from txjsonrpc.admission import concurrency_limit, priority
 from txjsonrpc.jsonrpc import (
-    BaseProxy, BaseQueryFactory, BaseSubhandler, Introspection)
+    BaseBatchQueryFactory, BaseProxy, BaseQueryFactory, BaseSubhandler,
+    Introspection, _callWithCodec, timeout)
+from txjsonrpc.cache import cached, coalesced
+from txjsonrpc.processpool import in_process
+from txjsonrpc.threadpool import in_thread
 
 
 class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
@@ -24,6 +33,15 @@ class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
     Binary, Boolean, DateTime, Deferreds, or Handler instances.
 
     By default methods beginning with 'jsonrpc_' are published.
+
+    Requests are decoded, and responses encoded, with codec: the name of a
+    codec registered with L{jsonrpclib.registerCodec}, or a codec itself.
+    None means the process default.
+
+    Calls which take longer than callTimeout seconds, or than the time given
+    by a method's L{timeout} decorator, are cancelled and fail with a
+    C{REQUEST_TIMEOUT} Fault. Clients may ask for a shorter timeout with a
+    "timeout" member in their requests.
     """
     # Error codes for Twisted, if they conflict with yours then
     # modify them at runtime.
@@ -32,51 +50,170 @@ class JSONRPC(basic.NetstringReceiver, BaseSubhandler):
 
     separator = '.'
     closed = 0
+    codec = None
+    callTimeout = None
 
 
     def __init__(self, version=jsonrpclib.VERSION_2):
+        BaseSubhandler.__init__(self)
         self.version = version
 
     def __call__(self):
-        return self
+        """
+        Return a protocol for a new connection.
+
+        Each connection gets its own copy of this instance, so that they
+        don't share a transport or any other connection state, while the
+        sub-handlers and everything else set up before listening are shared.
+        """
+        # Build the dispatch table first, so that every copy shares it.
+        self._getDispatchTable()
+        return copy.copy(self)
+
+    def _share(self, protocol):
+        """
+        Give protocol, a new instance made for a connection, the sub-handlers,
+        dispatch table and call state of this instance, and return it.
+        """
+        self._getDispatchTable()
+        protocol.subHandlers = self.subHandlers
+        protocol._dispatchTable = self._dispatchTable
+        protocol._dispatchGeneration = self._dispatchGeneration
+        protocol._callState = self._callState
+        return protocol
 
     def connectionMade(self):
         self.MAX_LENGTH = self.factory.maxLength
+        self._pending = set()
 
-    def stringReceived(self, line):
-        parser, unmarshaller = jsonrpclib.getparser()
-        deferred = defer.maybeDeferred(parser.feed, line)
+    def connectionLost(self, reason):
+        self.closed = 1
+        # Nobody is left to send the results of unfinished calls to.
+        pending, self._pending = self._pending, set()
+        for deferred in pending:
+            deferred.cancel()
+
+    def isIdle(self):
+        """
+        Return whether no call made over this connection is in progress.
+        """
+        return not self._pending
+
+    def _track(self, deferred):
+        """
+        Keep track of the call deferred until it fires, so that it can be
+        cancelled if the connection is lost first.
+        """
+        self._pending.add(deferred)
+
+        def untrack(result):
+            self._pending.discard(deferred)
+            return result
+        return deferred.addBoth(untrack)
 
-        req, req_id = self._cbDispatch(parser, unmarshaller)
-        deferred.addCallback(lambda x: req)
+    def stringReceived(self, line):
+        parser, unmarshaller = jsonrpclib.getparser(self.codec)
+        try:
+            parser.feed(line)
+            parser.close()
+        except ValueError:
+            return self._cbRender(
+                jsonrpclib.Fault(jsonrpclib.NOT_WELLFORMED_ERROR,
+                                 "parse error"),
+                req_id=None, version=self.version)
+        if isinstance(parser.data, list):
+            return self._dispatchBatch(parser.data)
+        if not isinstance(parser.data, dict):
+            return self._cbRender(
+                jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC,
+                                 "invalid request"),
+                req_id=None, version=self.version)
+        req_id, version = unmarshaller.getid(), unmarshaller.getversion()
+        deferred = self._track(defer.maybeDeferred(
+            self._cbDispatch, parser, unmarshaller))
         deferred.addErrback(self._ebRender, req_id = req_id)
-        deferred.addCallback(self._cbRender, req_id = req_id)
+        if req_id is None and version != jsonrpclib.VERSION_PRE1:
+            # Nothing is sent back for a notification.
+            return deferred
+        deferred.addCallback(self._cbRender, req_id = req_id,
+                             version = version)
         return deferred
 
     def _cbDispatch(self, parser, unmarshaller):
-        parser.close()
-        args, functionPath, req_id  = unmarshaller.close(), unmarshaller.getmethodname(), unmarshaller.getid()
+        args, functionPath = unmarshaller.close(), unmarshaller.getmethodname()
         function = self._getFunction(functionPath)
-        return defer.maybeDeferred(function, *args), req_id
+        return self._callAdmitted(
+            functionPath, function, unmarshaller.gettimeout(),
+            lambda: _callWithCodec(self.codec, function, *args))
+
+    def _dispatchBatch(self, batch):
+        """
+        Call every request in a JSON-RPC 2.0 batch at once, and send their
+        responses in a single array once they have all finished.
+        """
+        if not batch:
+            return self._cbRender(
+                jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "empty batch"),
+                req_id=None, version=jsonrpclib.VERSION_2)
+        deferred = defer.gatherResults(
+            [self._batchCall(request) for request in batch])
+        deferred.addCallback(self._cbRenderBatch)
+        return deferred
 
-    def _cbRender(self, result, req_id):
-        if not isinstance(result, jsonrpclib.Fault):
-            result = (result,)
-        #s = None
-        #e = None
+    def _batchCall(self, request):
+        """
+        Start one call of a batch, returning a Deferred which fires with its
+        serialized response, or None if it is a notification.
+        """
+        if not isinstance(request, dict):
+            f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "invalid request")
+            return defer.succeed(
+                self._serialize(f, None, jsonrpclib.VERSION_2))
+        parser, unmarshaller = jsonrpclib.getparser()
+        parser.data = request
+        req_id, version = unmarshaller.getid(), unmarshaller.getversion()
+        deferred = self._track(defer.maybeDeferred(
+            self._cbDispatch, parser, unmarshaller))
+        deferred.addErrback(self._ebRender, req_id = req_id)
+        if req_id is None:
+            deferred.addCallback(lambda result: None)
+        else:
+            deferred.addCallback(self._serialize, req_id, version)
+        return deferred
+
+    def _cbRenderBatch(self, responses):
+        responses = [response for response in responses
+                     if response is not None]
+        # A batch of notifications gets no response at all.
+        if responses and not self.closed:
+            self.sendString("[%s]" % (", ".join(responses),))
+
+    def _serialize(self, result, req_id, version):
+        if version == jsonrpclib.VERSION_PRE1:
+            if isinstance(result, jsonrpclib.RawJSON):
+                result = jsonrpclib.RawJSON("[%s]" % (result.encoded,))
+            elif not isinstance(result, jsonrpclib.Fault):
+                result = (result,)
         try:
-            s = jsonrpclib.dumps(result, id=req_id, version=self.version)
+            return jsonrpclib.dumps(result, id=req_id, version=version,
+                                    codec=self.codec)
         except:
             f = jsonrpclib.Fault(self.FAILURE, "can't serialize output")
-            #e = jsonrpclib.dumps(f)
-            s = jsonrpclib.dumps(f, id=req_id, version=self.version)
-        #result = {'result': result, 'error': e}
-        #return self.sendString(jsonrpclib.dumps(result))
-        return self.sendString(s)
+            return jsonrpclib.dumps(f, id=req_id, version=version,
+                                    codec=self.codec)
+
+    def _cbRender(self, result, req_id, version=None):
+        if version is None:
+            version = self.version
+        if self.closed:
+            return
+        return self.sendString(self._serialize(result, req_id, version))
 
     def _ebRender(self, failure, req_id):
         if isinstance(failure.value, jsonrpclib.Fault):
             return failure.value
+        if self.closed and failure.check(defer.CancelledError):
+            return None
         log.err(failure)
         return jsonrpclib.Fault(self.FAILURE, "error")
 
@@ -88,6 +225,9 @@ class QueryProtocol(basic.NetstringReceiver):
         msg = self.factory.payload
         packet = '%d:%s,' % (len(msg), msg)
         self.transport.write(packet)
+        if self.factory.notification:
+            # No response is coming.
+            self.transport.loseConnection()
 
     def stringReceived(self, string):
         self.factory.data = string
@@ -98,11 +238,144 @@ class QueryFactory(BaseQueryFactory):
 
     protocol = QueryProtocol
     data = ''
+    timeoutMember = True
 
     def clientConnectionLost(self, _, reason):
         self.parseResponse(self.data)
 
 
+class BatchQueryFactory(BaseBatchQueryFactory):
+
+    protocol = QueryProtocol
+    data = ''
+
+    def clientConnectionLost(self, _, reason):
+        self.parseResponse(self.data)
+
+
+class MultiplexedQueryProtocol(basic.NetstringReceiver):
+    """
+    A long-lived client protocol which writes many requests back to back
+    and matches the responses to them by their JSON-RPC id, in whatever
+    order they arrive.
+
+    @ivar pending: The queries which have been sent but not answered yet,
+    keyed by id.
+    """
+
+    def connectionMade(self):
+        self.pending = {}
+        self.factory._connectionMade(self)
+
+    def sendQuery(self, query):
+        if query.notification:
+            self.sendString(query.payload)
+            query.parseDecodedResponse(None)
+            return
+        self.pending[query.id] = query
+        query._abort = lambda: self._forget(query)
+        self.sendString(query.payload)
+
+    def _forget(self, query):
+        """
+        Stop waiting for the response to a cancelled query, making room for
+        another one. The response is discarded if it arrives after all.
+        """
+        if self.pending.pop(query.id, None) is not None:
+            self.factory._connectionReady(self)
+
+    def stringReceived(self, string):
+        try:
+            response = jsonrpclib.getCodec(self.factory.codec).decode(string)
+        except ValueError:
+            log.err(None, "Undecodable JSON-RPC response, disconnecting")
+            self.transport.loseConnection()
+            return
+        query = None
+        if isinstance(response, dict):
+            query = self.pending.pop(response.get("id"), None)
+        if query is None:
+            log.msg("Discarding JSON-RPC response for an unknown call")
+        else:
+            query.parseDecodedResponse(response)
+        self.factory._connectionReady(self)
+
+    def connectionLost(self, reason):
+        pending, self.pending = self.pending, {}
+        for query in pending.values():
+            query.clientConnectionFailed(None, reason)
+        self.factory._connectionLost(self)
+
+
+class MultiplexedQueryFactory(protocol.ReconnectingClientFactory):
+    """
+    Keep a single connection to a JSON-RPC server open, reconnecting with
+    exponential backoff when it is lost, and send queries over it.
+
+    No more than C{maxPending} queries are outstanding on the connection at
+    any time; the rest wait for earlier ones to be answered. Queries which
+    are waiting for a connection fail when an attempt to connect fails.
+    """
+    protocol = MultiplexedQueryProtocol
+    maxPending = 1000
+    maxDelay = 30
+
+    def __init__(self, maxPending=None, codec=None):
+        if maxPending is not None:
+            self.maxPending = maxPending
+        self.codec = codec
+        self.connection = None
+        self.waiting = deque()
+        self._lost = []
+
+    def submitQuery(self, query):
+        if query.isCancelled():
+            return
+        if (self.connection is not None and
+            len(self.connection.pending) < self.maxPending):
+            self.connection.sendQuery(query)
+        else:
+            self.waiting.append(query)
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return protocol.ReconnectingClientFactory.buildProtocol(self, addr)
+
+    def clientConnectionFailed(self, connector, reason):
+        waiting, self.waiting = self.waiting, deque()
+        for query in waiting:
+            query.clientConnectionFailed(None, reason)
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+    def notifyDisconnected(self):
+        """
+        Return a Deferred which fires when the current connection is lost.
+        """
+        d = defer.Deferred()
+        if self.connection is None:
+            d.callback(None)
+        else:
+            self._lost.append(d)
+        return d
+
+    def _connectionMade(self, connection):
+        self.connection = connection
+        self._connectionReady(connection)
+
+    def _connectionReady(self, connection):
+        while self.waiting and len(connection.pending) < self.maxPending:
+            query = self.waiting.popleft()
+            if not query.isCancelled():
+                connection.sendQuery(query)
+
+    def _connectionLost(self, connection):
+        self.connection = None
+        lost, self._lost = self._lost, []
+        for d in lost:
+            d.callback(None)
+
+
 class Proxy(BaseProxy):
     """
     A Proxy for making remote JSON-RPC calls.
@@ -114,7 +387,8 @@ class Proxy(BaseProxy):
     """
 
     def __init__(self, host, port, version=jsonrpclib.VERSION_PRE1,
-                 factoryClass=QueryFactory):
+                 factoryClass=QueryFactory, idGenerator=None,
+                 batchWindow=None, codec=None, callTimeout=None):
         """
         @type host: C{str}
         @param host: The host to which method calls are made.
@@ -132,20 +406,136 @@ class Proxy(BaseProxy):
         @param factoryClass: The factoryClass should be a subclass of
         QueryFactory (class, not instance) that will be used instead of
         QueryFactory.
+
+        @type idGenerator: C{callable} or None
+        @param idGenerator: A callable returning a new request id each time
+        it is called, such as a L{txjsonrpc.jsonrpc.CounterIdGenerator} (the
+        default), L{txjsonrpc.jsonrpc.PrefixedIdGenerator} or
+        L{txjsonrpc.jsonrpc.RandomIdGenerator}.
+
+        @type batchWindow: C{int} or C{float} or None
+        @param batchWindow: If given, JSON-RPC 2.0 calls made within this
+        many seconds of each other are sent together as a single batch
+        request. With 0, the calls made in the same reactor iteration are
+        batched.
+
+        @type codec: C{str} or codec or None
+        @param codec: The name of a codec registered with
+        L{jsonrpclib.registerCodec}, or a codec, to encode calls and decode
+        their responses with. If not specified, the process default is used.
+
+        @type callTimeout: C{int} or C{float} or None
+        @param callTimeout: The number of seconds after which calls which
+        have not been answered fail with a L{defer.TimeoutError}. With
+        JSON-RPC 1.0 and later, the server is sent it as the C{timeout}
+        member of the request, including within batches. A call's own
+        timeout keyword argument takes precedence.
         """
-        BaseProxy.__init__(self, version, factoryClass)
+        BaseProxy.__init__(self, version, factoryClass, idGenerator,
+                           batchWindow, codec, callTimeout)
         self.host = host
         self.port = port
 
-    def callRemote(self, method, *args, **kwargs):
+    def _callRemote(self, method, *args, **kwargs):
+        version = self._getVersion(kwargs)
+        factoryClass = self._getFactoryClass(kwargs)
+        factory = self._buildFactory(factoryClass, method, version, *args)
+        self._setTimeout(factory, self._getTimeout(kwargs))
+        self._submitQuery(factory)
+        return factory.deferred
+
+    def notify(self, method, *args, **kwargs):
+        """
+        Send a notification: call method with args, without a result coming
+        back. The returned Deferred fires with None once the notification
+        has been sent.
+
+        Pre-1.0 JSON-RPC has no notifications, so with VERSION_PRE1 this
+        makes a regular call and discards its result.
+        """
         version = self._getVersion(kwargs)
         factoryClass = self._getFactoryClass(kwargs)
-        factory = factoryClass(method, version, *args)
+        factory = self._buildNotificationFactory(
+            factoryClass, method, version, *args)
+        self._setTimeout(factory, self._getTimeout(kwargs))
+        self._submitQuery(factory)
+        return factory.deferred
+
+    def _buildBatchFactory(self, queries):
+        return BatchQueryFactory(queries)
+
+    def _sendQuery(self, factory):
         reactor.connectTCP(self.host, self.port, factory)
+
+
+class MultiplexedProxy(Proxy):
+    """
+    A Proxy which sends all of its calls over one persistent connection,
+    without waiting for earlier calls to be answered.
+
+    The connection is made on the first call and re-established, with
+    backoff, whenever it is lost. Responses are matched to calls by id, so
+    pre-1.0 JSON-RPC, which has no ids, can't be used.
+    """
+
+    def __init__(self, host, port, version=jsonrpclib.VERSION_2,
+                 factoryClass=QueryFactory, maxPending=None,
+                 idGenerator=None, codec=None, callTimeout=None):
+        """
+        See L{Proxy.__init__} for the other parameters.
+
+        @type maxPending: C{int}
+        @param maxPending: The maximum number of calls sent over the
+        connection and not yet answered. Further calls are held back until
+        answers arrive.
+        """
+        if version == jsonrpclib.VERSION_PRE1:
+            raise ValueError("Multiplexing requires JSON-RPC 1.0 or later")
+        Proxy.__init__(self, host, port, version, factoryClass, idGenerator,
+                       codec=codec, callTimeout=callTimeout)
+        self.connectionFactory = MultiplexedQueryFactory(maxPending, codec)
+        self.connector = None
+
+    def _callRemote(self, method, *args, **kwargs):
+        version = self._getVersion(kwargs)
+        factoryClass = self._getFactoryClass(kwargs)
+        factory = self._buildFactory(factoryClass, method, version, *args)
+        self._setTimeout(factory, self._getTimeout(kwargs))
+        self._sendQuery(factory)
         return factory.deferred
 
+    def _sendQuery(self, factory):
+        if self.connector is None:
+            self.connector = reactor.connectTCP(
+                self.host, self.port, self.connectionFactory)
+        self.connectionFactory.submitQuery(factory)
+
+    def disconnect(self):
+        """
+        Close the connection and stop reconnecting.
+
+        @return: a Deferred which fires when the connection is closed.
+        """
+        self.connectionFactory.stopTrying()
+        d = self.connectionFactory.notifyDisconnected()
+        if self.connector is not None:
+            self.connector.disconnect()
+            self.connector = None
+        return d
+
 
 class RPCFactory(protocol.ServerFactory):
+    """
+    A factory for JSON-RPC servers.
+
+    rpcClass may be a JSONRPC subclass or an instance of one. A single
+    instance of it, the dispatcher, holds the sub-handlers, and its dispatch
+    table and call state are shared by all connections.
+
+    Given a class, every connection gets a new instance of it, so that
+    whatever it sets up in __init__ belongs to that connection. Given an
+    instance, every connection gets a copy of it.
+    """
 
     protocol = None
 
@@ -153,22 +543,45 @@ class RPCFactory(protocol.ServerFactory):
         self.maxLength = maxLength
         self.protocol = rpcClass
         self.subHandlers = {}
+        self._dispatcher = None
+
+    def getDispatcher(self):
+        """
+        Return the JSONRPC instance whose sub-handlers the protocols for all
+        connections share, creating it and its sub-handlers on first use.
+        """
+        if self._dispatcher is None:
+            dispatcher = self.protocol
+            if inspect.isclass(dispatcher):
+                dispatcher = dispatcher()
+            for key, val in self.subHandlers.items():
+                klass, args, kws = val
+                if args and args[0] == 'protocol':
+                    dispatcher.putSubHandler(key, klass(dispatcher))
+                else:
+                    dispatcher.putSubHandler(key, klass(*args, **kws))
+            self._dispatcher = dispatcher
+        return self._dispatcher
 
     def buildProtocol(self, addr):
-        p = protocol.ServerFactory.buildProtocol(self, addr)
-        for key, val in self.subHandlers.items():
-            klass, args, kws = val
-            if args and args[0] == 'protocol':
-                p.putSubHandler(key, klass(p))
-            else:
-                p.putSubHandler(key, klass(*args, **kws))
+        dispatcher = self.getDispatcher()
+        if inspect.isclass(self.protocol):
+            p = dispatcher._share(self.protocol())
+        else:
+            p = dispatcher()
+        p.factory = self
         return p
 
     def putSubHandler(self, name, klass, args=(), kws={}):
         self.subHandlers[name] = (klass, args, kws)
+        # Sub-handlers are set up the next time a protocol is built.
+        self._dispatcher = None
 
     def addIntrospection(self):
         self.putSubHandler('system', Introspection, ('protocol',))
 
 
-__all__ = ["JSONRPC", "Proxy", "RPCFactory"]
+__all__ = [
+    "JSONRPC", "Proxy", "MultiplexedProxy", "RPCFactory", "timeout",
+    "in_thread", "in_process", "cached", "coalesced", "concurrency_limit",
+    "priority"]
@@ -4,13 +4,18 @@
 Test JSON-RPC over TCP support.
 """
 from __future__ import print_function
-from twisted.internet import reactor, defer
+import threading
+
+from twisted.internet import defer, error, reactor, task
 from twisted.trial import unittest
+from twisted.test.proto_helpers import StringTransport
 
 from txjsonrpc import jsonrpclib
+from txjsonrpc.admission import AdmissionController
 from txjsonrpc.netstring import jsonrpc
 from txjsonrpc.netstring.jsonrpc import (
     JSONRPC, Proxy, QueryFactory)
+from txjsonrpc.threadpool import ThreadPool
 
 
 class TestRuntimeError(RuntimeError):
@@ -86,6 +91,28 @@ class QueryFactoryTestCase(unittest.TestCase):
         factory = QueryFactory("mymethod", "myarg1", "myarg2")
         self.assertEquals(factory.protocol.MAX_LENGTH, 99999)
 
+    def testTimeoutMember(self):
+        factory = QueryFactory("mymethod", jsonrpclib.VERSION_2, "myarg")
+        factory.timeout = 5
+        request = jsonrpclib.json.loads(factory.payload)
+        self.assertEquals(request["timeout"], 5)
+
+    def testNoTimeoutMember(self):
+        factory = QueryFactory("mymethod", jsonrpclib.VERSION_2, "myarg")
+        self.assertNotIn("timeout", jsonrpclib.json.loads(factory.payload))
+
+    def testBatchTimeoutMembers(self):
+        """
+        Each call in a batch carries its own timeout.
+        """
+        queries = [QueryFactory("add", jsonrpclib.VERSION_2, 1, 2)
+                   for i in range(2)]
+        queries[0].timeout = 5
+        batch = jsonrpc.BatchQueryFactory(queries)
+        requests = jsonrpclib.json.loads(batch.payload)
+        self.assertEquals([request.get("timeout") for request in requests],
+                          [5, None])
+
 
 class JSONRPCTestCase(unittest.TestCase):
 
@@ -207,6 +234,461 @@ class JSONRPCMethodMaxLengthTestCase(JSONRPCTestCase):
         return d
 
 
+class BatchingProxyTestCase(JSONRPCTestCase):
+    """
+    Test with a proxy sending the calls made in one reactor iteration as a
+    single batch request.
+    """
+    def proxy(self):
+        if not hasattr(self, "batching"):
+            self.batching = Proxy("127.0.0.1", self.port,
+                                  version=jsonrpclib.VERSION_2, batchWindow=0)
+            self.sent = []
+            sendQuery = self.batching._sendQuery
+
+            def recordingSendQuery(factory):
+                self.sent.append(factory)
+                sendQuery(factory)
+            self.batching._sendQuery = recordingSendQuery
+        return self.batching
+
+    def testResults(self):
+        d = JSONRPCTestCase.testResults(self)
+        d.addCallback(lambda ign: self.assertEquals(len(self.sent), 1))
+        d.addCallback(lambda ign: self.assertEquals(
+            len(self.sent[0].queries), 5))
+        return d
+
+    def testBatchWindow(self):
+        proxy = self.proxy()
+        proxy.batchWindow = 0.05
+        calls = [proxy.callRemote("add", 1, 2)]
+        d = task.deferLater(reactor, 0.01, lambda: calls.append(
+            proxy.callRemote("add", 3, 4)))
+        d.addCallback(lambda ign: defer.gatherResults(calls))
+        d.addCallback(self.assertEquals, [3, 7])
+        d.addCallback(lambda ign: self.assertEquals(len(self.sent), 1))
+        return d
+
+
+class NotificationTest(Test):
+
+    notified = []
+
+    def jsonrpc_notice(self, x):
+        self.notified.append(x)
+        return "unwanted"
+
+
+class NotificationTestCase(unittest.TestCase):
+    """
+    Tests for sending notifications, which get no result.
+    """
+    def setUp(self):
+        NotificationTest.notified = []
+        self.p = reactor.listenTCP(0, jsonrpc.RPCFactory(NotificationTest),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def tearDown(self):
+        return self.p.stopListening()
+
+    def waitForNotification(self, ign=None):
+        if NotificationTest.notified:
+            return NotificationTest.notified.pop(0)
+        return task.deferLater(reactor, 0.01, self.waitForNotification)
+
+    def testNotify(self):
+        proxy = Proxy("127.0.0.1", self.port, version=jsonrpclib.VERSION_2)
+        d = proxy.notify("notice", "hello")
+        d.addCallback(self.assertEquals, None)
+        d.addCallback(self.waitForNotification)
+        d.addCallback(self.assertEquals, "hello")
+        return d
+
+    def testNotifyBatch(self):
+        proxy = Proxy("127.0.0.1", self.port, version=jsonrpclib.VERSION_2,
+                      batchWindow=0)
+        d = defer.gatherResults([proxy.notify("notice", "hello"),
+                                 proxy.notify("notice", "again")])
+        d.addCallback(self.assertEquals, [None, None])
+        d.addCallback(self.waitForNotification)
+        d.addCallback(self.assertEquals, "hello")
+        return d
+
+    def testNotifyMultiplexed(self):
+        proxy = jsonrpc.MultiplexedProxy("127.0.0.1", self.port)
+        d = proxy.notify("notice", "hello")
+        d.addCallback(self.assertEquals, None)
+        d.addCallback(lambda ign: proxy.callRemote("add", 1, 2))
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda ign: self.assertEquals(
+            NotificationTest.notified, ["hello"]))
+        d.addCallback(lambda ign: proxy.disconnect())
+        return d
+
+
+class SleepTest(Test):
+
+    def jsonrpc_sleep(self, x, seconds):
+        return task.deferLater(reactor, seconds, lambda: x)
+
+
+class MultiplexedProxyTestCase(JSONRPCTestCase):
+    """
+    Test with a proxy sending all of its calls over one connection.
+    """
+    def setUp(self):
+        self.p = reactor.listenTCP(0, jsonrpc.RPCFactory(SleepTest),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+        self.multiplexed = jsonrpc.MultiplexedProxy("127.0.0.1", self.port)
+
+    def tearDown(self):
+        d = self.multiplexed.disconnect()
+        d.addCallback(lambda ign: JSONRPCTestCase.tearDown(self))
+        return d
+
+    def proxy(self):
+        return self.multiplexed
+
+    def testPreVersion1Refused(self):
+        self.assertRaises(ValueError, jsonrpc.MultiplexedProxy,
+                          "127.0.0.1", self.port, jsonrpclib.VERSION_PRE1)
+
+    def testOneConnection(self):
+        connections = []
+
+        def secondCall(result):
+            connections.append(self.multiplexed.connectionFactory.connection)
+            return self.multiplexed.callRemote("add", 3, 4)
+
+        d = self.multiplexed.callRemote("add", 1, 2)
+        d.addCallback(secondCall)
+        d.addCallback(self.assertEquals, 7)
+        d.addCallback(lambda ign: self.assertIdentical(
+            self.multiplexed.connectionFactory.connection, connections[0]))
+        return d
+
+    def testOutOfOrderResponses(self):
+        results = []
+        first = self.multiplexed.callRemote("sleep", "first", 0.1)
+        second = self.multiplexed.callRemote("sleep", "second", 0)
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        d = defer.gatherResults([first, second])
+        d.addCallback(
+            lambda ign: self.assertEquals(results, ["second", "first"]))
+        return d
+
+    def testMaxPending(self):
+        self.multiplexed.connectionFactory.maxPending = 2
+        dl = [self.multiplexed.callRemote("add", i, 1) for i in range(5)]
+        d = defer.gatherResults(dl)
+        d.addCallback(self.assertEquals, [1, 2, 3, 4, 5])
+        return d
+
+    def testConnectionFailed(self):
+        d = self.p.stopListening()
+        d.addCallback(lambda ign: self.multiplexed.callRemote("add", 1, 2))
+        return self.assertFailure(d, error.ConnectionRefusedError)
+
+    def testTimeout(self):
+        """
+        A call which times out makes room for the next one, without the
+        connection being dropped.
+        """
+        self.multiplexed.connectionFactory.maxPending = 1
+        slow = self.multiplexed.callRemote("sleep", "slow", 0.2, timeout=0.05)
+        slow = self.assertFailure(slow, defer.TimeoutError)
+        quick = self.multiplexed.callRemote("add", 1, 2)
+        quick.addCallback(self.assertEquals, 3)
+        d = defer.gatherResults([slow, quick])
+        # Let the late response to the slow call be discarded.
+        d.addCallback(lambda ign: task.deferLater(reactor, 0.3, lambda: None))
+        d.addCallback(lambda ign: self.assertEquals(
+            self.multiplexed.connectionFactory.connection.pending, {}))
+        return d
+
+    def testCancelWaiting(self):
+        self.multiplexed.connectionFactory.maxPending = 1
+        first = self.multiplexed.callRemote("add", 1, 2)
+        second = self.multiplexed.callRemote("add", 3, 4)
+        second.cancel()
+        d = self.assertFailure(second, defer.CancelledError)
+        d.addCallback(lambda ign: first)
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda ign: task.deferLater(reactor, 0, lambda: None))
+        d.addCallback(lambda ign: self.assertEquals(
+            self.multiplexed.connectionFactory.connection.pending, {}))
+        return d
+
+
+class RPCFactoryTestCase(unittest.TestCase):
+
+    def testProtocolPerConnection(self):
+        factory = jsonrpc.RPCFactory(Test)
+        factory.addIntrospection()
+        first = factory.buildProtocol(None)
+        second = factory.buildProtocol(None)
+        self.assertNotIdentical(first, second)
+        self.assertIdentical(first.factory, factory)
+        self.assertIdentical(first.subHandlers, second.subHandlers)
+        self.assertIdentical(first.getSubHandler("system"),
+                             second.getSubHandler("system"))
+
+    def testSharedDispatchTable(self):
+        """
+        Connections share one dispatch table, which binds functions to the
+        protocol of the connection they are called on.
+        """
+        factory = jsonrpc.RPCFactory(Test)
+        first = factory.buildProtocol(None)
+        second = factory.buildProtocol(None)
+        self.assertIdentical(first._getDispatchTable(),
+                             second._getDispatchTable())
+        self.assertIdentical(second._getFunction("add").__self__, second)
+
+    def testClassInstancePerConnection(self):
+        """
+        Given a class, every connection gets an instance of its own, which
+        shares the sub-handlers, dispatch table and call state.
+        """
+        class Seeing(Test):
+            def __init__(self):
+                Test.__init__(self)
+                self.seen = []
+
+        factory = jsonrpc.RPCFactory(Seeing)
+        factory.addIntrospection()
+        first = factory.buildProtocol(None)
+        second = factory.buildProtocol(None)
+        self.assertNotIdentical(first.seen, second.seen)
+        self.assertIdentical(first.subHandlers, second.subHandlers)
+        self.assertIdentical(first._getDispatchTable(),
+                             second._getDispatchTable())
+        self.assertIdentical(first._callState, second._callState)
+
+    def testInstance(self):
+        instance = Test()
+        factory = jsonrpc.RPCFactory(instance)
+        p = factory.buildProtocol(None)
+        self.assertNotIdentical(p, instance)
+        self.assertIsInstance(p, Test)
+        self.assertIdentical(factory.getDispatcher(), instance)
+
+    def testPutSubHandlerLater(self):
+        factory = jsonrpc.RPCFactory(Test)
+        factory.buildProtocol(None)
+        factory.addIntrospection()
+        p = factory.buildProtocol(None)
+        self.assertNotEquals(p.getSubHandler("system"), None)
+
+    def testCancelOnConnectionLost(self):
+        cancelled = []
+
+        class Waiting(Test):
+            def jsonrpc_wait(self):
+                return defer.Deferred(cancelled.append)
+
+        factory = jsonrpc.RPCFactory(Waiting)
+        p = factory.buildProtocol(None)
+        p.makeConnection(StringTransport())
+        p.stringReceived('{"method": "wait", "params": [], "id": 1}')
+        self.assertEquals(len(p._pending), 1)
+        p.connectionLost(None)
+        self.assertEquals(len(cancelled), 1)
+        self.assertEquals(p._pending, set())
+        self.assertEquals(p.transport.value(), "")
+
+
+class TimeoutTest(Test):
+
+    def jsonrpc_hang(self):
+        return defer.Deferred()
+
+    @jsonrpc.timeout(0.01)
+    def jsonrpc_quick(self):
+        return defer.Deferred()
+
+
+class TimeoutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = jsonrpc.RPCFactory(TimeoutTest).buildProtocol(None)
+        self.protocol.makeConnection(StringTransport())
+
+    def call(self, request):
+        """
+        Make a call, returning a Deferred which fires with the response.
+        """
+        d = self.protocol.stringReceived(jsonrpclib.json.dumps(request))
+
+        def cbResponse(ignored):
+            length, response = self.protocol.transport.value().split(":", 1)
+            return jsonrpclib.json.loads(response[:-1])
+        return d.addCallback(cbResponse)
+
+    def assertTimedOut(self, response):
+        self.assertEquals(response["error"]["code"],
+                          jsonrpclib.REQUEST_TIMEOUT)
+
+    def testMethodTimeout(self):
+        d = self.call(
+            {"jsonrpc": "2.0", "method": "quick", "params": [], "id": 1})
+        return d.addCallback(self.assertTimedOut)
+
+    def testServerTimeout(self):
+        self.protocol.callTimeout = 0.01
+        d = self.call(
+            {"jsonrpc": "2.0", "method": "hang", "params": [], "id": 1})
+        return d.addCallback(self.assertTimedOut)
+
+    def testRequestedTimeout(self):
+        d = self.call(
+            {"jsonrpc": "2.0", "method": "hang", "params": [], "id": 1,
+             "timeout": 0.01})
+        return d.addCallback(self.assertTimedOut)
+
+    def testFinishedInTime(self):
+        self.protocol.callTimeout = 0.01
+        d = self.call({"jsonrpc": "2.0", "method": "add", "params": [1, 2],
+                       "id": 1})
+        d.addCallback(lambda response: self.assertEquals(response["result"],
+                                                         3))
+        return d
+
+
+class AdmissionTest(Test):
+
+    def jsonrpc_wait(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    @jsonrpc.concurrency_limit(1)
+    def jsonrpc_limited(self):
+        return self.jsonrpc_wait()
+
+    @jsonrpc.priority
+    def jsonrpc_health(self):
+        return "ok"
+
+
+class AdmissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = jsonrpc.RPCFactory(AdmissionTest).buildProtocol(None)
+        self.protocol.waiting = []
+        self.protocol.admission = AdmissionController(maxInFlight=2)
+        self.protocol.makeConnection(StringTransport())
+
+    def send(self, method):
+        return self.protocol.stringReceived(jsonrpclib.json.dumps(
+            {"jsonrpc": "2.0", "method": method, "params": [], "id": 1}))
+
+    def call(self, method):
+        """
+        Make a call which is answered straight away, returning a Deferred
+        which fires with the response.
+        """
+        self.protocol.transport.clear()
+        d = self.send(method)
+
+        def cbResponse(ignored):
+            length, response = self.protocol.transport.value().split(":", 1)
+            return jsonrpclib.json.loads(response[:-1])
+        return d.addCallback(cbResponse)
+
+    def assertBusy(self, response):
+        self.assertEquals(response["error"]["code"], jsonrpclib.SERVER_BUSY)
+
+    def testBusy(self):
+        """
+        Calls made while too many are in progress are refused, except for
+        priority ones, until some finish.
+        """
+        self.send("wait")
+        self.send("wait")
+        self.assertBusy(self.successResultOf(self.call("add")))
+        self.assertEquals(self.successResultOf(self.call("health"))["result"],
+                          "ok")
+        self.protocol.waiting.pop().callback("done")
+        self.assertEquals(self.successResultOf(self.call("complex"))["result"],
+                          {"a": ["b", "c", 12, []], "D": "foo"})
+
+    def testSynchronousFailure(self):
+        """
+        A call which fails before it is under way still makes room for
+        another.
+        """
+        def callWithCodec(codec, function, *args):
+            raise TestRuntimeError()
+        self.patch(jsonrpc, "_callWithCodec", callWithCodec)
+        response = self.successResultOf(self.call("complex"))
+        self.assertEquals(response["error"]["code"], self.protocol.FAILURE)
+        self.assertEquals(self.protocol.admission.inFlight, 0)
+        self.flushLoggedErrors(TestRuntimeError)
+
+    def testConcurrencyLimit(self):
+        self.send("limited")
+        self.assertBusy(self.successResultOf(self.call("limited")))
+        self.protocol.waiting.pop().callback("done")
+        self.send("limited")
+        self.assertEquals(self.protocol.admission.stats()["rejected"], 1)
+
+
+class IteratorTest(Test):
+
+    def jsonrpc_iterate(self):
+        return iter([1, 2])
+
+    def jsonrpc_generate(self):
+        return (i * 2 for i in xrange(2))
+
+
+class IteratorTestCase(unittest.TestCase):
+
+    def testIterators(self):
+        """
+        Generators and other iterators are sent as arrays.
+        """
+        protocol = jsonrpc.RPCFactory(IteratorTest).buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        results = []
+        for method in ["iterate", "generate"]:
+            protocol.transport.clear()
+            protocol.stringReceived(jsonrpclib.json.dumps(
+                {"jsonrpc": "2.0", "method": method, "params": [], "id": 1}))
+            length, response = protocol.transport.value().split(":", 1)
+            results.append(jsonrpclib.json.loads(response[:-1])["result"])
+        self.assertEquals(results, [[1, 2], [0, 2]])
+
+
+class ThreadTest(Test):
+
+    @jsonrpc.in_thread
+    def jsonrpc_thread(self):
+        return threading.currentThread().getName()
+
+
+class ThreadTestCase(unittest.TestCase):
+
+    def testInThread(self):
+        protocol = jsonrpc.RPCFactory(ThreadTest).buildProtocol(None)
+        protocol.threadPool = ThreadPool(maxthreads=1, name="netstring")
+        self.addCleanup(protocol.threadPool._stopIfStarted)
+        protocol.makeConnection(StringTransport())
+        d = protocol.stringReceived(jsonrpclib.json.dumps(
+            {"jsonrpc": "2.0", "method": "thread", "params": [], "id": 1}))
+
+        def check(ignored):
+            length, response = protocol.transport.value().split(":", 1)
+            name = jsonrpclib.json.loads(response[:-1])["result"]
+            self.assertTrue(name.startswith("PoolThread-netstring-"), name)
+        return d.addCallback(check)
+
+
 class JSONRPCTestIntrospection(JSONRPCTestCase):
 
     def setUp(self):
@@ -223,7 +705,8 @@ class JSONRPCTestIntrospection(JSONRPCTestCase):
                 meths,
                 ['add', 'complex', 'defer', 'deferFail',
                  'deferFault', 'dict', 'fail', 'fault',
-                 'pair', 'system.listMethods',
+                 'pair', 'system.cacheStats',
+                 'system.listMethods',
                  'system.methodHelp',
                  'system.methodSignature'])
 
@@ -0,0 +1,369 @@
+"""
+Running a JSON-RPC server in several processes which share one listening
+socket, so that it can use every core of the machine.
+
+A supervisor process opens the socket and starts the workers, which
+inherit it and accept connections on it: the kernel hands each connection
+to one of them. The supervisor replaces workers which die, and replaces
+all of them one at a time, without refusing any connections, when asked
+to restart (on SIGHUP, when run from the command line). A worker which is
+told to stop closes its end of the socket and finishes the calls it is
+serving first.
+
+The server is given as the fully qualified name of a protocol factory,
+such as a C{server.Site} wrapping a L{txjsonrpc.web.jsonrpc.JSONRPC}
+resource or a L{txjsonrpc.netstring.jsonrpc.RPCFactory}, or of a callable
+returning one. Each worker imports it anew, so it must be importable:
+
+    python -m txjsonrpc.prefork --port 7080 --workers 4 myapp.makeSite
+"""
+import multiprocessing
+import signal
+import socket
+import sys
+
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.internet.interfaces import IProtocolFactory
+from twisted.protocols import policies
+from twisted.python import log, reflect, usage
+
+from txjsonrpc.processpool import _workerEnvironment
+
+
+# The file descriptor of the listening socket in a worker.
+LISTEN_FD = 3
+
+
+def getFactory(name):
+    """
+    Return the protocol factory with the fully qualified name name, or the
+    result of calling name if it isn't a factory itself.
+    """
+    factory = reflect.namedAny(name)
+    if not IProtocolFactory.providedBy(factory):
+        factory = factory()
+    return factory
+
+
+class _CountingWrapper(policies.ProtocolWrapper):
+    """
+    Count the bytes received on a connection, so that a draining worker
+    can tell whether a client has sent anything since it last looked.
+    """
+    received = 0
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        policies.ProtocolWrapper.dataReceived(self, data)
+
+
+class _CountingFactory(policies.WrappingFactory):
+
+    protocol = _CountingWrapper
+
+
+def _isIdle(protocol):
+    """
+    Return whether protocol has no call in progress: either it has an
+    isIdle method, such as the netstring JSONRPC protocol, which says so,
+    or it is an HTTP channel with no request in progress.
+
+    Recent versions of Twisted wrap the channel a C{server.Site} builds in
+    a protocol which picks the version of HTTP, keeping it as C{_channel}.
+    """
+    isIdle = getattr(protocol, "isIdle", None)
+    if isIdle is not None:
+        return isIdle()
+    channel = getattr(protocol, "_channel", protocol)
+    return getattr(channel, "requests", None) == []
+
+
+class Worker(object):
+    """
+    Serve the connections accepted on the listening socket inherited from
+    the supervisor, until told to stop with SIGTERM.
+    """
+
+    def __init__(self, factory, family=socket.AF_INET, drainTimeout=30,
+                 reactor=reactor):
+        """
+        @param factory: The protocol factory for the connections.
+
+        @param family: The address family of the listening socket.
+
+        @type drainTimeout: C{int} or C{float}
+        @param drainTimeout: The longest time, in seconds, that a worker
+        which is stopping waits for its connections to close.
+        """
+        self.factory = _CountingFactory(factory)
+        self.family = family
+        self.drainTimeout = drainTimeout
+        self.reactor = reactor
+        self.port = None
+
+    def start(self):
+        self.port = self.reactor.adoptStreamPort(
+            LISTEN_FD, self.family, self.factory)
+        signal.signal(signal.SIGTERM, self._sigTerm)
+
+    def _sigTerm(self, *args):
+        self.reactor.callFromThread(self.drain)
+
+    def drain(self):
+        """
+        Stop accepting connections, and stop the reactor once the open ones
+        are closed or C{drainTimeout} seconds have passed.
+        """
+        self.port.stopListening()
+        deadline = self.reactor.seconds() + self.drainTimeout
+        received = {}
+
+        def check():
+            for wrapper in self.factory.protocols.keys():
+                # An idle persistent connection, over HTTP or netstrings,
+                # has nothing left to finish. One which hasn't been sent
+                # anything yet, or was sent something since the last check,
+                # may have a request on its way, though.
+                if (wrapper.received and
+                    received.get(wrapper) == wrapper.received and
+                    _isIdle(wrapper.wrappedProtocol)):
+                    wrapper.transport.loseConnection()
+                received[wrapper] = wrapper.received
+            if (not self.factory.protocols or
+                self.reactor.seconds() >= deadline):
+                loop.stop()
+                self.reactor.stop()
+        loop = task.LoopingCall(check)
+        loop.clock = self.reactor
+        loop.start(0.1)
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+    """
+    The supervisor's handle on one worker process.
+    """
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.stopping = False
+        self.ended = defer.Deferred()
+        self._kill = None
+
+    @property
+    def pid(self):
+        return self.transport.pid
+
+    def stop(self, timeout):
+        """
+        Tell the worker to stop, killing it if it hasn't after timeout
+        seconds.
+
+        @return: a Deferred which fires when it has stopped.
+        """
+        self.stopping = True
+        if self._signal("TERM"):
+            self._kill = self.supervisor.reactor.callLater(
+                timeout, self._signal, "KILL")
+        return self.ended
+
+    def _signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except error.ProcessExitedAlready:
+            return False
+        return True
+
+    def processEnded(self, reason):
+        if self._kill is not None and self._kill.active():
+            self._kill.cancel()
+        self.supervisor._workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class Supervisor(object):
+    """
+    Open a listening socket, and run a JSON-RPC server in several worker
+    processes which accept connections on it.
+
+    A worker which dies is replaced after C{restartDelay} seconds. Workers
+    which are stopped get C{drainTimeout} seconds to finish serving their
+    connections, and are then killed if they haven't exited a few seconds
+    later.
+    """
+    restartDelay = 1
+    drainTimeout = 30
+
+    def __init__(self, factory, port, interface="", workers=None,
+                 backlog=50, reactor=reactor):
+        """
+        @type factory: C{str}
+        @param factory: The fully qualified name of the protocol factory
+        the workers serve connections with, or of a callable returning it.
+
+        @type port: C{int}
+        @param port: The port to listen on, or 0 for any free port.
+
+        @type interface: C{str}
+        @param interface: The address of the interface to listen on. By
+        default, all IPv4 interfaces.
+
+        @type workers: C{int} or None
+        @param workers: The number of worker processes. If not given, there
+        is one for each CPU.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.factory = factory
+        self.port = port
+        self.interface = interface
+        self.size = workers
+        self.backlog = backlog
+        self.reactor = reactor
+        self.workers = []
+        self.running = False
+        self.socket = None
+        self._restarts = []
+
+    def start(self):
+        """
+        Open the listening socket and start the workers.
+        """
+        family = socket.AF_INET
+        if ":" in self.interface:
+            family = socket.AF_INET6
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.interface, self.port))
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+        self.port = self.socket.getsockname()[1]
+        self.running = True
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        while len(self.workers) < self.size:
+            self._spawn()
+
+    def stop(self):
+        """
+        Stop the workers and close the listening socket.
+
+        @return: a Deferred which fires when the workers have all exited.
+        """
+        if not self.running:
+            return defer.succeed(None)
+        self.running = False
+        restarts, self._restarts = self._restarts, []
+        for restart in restarts:
+            restart.cancel()
+        d = defer.DeferredList([self._stopWorker(worker)
+                                for worker in self.workers[:]])
+        d.addCallback(lambda ignored: self.socket.close())
+        return d
+
+    def restart(self):
+        """
+        Replace the workers one at a time: a new worker is started before
+        each old one is stopped, so that there are always workers accepting
+        connections.
+
+        @return: a Deferred which fires when the old workers have all
+        exited.
+        """
+        d = defer.succeed(None)
+        for worker in self.workers[:]:
+            d.addCallback(lambda ignored, worker=worker: self._replace(worker))
+        return d
+
+    def _replace(self, worker):
+        if not self.running or worker not in self.workers:
+            # It died, or everything was stopped, in the meantime.
+            return
+        self._spawn()
+        return self._stopWorker(worker)
+
+    def _stopWorker(self, worker):
+        return worker.stop(self.drainTimeout + 5)
+
+    def _spawn(self):
+        worker = _WorkerProcess(self)
+        args = [sys.executable, "-m", "txjsonrpc.prefork", "--worker",
+                "--drain-timeout", str(self.drainTimeout)]
+        if self.socket.family == socket.AF_INET6:
+            args.append("--ipv6")
+        args.append(self.factory)
+        self.reactor.spawnProcess(
+            worker, sys.executable, args, env=_workerEnvironment(),
+            childFDs={0: 0, 1: 1, 2: 2, LISTEN_FD: self.socket.fileno()})
+        self.workers.append(worker)
+        return worker
+
+    def _workerEnded(self, worker, reason):
+        self.workers.remove(worker)
+        if worker.stopping or not self.running:
+            return
+        log.err(reason, "JSON-RPC worker process died, restarting it")
+        self._restarts.append(
+            self.reactor.callLater(self.restartDelay, self._restart))
+
+    def _restart(self):
+        self._restarts = [restart for restart in self._restarts
+                          if restart.active()]
+        if self.running and len(self.workers) < self.size:
+            self._spawn()
+
+
+class Options(usage.Options):
+
+    synopsis = "[options] factory"
+
+    optParameters = [
+        ["port", "p", 7080, "The port to listen on.", int],
+        ["interface", "i", "", "The interface to listen on."],
+        ["workers", "w", None,
+         "The number of worker processes (default: one per CPU).", int],
+        ["drain-timeout", None, Supervisor.drainTimeout,
+         "The longest time a stopping worker waits for its connections to "
+         "close.", float],
+        ]
+
+    optFlags = [
+        ["worker", None, "Serve as a worker of a supervisor."],
+        ["ipv6", None, "The inherited socket is an IPv6 one (workers "
+         "only)."],
+        ]
+
+    def parseArgs(self, factory):
+        self["factory"] = factory
+
+
+def main(argv=None):
+    """
+    Run a supervisor, or a worker, as told by the command line arguments.
+    """
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.stderr.write("%s\n%s\n" % (options, e))
+        sys.exit(2)
+    log.startLogging(sys.stdout)
+    if options["worker"]:
+        family = socket.AF_INET
+        if options["ipv6"]:
+            family = socket.AF_INET6
+        worker = Worker(getFactory(options["factory"]), family,
+                        options["drain-timeout"])
+        reactor.callWhenRunning(worker.start)
+    else:
+        supervisor = Supervisor(options["factory"], options["port"],
+                                options["interface"], options["workers"])
+        supervisor.drainTimeout = options["drain-timeout"]
+        reactor.callWhenRunning(supervisor.start)
+
+        def restart(*args):
+            reactor.callFromThread(supervisor.restart)
+        signal.signal(signal.SIGHUP, restart)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""
+Running the CPU-bound functions of JSON-RPC handlers in a pool of worker
+processes, so that one server can use every core of the machine.
+
+The workers are long-lived Python processes started with
+C{reactor.spawnProcess}. Calls are pickled and written to a worker over a
+pipe, and their results come back the same way. A worker doesn't share
+anything with the server: it imports the class of the handler a method
+belongs to, makes an instance of it with no arguments, and calls the
+method on that. Methods run in a process should therefore belong to
+importable classes and only depend on their arguments.
+"""
+import cPickle as pickle
+import itertools
+import multiprocessing
+import os
+import sys
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import basic
+from twisted.python import log, reflect
+
+import txjsonrpc
+from txjsonrpc import jsonrpclib
+
+
+# The file descriptors of the pipes in a worker, as they are numbered in
+# the worker: calls are read from the first and results written to the
+# second. Its standard output and error are those of the server.
+REQUESTS_FD = 3
+RESPONSES_FD = 4
+
+
+def _pythonPath():
+    """
+    Return the Python path of a worker, which lets it import txjsonrpc and
+    the server's own modules.
+    """
+    path = [os.path.dirname(os.path.dirname(
+        os.path.abspath(txjsonrpc.__file__)))]
+    path.extend([os.path.abspath(entry) for entry in sys.path])
+    return os.pathsep.join(path)
+
+# Worked out straight away, since the relative entries are relative to the
+# directory the server started in.
+_workerPath = _pythonPath()
+
+
+def _workerEnvironment():
+    """
+    Return the environment of a worker: the server's, with the server's
+    Python path.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = _workerPath
+    return env
+
+
+def in_process(method):
+    """
+    Decorator to run a method in a worker process from the pool of its
+    handler (see L{getProcessPool}) instead of in the server process.
+    """
+    method.in_process = True
+    return method
+
+
+def _functionPath(function):
+    """
+    Return the fully qualified name of the class of the handler function is
+    a method of, and the name of the method; or the fully qualified name of
+    function and None if it isn't a method.
+    """
+    handler = getattr(function, "im_self", None)
+    if handler is None:
+        return reflect.qual(function), None
+    return reflect.qual(handler.__class__), function.__name__
+
+
+class _ResponseReceiver(basic.NetstringReceiver):
+    """
+    Split what a worker writes into responses, handing them to its
+    L{_WorkerProtocol}.
+    """
+    MAX_LENGTH = 2 ** 31
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def stringReceived(self, string):
+        self.worker.responseReceived(string)
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """
+    The server's end of the pipes to one worker process.
+
+    @ivar pending: The Deferreds of the calls sent to the worker which
+    haven't been answered yet, keyed by call id.
+    @ivar accepting: Whether the worker can still be sent calls.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = {}
+        self.accepting = True
+        self.ended = defer.Deferred()
+        self._receiver = _ResponseReceiver(self)
+
+    def connectionMade(self):
+        self._receiver.makeConnection(self.transport)
+
+    def sendCall(self, callId, function, args, kwargs):
+        d = defer.Deferred()
+        path, name = _functionPath(function)
+        request = pickle.dumps((callId, path, name, args, kwargs), 2)
+        self.pending[callId] = d
+        self.transport.writeToChild(
+            REQUESTS_FD, "%d:%s," % (len(request), request))
+        return d
+
+    def stop(self):
+        """
+        Close the pipe the worker reads calls from, so that it exits once
+        it has answered the calls it was given.
+        """
+        self.accepting = False
+        self.transport.closeChildFD(REQUESTS_FD)
+
+    def childConnectionLost(self, childFD):
+        if childFD == REQUESTS_FD:
+            self.accepting = False
+
+    def childDataReceived(self, childFD, data):
+        if childFD == RESPONSES_FD:
+            self._receiver.dataReceived(data)
+
+    def responseReceived(self, string):
+        callId, kind, value = pickle.loads(string)
+        d = self.pending.pop(callId, None)
+        if d is None:
+            return
+        if kind == "result":
+            d.callback(value)
+        elif kind == "fault":
+            d.errback(jsonrpclib.Fault(*value))
+        else:
+            d.errback(value)
+
+    def processEnded(self, reason):
+        pending, self.pending = self.pending, {}
+        for d in pending.values():
+            d.errback(reason)
+        self.pool._workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class ProcessPool(object):
+    """
+    A pool of worker processes for the CPU-bound functions of handlers.
+
+    The workers are started when the pool is first given a call, and
+    stopped when the reactor shuts down. Each call goes to the worker with
+    the fewest calls in progress. A worker which dies is replaced after
+    C{restartDelay} seconds; the calls it was running fail.
+    """
+    restartDelay = 1
+
+    def __init__(self, size=None, reactor=reactor):
+        """
+        @type size: C{int} or None
+        @param size: The number of worker processes. If not given, there
+        is one for each CPU.
+        """
+        if size is None:
+            size = multiprocessing.cpu_count()
+        self.size = size
+        self.reactor = reactor
+        self.workers = []
+        self.running = False
+        self._callIds = itertools.count(1)
+        self._restarts = []
+        self._shutdownTrigger = None
+
+    def start(self):
+        """
+        Start the workers.
+        """
+        self.running = True
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                "before", "shutdown", self.stop)
+        while len(self.workers) < self.size:
+            self._spawn()
+
+    def stop(self):
+        """
+        Stop the workers once they have answered the calls they were given.
+
+        @return: a Deferred which fires when they have all exited.
+        """
+        self.running = False
+        restarts, self._restarts = self._restarts, []
+        for restart in restarts:
+            restart.cancel()
+        ended = []
+        for worker in self.workers[:]:
+            ended.append(worker.ended)
+            worker.stop()
+        return defer.DeferredList(ended)
+
+    def callInProcess(self, function, *args, **kwargs):
+        """
+        Call function with args and kwargs in the least loaded worker.
+
+        @return: a Deferred which fires with the result of the call.
+        """
+        if not self.running:
+            self.start()
+        workers = [worker for worker in self.workers if worker.accepting]
+        if not workers:
+            # They all died, and haven't been replaced yet.
+            workers = [self._spawn()]
+        worker = min(workers, key=lambda worker: len(worker.pending))
+        try:
+            return worker.sendCall(
+                next(self._callIds), function, args, kwargs)
+        except Exception:
+            return defer.fail()
+
+    def _spawn(self):
+        worker = _WorkerProtocol(self)
+        self.reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, "-m", "txjsonrpc.processpool"],
+            env=_workerEnvironment(),
+            childFDs={0: 0, 1: 1, 2: 2, REQUESTS_FD: "w", RESPONSES_FD: "r"})
+        self.workers.append(worker)
+        return worker
+
+    def _workerEnded(self, worker, reason):
+        self.workers.remove(worker)
+        if not self.running:
+            return
+        log.err(reason, "JSON-RPC worker process died, restarting it")
+        self._restarts.append(
+            self.reactor.callLater(self.restartDelay, self._restart))
+
+    def _restart(self):
+        self._restarts = [restart for restart in self._restarts
+                          if restart.active()]
+        if self.running and len(self.workers) < self.size:
+            self._spawn()
+
+
+defaultProcessPool = ProcessPool()
+
+
+def setDefaultProcessPool(pool):
+    """
+    Run the functions decorated with L{in_process} whose handlers have no
+    pool of their own in pool.
+    """
+    global defaultProcessPool
+    defaultProcessPool = pool
+
+
+def getProcessPool(function):
+    """
+    Return the pool function is run in: the C{processPool} of the handler
+    it is a method of, if it has one, or the default pool.
+    """
+    pool = getattr(getattr(function, "im_self", None), "processPool", None)
+    if pool is None:
+        pool = defaultProcessPool
+    return pool
+
+
+def _readString(stream):
+    """
+    Read a netstring from stream, returning None at the end of it.
+    """
+    length = ""
+    while True:
+        c = stream.read(1)
+        if not c:
+            return None
+        if c == ":":
+            break
+        length += c
+    string = stream.read(int(length))
+    if stream.read(1) != ",":
+        raise ValueError("Malformed netstring")
+    return string
+
+
+def _getFunction(handlers, path, name):
+    """
+    Return the function a call names, making an instance of its handler
+    class the first time one of the methods of the class is called.
+    """
+    if name is None:
+        return reflect.namedAny(path)
+    handler = handlers.get(path)
+    if handler is None:
+        handler = handlers[path] = reflect.namedAny(path)()
+    return getattr(handler, name)
+
+
+def _call(handlers, path, name, args, kwargs):
+    """
+    Make a call, returning the kind of its outcome and its value.
+    """
+    try:
+        return "result", _getFunction(handlers, path, name)(*args, **kwargs)
+    except jsonrpclib.Fault as f:
+        return "fault", (f.faultCode, f.faultString)
+    except Exception as e:
+        try:
+            # Not every exception can be unpickled.
+            pickle.loads(pickle.dumps(e, 2))
+        except Exception:
+            e = RuntimeError("%s: %s" % (reflect.qual(e.__class__), e))
+        return "error", e
+
+
+def work(requests, responses):
+    """
+    Answer the calls read from the file requests, writing their results to
+    the file responses, until requests is closed.
+    """
+    handlers = {}
+    while True:
+        request = _readString(requests)
+        if request is None:
+            return
+        callId, path, name, args, kwargs = pickle.loads(request)
+        kind, value = _call(handlers, path, name, args, kwargs)
+        try:
+            response = pickle.dumps((callId, kind, value), 2)
+        except Exception as e:
+            response = pickle.dumps((callId, "error", RuntimeError(
+                "Can't send the result back: %s" % (e,))), 2)
+        responses.write("%d:%s," % (len(response), response))
+        responses.flush()
+
+
+if __name__ == "__main__":
+    try:
+        work(os.fdopen(REQUESTS_FD, "rb"), os.fdopen(RESPONSES_FD, "wb"))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,157 @@
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from txjsonrpc.admission import (
+    AdmissionController, LagMonitor, ServerBusy, concurrency_limit,
+    priority)
+from txjsonrpc.jsonrpc import BaseSubhandler
+from txjsonrpc.jsonrpclib import SERVER_BUSY
+
+
+def plain():
+    pass
+
+
+@priority
+def health():
+    pass
+
+
+@concurrency_limit(1)
+def limited():
+    pass
+
+
+class LagMonitorTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.monitor = LagMonitor(0.1, self.clock)
+        self.addCleanup(self.monitor.stop)
+
+    def test_lag(self):
+        self.monitor.start()
+        self.assertTrue(self.monitor.running)
+        self.clock.advance(0.1)
+        self.assertEquals(self.monitor.lag, 0)
+        self.clock.advance(0.5)
+        self.assertAlmostEqual(self.monitor.lag, 0.4)
+
+    def test_currentLag(self):
+        """
+        A measurement which is already late counts before it is made.
+        """
+        self.monitor.start()
+        self.clock.rightNow += 1
+        self.assertEquals(self.monitor.lag, 0)
+        self.assertAlmostEqual(self.monitor.currentLag(), 0.9)
+
+    def test_stop(self):
+        self.monitor.start()
+        self.monitor.stop()
+        self.assertFalse(self.monitor.running)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+class AdmissionControllerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.controller = AdmissionController(maxInFlight=2, retryAfter=5,
+                                              clock=self.clock)
+        self.addCleanup(self.controller.stop)
+
+    def test_decorators(self):
+        self.assertTrue(health.priority)
+        self.assertEquals(limited.concurrencyLimit, 1)
+
+    def test_maxInFlight(self):
+        self.controller.admit("plain", plain)
+        self.controller.admit("plain", plain)
+        e = self.assertRaises(ServerBusy, self.controller.admit, "plain",
+                              plain)
+        self.assertEquals(e.faultCode, SERVER_BUSY)
+        self.assertEquals(e.retryAfter, 5)
+        self.assertIn("retry after 5 seconds", e.faultString)
+        self.assertEquals(self.controller.release("result", "plain"),
+                          "result")
+        self.controller.admit("plain", plain)
+        self.assertEquals(self.controller.stats(),
+                          {"inFlight": 2, "admitted": 3, "rejected": 1,
+                           "lag": 0})
+
+    def test_priority(self):
+        """
+        Priority methods are let in however busy the server is, and count
+        as in progress.
+        """
+        self.controller.admit("plain", plain)
+        self.controller.admit("plain", plain)
+        self.controller.admit("health", health)
+        self.assertEquals(self.controller.inFlight, 3)
+
+    def test_concurrencyLimit(self):
+        self.controller.admit("limited", limited)
+        self.assertRaises(ServerBusy, self.controller.admit, "limited",
+                          limited)
+        self.controller.admit("plain", plain)
+        self.controller.release(None, "limited")
+        self.controller.release(None, "plain")
+        self.controller.admit("limited", limited)
+
+    def test_lag(self):
+        self.controller.maxLag = 0.5
+        self.controller.admit("plain", plain)
+        self.assertTrue(self.controller.monitor.running)
+        self.controller.release(None, "plain")
+        self.clock.advance(1)
+        self.assertRaises(ServerBusy, self.controller.admit, "plain", plain)
+        self.controller.admit("health", health)
+        self.clock.advance(0.1)
+        self.controller.admit("plain", plain)
+
+    def test_shutdownTrigger(self):
+        """
+        The lag monitor is stopped when the clock, if it is a reactor,
+        shuts down.
+        """
+        triggers = []
+        self.clock.addSystemEventTrigger = lambda *args: triggers.append(args)
+        self.controller.maxLag = 1
+        self.controller.admit("plain", plain)
+        self.controller.admit("plain", plain)
+        self.assertEquals(triggers,
+                          [("before", "shutdown", self.controller.stop)])
+
+    def test_noLagMonitor(self):
+        self.controller.admit("plain", plain)
+        self.assertFalse(self.controller.monitor.running)
+
+
+class CallAdmittedTestCase(TestCase):
+    """
+    Tests for L{BaseSubhandler._callAdmitted}, which the servers make their
+    calls with.
+    """
+    def setUp(self):
+        self.handler = BaseSubhandler()
+        self.handler.admission = AdmissionController(maxInFlight=1)
+        self.addCleanup(self.handler.admission.stop)
+
+    def call(self, call):
+        return self.handler._callAdmitted("plain", plain, None, call)
+
+    def test_released(self):
+        d = defer.Deferred()
+        self.assertIdentical(self.call(lambda: d), d)
+        self.assertEquals(self.handler.admission.inFlight, 1)
+        self.assertRaises(ServerBusy, self.call, lambda: defer.succeed(1))
+        d.callback("result")
+        self.assertEquals(self.successResultOf(d), "result")
+        self.assertEquals(self.handler.admission.inFlight, 0)
+
+    def test_releasedOnRaise(self):
+        def call():
+            raise ValueError()
+        self.assertRaises(ValueError, self.call, call)
+        self.assertEquals(self.handler.admission.inFlight, 0)
@@ -0,0 +1,188 @@
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+
+from txjsonrpc.breaker import (
+    CLOSED, HALF_OPEN, OPEN, CallRejected, CircuitBreaker, CircuitOpen,
+    ConcurrencyLimitExceeded, ConcurrencyLimiter)
+from txjsonrpc.jsonrpclib import SERVER_BUSY, Fault
+from txjsonrpc.test.test_jsonrpc import FakeProxy
+
+
+def fail(exception):
+    try:
+        raise exception
+    except:
+        return failure.Failure()
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.breaker = CircuitBreaker(window=4, minCalls=4, resetTimeout=10,
+                                      clock=self.clock)
+
+    def call(self, result, duration=0):
+        started = self.breaker.start()
+        self.clock.advance(duration)
+        return self.breaker.finish(result, started)
+
+    def test_opens(self):
+        """
+        The breaker opens when enough of the recent calls failed, and then
+        refuses calls.
+        """
+        for result in ["ok", fail(ValueError()), "ok"]:
+            self.call(result)
+        self.assertEquals(self.breaker.state, CLOSED)
+        self.call(fail(ValueError()))
+        self.assertEquals(self.breaker.state, OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.start)
+        self.assertEquals(self.breaker.stats()["rejected"], 1)
+        self.assertEquals(self.breaker.opened, 1)
+
+    def test_faults(self):
+        """
+        Faults are answers from the server, and cancelled calls aren't
+        answers at all, so neither counts as a failure.
+        """
+        for i in range(4):
+            self.call(fail(Fault(1, "failed")))
+            self.call(fail(defer.CancelledError()))
+        self.assertEquals(self.breaker.state, CLOSED)
+        self.assertEquals(self.breaker.stats()["failures"], 0)
+
+    def test_serverBusy(self):
+        """
+        A server refusing calls because it's too busy is failing them.
+        """
+        for i in range(4):
+            self.call(fail(Fault(SERVER_BUSY, "Server busy")))
+        self.assertEquals(self.breaker.state, OPEN)
+
+    def test_slowCalls(self):
+        self.breaker.slowCallTime = 1
+        self.breaker.slowCallRate = 0.75
+        for duration in [2, 0.5, 2, 2]:
+            self.call("ok", duration)
+        self.assertEquals(self.breaker.state, OPEN)
+
+    def test_halfOpen(self):
+        for i in range(4):
+            self.call(fail(ValueError()))
+        self.clock.advance(10)
+        started = self.breaker.start()
+        self.assertEquals(self.breaker.state, HALF_OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.start)
+        self.breaker.finish("ok", started)
+        self.assertEquals(self.breaker.state, CLOSED)
+        self.assertEquals(self.breaker.stats()["calls"], 0)
+
+    def test_halfOpenFails(self):
+        for i in range(4):
+            self.call(fail(ValueError()))
+        self.clock.advance(10)
+        self.call(fail(ValueError()))
+        self.assertEquals(self.breaker.state, OPEN)
+        self.assertRaises(CircuitOpen, self.breaker.start)
+        self.assertEquals(self.breaker.opened, 2)
+
+    def test_halfOpenCancelled(self):
+        """
+        A trial call which doesn't get an answer makes room for another.
+        """
+        for i in range(4):
+            self.call(fail(ValueError()))
+        self.clock.advance(10)
+        self.call(fail(defer.CancelledError()))
+        self.assertEquals(self.breaker.state, HALF_OPEN)
+        self.call("ok")
+        self.assertEquals(self.breaker.state, CLOSED)
+
+
+class ConcurrencyLimiterTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = ConcurrencyLimiter(initialLimit=4, minLimit=2,
+                                          maxLimit=6, backoff=0.5,
+                                          clock=self.clock)
+
+    def test_limit(self):
+        started = [self.limiter.start() for i in range(4)]
+        self.assertRaises(ConcurrencyLimitExceeded, self.limiter.start)
+        self.assertEquals(self.limiter.stats(),
+                          {"limit": 4, "inFlight": 4, "rejected": 1})
+        self.limiter.finish(fail(defer.CancelledError()), started[0])
+        self.assertEquals(self.limiter.stats(),
+                          {"limit": 4, "inFlight": 3, "rejected": 1})
+
+    def test_increase(self):
+        """
+        Calls which succeed while at least half of the limit is in use
+        raise it, up to maxLimit.
+        """
+        started = self.limiter.start()
+        self.limiter.finish("ok", started)
+        self.assertEquals(self.limiter.limit, 4)
+        for i in range(3):
+            started = [self.limiter.start() for j in range(3)]
+            self.limiter.finish(fail(Fault(1, "failed")), started[0])
+            for time in started[1:]:
+                self.limiter.finish("ok", time)
+        self.assertEquals(self.limiter.limit, 6)
+
+    def test_decrease(self):
+        for i in range(3):
+            self.limiter.finish(fail(ValueError()), self.limiter.start())
+        self.assertEquals(self.limiter.limit, 2)
+
+    def test_latencyThreshold(self):
+        self.limiter.latencyThreshold = 1
+        started = self.limiter.start()
+        self.clock.advance(2)
+        self.limiter.finish("ok", started)
+        self.assertEquals(self.limiter.limit, 2)
+
+
+class ProxyGuardTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxy = FakeProxy()
+
+    def test_breaker(self):
+        self.proxy.breaker = CircuitBreaker(minCalls=1, clock=self.clock)
+        d = self.proxy.callRemote("echo")
+        self.proxy.calls[0][2].errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.failureResultOf(self.proxy.callRemote("echo"), CircuitOpen)
+        self.assertEquals(len(self.proxy.calls), 1)
+
+    def test_limiter(self):
+        limiter = self.proxy.limiter = ConcurrencyLimiter(
+            initialLimit=1, clock=self.clock)
+        d = self.proxy.callRemote("echo")
+        self.failureResultOf(self.proxy.callRemote("echo"), CallRejected)
+        self.assertEquals(len(self.proxy.calls), 1)
+        self.proxy.calls[0][2].callback("ok")
+        self.assertEquals(self.successResultOf(d), "ok")
+        self.assertEquals(limiter.stats(),
+                          {"limit": 2, "inFlight": 0, "rejected": 1})
+
+    def test_limiterReleasesTrial(self):
+        """
+        A trial call of a half-open breaker which the limiter refuses lets
+        another call try the server.
+        """
+        breaker = self.proxy.breaker = CircuitBreaker(clock=self.clock)
+        breaker.state = HALF_OPEN
+        self.proxy.limiter = ConcurrencyLimiter(initialLimit=0,
+                                                clock=self.clock)
+        self.failureResultOf(self.proxy.callRemote("echo"),
+                             ConcurrencyLimitExceeded)
+        self.assertEquals(breaker.state, HALF_OPEN)
+        self.proxy.limiter = None
+        self.proxy.callRemote("echo")
+        self.assertEquals(len(self.proxy.calls), 1)
@@ -0,0 +1,289 @@
+import copy
+from StringIO import StringIO
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web.client import FileBodyProducer
+
+from txjsonrpc.cache import (
+    ResultCache, cached, coalesced, getCache, getInFlightCalls)
+from txjsonrpc.jsonrpc import BaseSubhandler, callFunction
+from txjsonrpc.jsonrpclib import Fault, RawJSON
+
+
+class Database(BaseSubhandler):
+
+    def __init__(self, name):
+        BaseSubhandler.__init__(self)
+        self.name = name
+        self.waiting = []
+
+    @cached()
+    def jsonrpc_get(self, key):
+        return "%s:%s" % (self.name, key)
+
+    @coalesced
+    def jsonrpc_slowGet(self, key):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d.addCallback(lambda ign: self.jsonrpc_get(key))
+
+
+class ResultCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = ResultCache(ttl=10, maxsize=3, clock=self.clock)
+
+    def test_decorator(self):
+
+        @cached(ttl=5, maxsize=10, maxBytes=100)
+        def f():
+            pass
+        cache = getCache(f)
+        self.assertEquals((cache.ttl, cache.maxsize, cache.maxBytes),
+                          (5, 10, 100))
+        self.assertIdentical(getCache(f), cache)
+        self.assertIdentical(getCache(lambda: None), None)
+
+    def test_makeKey(self):
+        self.assertEquals(self.cache.makeKey([1, "a"], {"b": 2, "a": 1}),
+                          self.cache.makeKey([1, "a"], {"a": 1, "b": 2}))
+        self.assertNotEquals(self.cache.makeKey([1], {}),
+                             self.cache.makeKey(["1"], {}))
+        self.assertEquals(self.cache.makeKey([object()], {}), None)
+
+    def test_ttl(self):
+        self.cache.put("k", "1")
+        self.clock.advance(9)
+        self.assertEquals(self.cache.get("k"), "1")
+        self.clock.advance(1)
+        self.assertEquals(self.cache.get("k"), None)
+        self.assertEquals((len(self.cache), self.cache.size), (0, 0))
+
+    def test_lru(self):
+        for key in "abc":
+            self.cache.put(key, "1")
+        self.cache.get("a")
+        self.cache.put("d", "1")
+        self.assertEquals(self.cache.get("b"), None)
+        self.assertEquals([self.cache.get(key) for key in "acd"],
+                          ["1", "1", "1"])
+        self.assertEquals(self.cache.evictions, 1)
+
+    def test_maxBytes(self):
+        cache = ResultCache(maxsize=None, maxBytes=10)
+        cache.put("a", "1234")
+        cache.put("b", "1234")
+        self.assertEquals(cache.size, 10)
+        cache.put("c", "12")
+        self.assertEquals(cache.get("a"), None)
+        self.assertEquals(cache.size, 8)
+        cache.put("d", "1234567890")
+        self.assertEquals(cache.get("d"), None)
+        self.assertEquals(cache.size, 8)
+
+    def test_invalidate(self):
+        self.cache.put(self.cache.makeKey([1], {"a": 2}), "1")
+        self.cache.invalidate(1, a=2)
+        self.assertEquals((len(self.cache), self.cache.size), (0, 0))
+
+    def test_clear(self):
+        self.cache.put("a", "1")
+        self.cache.clear()
+        self.assertEquals((len(self.cache), self.cache.size), (0, 0))
+
+    def test_call(self):
+        calls = []
+
+        @cached()
+        def f(x):
+            calls.append(x)
+            return [x]
+        first = self.successResultOf(callFunction(f, 1))
+        second = self.successResultOf(callFunction(f, 1))
+        self.assertIsInstance(first, RawJSON)
+        self.assertEquals((first.encoded, second.encoded), ("[1]", "[1]"))
+        self.assertEquals(calls, [1])
+        self.assertEquals(getCache(f).stats(), {
+            "hits": 1, "misses": 1, "evictions": 0, "entries": 1,
+            "bytes": len("[[1],{}]") + 3})
+
+    def test_failuresNotCached(self):
+
+        @cached()
+        def f():
+            return defer.fail(ValueError())
+
+        @cached()
+        def g():
+            return Fault(1, "fault")
+        self.failureResultOf(callFunction(f), ValueError)
+        self.assertIsInstance(self.successResultOf(callFunction(g)), Fault)
+        self.assertEquals((len(getCache(f)), len(getCache(g))), (0, 0))
+
+    def test_unencodable(self):
+
+        @cached()
+        def f(x):
+            return object()
+        result = self.successResultOf(callFunction(f, 1))
+        self.assertNotIsInstance(result, RawJSON)
+        self.successResultOf(callFunction(f, object()))
+        self.assertEquals(len(getCache(f)), 0)
+
+    def test_perHandler(self):
+        """
+        Handlers of the same class have caches of their own, which copies
+        of them share.
+        """
+        root = BaseSubhandler()
+        root.putSubHandler("db1", Database("one"))
+        root.putSubHandler("db2", Database("two"))
+        results = [self.successResultOf(callFunction(
+            root._getFunction(path), "x")).encoded
+            for path in ["db1.get", "db2.get"]]
+        self.assertEquals(results, ['"one:x"', '"two:x"'])
+        handler = root.getSubHandler("db1")
+        self.assertIdentical(getCache(copy.copy(handler).jsonrpc_get),
+                             getCache(handler.jsonrpc_get))
+
+
+class InFlightCallsTestCase(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        @coalesced
+        def f(x):
+            d = defer.Deferred(lambda d: self.calls.remove((x, d)))
+            self.calls.append((x, d))
+            return d
+        self.f = f
+
+    def test_shared(self):
+        first = callFunction(self.f, 1)
+        second = callFunction(self.f, 1)
+        other = callFunction(self.f, 2)
+        self.assertEquals(len(self.calls), 2)
+        self.assertEquals(getInFlightCalls(self.f).coalesced, 1)
+        self.calls[0][1].callback("one")
+        self.calls[1][1].callback("two")
+        self.assertEquals(
+            [self.successResultOf(d) for d in (first, second, other)],
+            ["one", "one", "two"])
+        self.assertEquals(len(getInFlightCalls(self.f)), 0)
+
+    def test_notShared(self):
+        """
+        A call made after an identical one has finished is made again.
+        """
+        callFunction(self.f, 1)
+        self.calls[0][1].callback("one")
+        callFunction(self.f, 1)
+        self.assertEquals(len(self.calls), 2)
+
+    def test_failure(self):
+        first = callFunction(self.f, 1)
+        second = callFunction(self.f, 1)
+        self.calls[0][1].errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+
+    def test_cancel(self):
+        """
+        The call is only cancelled once every caller has cancelled.
+        """
+        first = callFunction(self.f, 1)
+        second = callFunction(self.f, 1)
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.assertEquals(len(self.calls), 1)
+        second.cancel()
+        self.failureResultOf(second, defer.CancelledError)
+        self.assertEquals(self.calls, [])
+        self.assertEquals(len(getInFlightCalls(self.f)), 0)
+
+    def test_iterator(self):
+        """
+        Callers sharing an iterator result each get all of it, as a list.
+        """
+        first = callFunction(self.f, 1)
+        second = callFunction(self.f, 1)
+        self.calls[0][1].callback(iter(range(3)))
+        self.assertEquals(
+            [self.successResultOf(d) for d in (first, second)],
+            [[0, 1, 2], [0, 1, 2]])
+
+    def test_iteratorOneCaller(self):
+        """
+        An iterator result is left as it is when only one caller wants it,
+        so that it can be streamed.
+        """
+        d = callFunction(self.f, 1)
+        rows = iter(range(3))
+        self.calls[0][1].callback(rows)
+        self.assertIdentical(self.successResultOf(d), rows)
+
+    def test_producer(self):
+        """
+        A body producer result goes to the first caller, and the call is
+        made again for each of the others.
+        """
+        first = callFunction(self.f, 1)
+        second = callFunction(self.f, 1)
+        producer = FileBodyProducer(StringIO("one"))
+        self.calls[0][1].callback(producer)
+        self.assertIdentical(self.successResultOf(first), producer)
+        self.assertEquals(len(self.calls), 2)
+        self.calls[1][1].callback("again")
+        self.assertEquals(self.successResultOf(second), "again")
+
+    def test_producerCancel(self):
+        """
+        Cancelling a caller whose call is made again cancels that call.
+        """
+        callFunction(self.f, 1)
+        second = callFunction(self.f, 1)
+        self.calls[0][1].callback(FileBodyProducer(StringIO("one")))
+        self.assertEquals(len(self.calls), 2)
+        second.cancel()
+        self.failureResultOf(second, defer.CancelledError)
+        self.assertEquals(len(self.calls), 1)
+
+    def test_perHandler(self):
+        """
+        Identical calls of the same method of two handlers aren't shared.
+        """
+        one, two = Database("one"), Database("two")
+        first = callFunction(one.jsonrpc_slowGet, "x")
+        second = callFunction(two.jsonrpc_slowGet, "x")
+        self.assertEquals((len(one.waiting), len(two.waiting)), (1, 1))
+        one.waiting[0].callback(None)
+        two.waiting[0].callback(None)
+        self.assertEquals(
+            [self.successResultOf(d) for d in (first, second)],
+            ["one:x", "two:x"])
+
+    def test_synchronous(self):
+
+        @coalesced
+        def g(x):
+            return x
+        self.assertEquals(self.successResultOf(callFunction(g, 1)), 1)
+        self.assertEquals(len(getInFlightCalls(g)), 0)
+
+    def test_cached(self):
+        """
+        Identical calls waiting for the same result are both answered from
+        the cache afterwards.
+        """
+        f = cached()(self.f)
+        first = callFunction(f, 1)
+        second = callFunction(f, 1)
+        self.calls[0][1].callback([1])
+        for d in (first, second):
+            self.assertEquals(self.successResultOf(d).encoded, "[1]")
+        self.assertEquals(
+            self.successResultOf(callFunction(f, 1)).encoded, "[1]")
+        self.assertEquals(len(self.calls), 1)
@@ -0,0 +1,418 @@
+import random
+
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+
+from txjsonrpc.breaker import CircuitOpen
+from txjsonrpc.cluster import (
+    ClusterProxy, ConsistentHash, Endpoint, Hedging, LeastOutstanding,
+    PowerOfTwoChoices, RoundRobin)
+from txjsonrpc.jsonrpclib import SERVER_BUSY, Fault
+
+
+class FakeProxy(object):
+
+    def __init__(self, host, port=80):
+        self.host = host
+        self.port = port
+        self.calls = []
+        self.notifications = []
+
+    def callRemote(self, method, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((method, args, kwargs, d))
+        return d
+
+    def notify(self, method, *args, **kwargs):
+        self.notifications.append((method, args))
+        return defer.succeed(None)
+
+    def answer(self, result=None):
+        method, args, kwargs, d = self.calls.pop(0)
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+
+class PolicyTestCase(TestCase):
+
+    def setUp(self):
+        self.endpoints = [Endpoint(FakeProxy("h%d" % i)) for i in range(4)]
+
+    def choose(self, policy, args=()):
+        return policy.choose(self.endpoints, "m", args)
+
+    def test_name(self):
+        self.assertEquals(self.endpoints[0].name, "h0:80")
+        proxy = FakeProxy("host", 7080)
+        proxy.path = "/rpc"
+        self.assertEquals(Endpoint(proxy).name, "host:7080/rpc")
+        self.assertEquals(Endpoint(proxy, "other").name, "other")
+
+    def test_roundRobin(self):
+        policy = RoundRobin()
+        self.assertEquals([self.choose(policy) for i in range(6)],
+                          self.endpoints + self.endpoints[:2])
+
+    def test_leastOutstanding(self):
+        policy = LeastOutstanding()
+        for endpoint, outstanding in zip(self.endpoints, [3, 1, 2, 1]):
+            endpoint.outstanding = outstanding
+        self.assertEquals(
+            [self.choose(policy) for i in range(4)],
+            [self.endpoints[1], self.endpoints[1], self.endpoints[3],
+             self.endpoints[3]])
+
+    def test_powerOfTwoChoices(self):
+        policy = PowerOfTwoChoices(random.Random(1))
+        self.endpoints[0].outstanding = 100
+        chosen = set([self.choose(policy) for i in range(100)])
+        self.assertNotIn(self.endpoints[0], chosen)
+        self.assertEquals(len(chosen), 3)
+        self.assertIdentical(
+            policy.choose(self.endpoints[:1], "m", ()), self.endpoints[0])
+
+    def test_consistentHash(self):
+        policy = ConsistentHash()
+        keys = ["key-%d" % i for i in range(200)]
+        before = dict((key, self.choose(policy, (key, "other")))
+                      for key in keys)
+        self.assertEquals(len(set(before.values())), 4)
+        self.assertIdentical(self.choose(policy, ("key-1", "different")),
+                             before["key-1"])
+        removed = self.endpoints.pop(2)
+        for key in keys:
+            if before[key] is not removed:
+                self.assertIdentical(self.choose(policy, (key,)), before[key])
+
+    def test_consistentHashOneRing(self):
+        """
+        Leaving servers out doesn't build the ring again.
+        """
+        policy = ConsistentHash()
+        self.choose(policy, ("key",))
+        ring = policy._ring
+        for i in range(len(self.endpoints)):
+            others = self.endpoints[:i] + self.endpoints[i + 1:]
+            self.assertIn(policy.choose(others, "m", ("key",)), others)
+        self.assertIdentical(policy._ring, ring)
+
+    def test_consistentHashArgument(self):
+        policy = ConsistentHash(argument=1)
+        self.assertIdentical(self.choose(policy, ("a", {"x": 1})),
+                             self.choose(policy, ("b", {"x": 1})))
+        self.assertIdentical(self.choose(policy, ()),
+                             self.choose(policy, ()))
+
+
+class ClusterProxyTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxies = [FakeProxy("h%d" % i) for i in range(3)]
+        self.cluster = ClusterProxy(self.proxies, clock=self.clock)
+        self.cluster.maxFailures = 2
+        self.cluster.ejectTime = 10
+
+    def answer(self, result):
+        """
+        Answer the only call waiting for an answer.
+        """
+        [proxy] = [proxy for proxy in self.proxies if proxy.calls]
+        proxy.answer(result)
+
+    def test_noEndpoints(self):
+        self.assertRaises(ValueError, ClusterProxy, [])
+
+    def test_spread(self):
+        dl = [self.cluster.callRemote("echo", i, timeout=5) for i in range(3)]
+        self.assertEquals([proxy.calls[0][:3] for proxy in self.proxies],
+                          [("echo", (i,), {"timeout": 5}) for i in range(3)])
+        self.assertEquals(
+            [endpoint.outstanding for endpoint in self.cluster.endpoints],
+            [1, 1, 1])
+        for i, proxy in enumerate(self.proxies):
+            proxy.answer(i)
+        self.assertEquals([self.successResultOf(d) for d in dl], [0, 1, 2])
+        self.assertEquals(
+            [endpoint.outstanding for endpoint in self.cluster.endpoints],
+            [0, 0, 0])
+
+    def test_fault(self):
+        """
+        A Fault is passed on, and doesn't count against the server.
+        """
+        d = self.cluster.callRemote("echo")
+        self.proxies[0].answer(Fault(1, "failed"))
+        self.failureResultOf(d, Fault)
+        self.assertEquals(self.cluster.endpoints[0].failures, 0)
+
+    def test_failureNotRetried(self):
+        d = self.cluster.callRemote("echo")
+        self.proxies[0].answer(defer.TimeoutError())
+        self.failureResultOf(d, defer.TimeoutError)
+        self.assertEquals(self.cluster.endpoints[0].failures, 1)
+        self.assertEquals(self.proxies[1].calls, [])
+
+    def test_failover(self):
+        """
+        A call whose connection couldn't be made is sent to another server.
+        """
+        d = self.cluster.callRemote("echo", 1)
+        self.proxies[0].answer(error.ConnectionRefusedError())
+        self.assertEquals(
+            [proxy.calls[0][:2] for proxy in self.proxies if proxy.calls],
+            [("echo", (1,))])
+        self.answer(error.ConnectionRefusedError())
+        self.answer("result")
+        self.assertEquals(self.successResultOf(d), "result")
+        self.assertEquals(
+            sorted([endpoint.failures
+                    for endpoint in self.cluster.endpoints]),
+            [0, 1, 1])
+
+    def test_failoverRejected(self):
+        """
+        A call refused by the proxy of its server, without being sent, is
+        sent to another server, and doesn't count against the first.
+        """
+        def reject(method, *args, **kwargs):
+            return defer.fail(CircuitOpen())
+        self.proxies[0].callRemote = reject
+        d = self.cluster.callRemote("echo")
+        self.answer("result")
+        self.assertEquals(self.successResultOf(d), "result")
+        self.assertEquals(self.cluster.endpoints[0].failures, 0)
+
+    def test_failoverBusy(self):
+        """
+        A call the server refused because it was too busy is sent to
+        another server.
+        """
+        d = self.cluster.callRemote("echo")
+        self.answer(Fault(SERVER_BUSY, "Server busy"))
+        self.assertNoResult(d)
+        self.answer("result")
+        self.assertEquals(self.successResultOf(d), "result")
+
+    def test_failoverExhausted(self):
+        d = self.cluster.callRemote("echo")
+        for proxy in self.proxies:
+            self.answer(error.ConnectionRefusedError())
+        self.failureResultOf(d, error.ConnectionRefusedError)
+
+    def test_eject(self):
+        """
+        A server failing maxFailures calls in a row is left out for
+        ejectTime seconds, and then left out again if it fails once more.
+        """
+        endpoint = self.cluster.endpoints[0]
+        for i in range(2):
+            self.cluster._choose = lambda method, args, exclude=(): endpoint
+            d = self.cluster.callRemote("echo")
+            self.proxies[0].answer(ValueError())
+            self.failureResultOf(d, ValueError)
+        del self.cluster._choose
+        self.assertEquals(endpoint.ejectedUntil, 10)
+        for i in range(4):
+            self.cluster.callRemote("echo")
+        self.assertEquals([len(proxy.calls) for proxy in self.proxies],
+                          [0, 2, 2])
+        self.clock.advance(10)
+        dl = [self.cluster.callRemote("echo") for i in range(3)]
+        self.assertEquals(len(self.proxies[0].calls), 1)
+        self.assertEquals(endpoint.ejectedUntil, None)
+        self.proxies[0].answer(ValueError())
+        self.assertEquals(endpoint.ejectedUntil, 20)
+        failed = [call for call in dl if call.called]
+        self.assertEquals(len(failed), 1)
+        self.failureResultOf(failed[0], ValueError)
+
+    def test_readmittedSuccess(self):
+        endpoint = self.cluster.endpoints[0]
+        endpoint.ejectedUntil = 5
+        self.clock.advance(5)
+        d = self.cluster.callRemote("echo")
+        self.proxies[0].answer("ok")
+        self.successResultOf(d)
+        self.assertEquals(endpoint.failures, 0)
+
+    def test_allEjected(self):
+        """
+        If every server is left out, they are all used anyway.
+        """
+        for endpoint in self.cluster.endpoints:
+            endpoint.ejectedUntil = 10
+        self.cluster.callRemote("echo")
+        self.assertEquals(len(self.proxies[0].calls), 1)
+
+    def test_cancel(self):
+        d = self.cluster.callRemote("echo")
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEquals(self.cluster.endpoints[0].failures, 0)
+        self.assertEquals(self.cluster.endpoints[0].outstanding, 0)
+
+    def test_notify(self):
+        d = self.cluster.notify("log", "message")
+        self.successResultOf(d)
+        self.assertEquals(self.proxies[0].notifications, [("log",
+                                                           ("message",))])
+
+    def test_coalesced(self):
+        self.cluster.coalesce = True
+        first = self.cluster.callRemote("echo", 1)
+        second = self.cluster.callRemote("echo", 1)
+        self.assertEquals([len(proxy.calls) for proxy in self.proxies],
+                          [1, 0, 0])
+        self.proxies[0].answer("result")
+        self.assertEquals(self.successResultOf(first), "result")
+        self.assertEquals(self.successResultOf(second), "result")
+
+
+class HedgingTestCase(TestCase):
+
+    def test_delay(self):
+        hedging = Hedging(percentile=90, minSamples=10)
+        for i in range(9):
+            hedging.record(i)
+        self.assertEquals(hedging.delay(), None)
+        hedging.record(9)
+        self.assertEquals(hedging.delay(), 9)
+        hedging.percentile = 50
+        self.assertEquals(hedging.delay(), 5)
+        self.assertEquals(hedging.calls, 3)
+
+    def test_window(self):
+        hedging = Hedging(percentile=100, window=5, minSamples=1)
+        for i in range(10):
+            hedging.record(10 - i)
+        self.assertEquals(hedging.delay(), 5)
+
+    def test_percentileOfWindow(self):
+        """
+        The delay is the percentile of the latencies in the window, however
+        many have been recorded.
+        """
+        hedging = Hedging(percentile=90, window=50, minSamples=1)
+        rand = random.Random(2)
+        for i in range(500):
+            hedging.record(rand.choice([rand.random(), 0.5]))
+            latencies = sorted(hedging.latencies)
+            self.assertEquals(
+                hedging.delay(),
+                latencies[min(len(latencies) * 9 // 10, len(latencies) - 1)])
+
+    def test_budget(self):
+        """
+        No more than budget hedged calls are allowed for each call made.
+        """
+        hedging = Hedging(budget=0.25)
+        allowed = 0
+        for i in range(100):
+            hedging.delay()
+            if hedging.allow():
+                allowed += 1
+        self.assertEquals(allowed, 25)
+        self.assertEquals(hedging.hedged, 25)
+
+    def test_maxTokens(self):
+        hedging = Hedging(budget=1, maxTokens=2)
+        for i in range(10):
+            hedging.delay()
+        self.assertEquals([hedging.allow() for i in range(3)],
+                          [True, True, False])
+
+
+class ClusterHedgingTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxies = [FakeProxy("h%d" % i) for i in range(2)]
+        self.cluster = ClusterProxy(self.proxies, clock=self.clock)
+        self.hedging = self.cluster.hedgeCalls(
+            "lookup", percentile=50, budget=1, minSamples=1)
+        self.hedging.record(1)
+
+    def test_hedged(self):
+        """
+        A call which hasn't been answered in time is sent to another server
+        too. The first answer is used and the other call cancelled.
+        """
+        d = self.cluster.callRemote("lookup", 1)
+        self.assertEquals(len(self.proxies[1].calls), 0)
+        self.clock.advance(1)
+        self.assertEquals(self.proxies[1].calls[0][:2], ("lookup", (1,)))
+        self.proxies[1].answer("second")
+        self.assertEquals(self.successResultOf(d), "second")
+        self.assertTrue(self.proxies[0].calls[0][3].called)
+        self.assertEquals(
+            [endpoint.outstanding for endpoint in self.cluster.endpoints],
+            [0, 0])
+        self.assertEquals(self.cluster.endpoints[0].failures, 0)
+        self.assertEquals(list(self.hedging.latencies), [1, 0])
+        self.assertEquals(self.hedging.hedged, 1)
+
+    def test_answeredInTime(self):
+        d = self.cluster.callRemote("lookup", 1)
+        self.clock.advance(0.5)
+        self.proxies[0].answer("first")
+        self.assertEquals(self.successResultOf(d), "first")
+        self.clock.advance(1)
+        self.assertEquals(self.proxies[1].calls, [])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def test_notHedged(self):
+        self.cluster.callRemote("other")
+        self.clock.advance(10)
+        self.assertEquals(len(self.proxies[1].calls), 0)
+
+    def test_percentileOfWindow(self):
+        """
+        The delay is the percentile of the latencies in the window, however
+        many have been recorded.
+        """
+        hedging = Hedging(percentile=90, window=50, minSamples=1)
+        rand = random.Random(2)
+        for i in range(500):
+            hedging.record(rand.choice([rand.random(), 0.5]))
+            latencies = sorted(hedging.latencies)
+            self.assertEquals(
+                hedging.delay(),
+                latencies[min(len(latencies) * 9 // 10, len(latencies) - 1)])
+
+    def test_budget(self):
+        self.hedging.budget = 0.5
+        self.cluster.callRemote("lookup", 1)
+        self.clock.advance(1)
+        self.assertEquals(len(self.proxies[1].calls), 0)
+        self.cluster.callRemote("lookup", 2)
+        self.clock.advance(1)
+        self.assertEquals(len(self.proxies[0].calls) +
+                          len(self.proxies[1].calls), 3)
+
+    def test_firstFailureWaits(self):
+        """
+        When one of the copies fails, the other one's answer is waited for.
+        """
+        d = self.cluster.callRemote("lookup", 1)
+        self.clock.advance(1)
+        self.proxies[0].answer(defer.TimeoutError())
+        self.assertNoResult(d)
+        self.proxies[1].answer("second")
+        self.assertEquals(self.successResultOf(d), "second")
+
+    def test_cancel(self):
+        d = self.cluster.callRemote("lookup", 1)
+        self.clock.advance(1)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        for proxy in self.proxies:
+            self.assertTrue(proxy.calls[0][3].called)
+
+    def test_cancelBeforeHedge(self):
+        d = self.cluster.callRemote("lookup", 1)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
@@ -1,7 +1,15 @@
+import copy
+
+from twisted.internet import defer, task
 from twisted.trial.unittest import TestCase
 
-from txjsonrpc.jsonrpc import BaseProxy, BaseQueryFactory
-from txjsonrpc.jsonrpclib import Fault, VERSION_PRE1, VERSION_1, VERSION_2
+from txjsonrpc.jsonrpc import (
+    BaseBatchQueryFactory, BaseProxy, BaseQueryFactory, BaseSubhandler,
+    CounterIdGenerator, PrefixedIdGenerator, RandomIdGenerator, addTimeout,
+    getTimeout, timeout)
+from txjsonrpc.jsonrpclib import (
+    Fault, NoSuchFunction, METHOD_NOT_CALLABLE, METHOD_NOT_FOUND,
+    REQUEST_TIMEOUT, VERSION_PRE1, VERSION_1, VERSION_2)
 
 
 class BaseQueryFactoryTestCase(TestCase):
@@ -31,6 +39,20 @@ class BaseQueryFactoryTestCase(TestCase):
             payload,
             '{"params": [], "jsonrpc": "2.0", "method": "", "id": 1}')
 
+    def test_buildVersionedPayloadWithId(self):
+        factory = BaseQueryFactory("someMethod", VERSION_2, id="abc")
+        self.assertEquals(
+            factory.payload,
+            '{"params": [], "jsonrpc": "2.0", "method": "someMethod", '
+            '"id": "abc"}')
+
+    def test_payloadUsesAssignedId(self):
+        factory = BaseQueryFactory("someMethod", VERSION_1)
+        factory.id = 7
+        self.assertEquals(
+            factory.payload,
+            '{"params": [], "method": "someMethod", "id": 7}')
+
     def test_parseResponseNoJSON(self):
 
         def check_error(error):
@@ -67,6 +89,47 @@ class BaseQueryFactoryTestCase(TestCase):
         return d.addErrback(check_error)
 
 
+class BaseBatchQueryFactoryTestCase(TestCase):
+
+    def setUp(self):
+        self.queries = [BaseQueryFactory("m%d" % i, VERSION_2, id=i)
+                        for i in range(3)]
+        self.factory = BaseBatchQueryFactory(self.queries)
+
+    def test_payload(self):
+        self.assertEquals(
+            self.factory.payload,
+            "[%s]" % ", ".join([query.payload for query in self.queries]))
+
+    def test_parseResponse(self):
+        results = [query.deferred for query in self.queries]
+        self.factory.parseResponse(
+            '[{"jsonrpc": "2.0", "result": "c", "id": 2}, '
+            '{"jsonrpc": "2.0", "result": "a", "id": 0}, '
+            '{"jsonrpc": "2.0", "error": {"code": 1, "message": "Fault", '
+            '"data": "oops"}, "id": 1}]')
+        d = defer.gatherResults([results[0], results[2]])
+        d.addCallback(self.assertEquals, ["a", "c"])
+        return self.assertFailure(results[1], Fault).addCallback(
+            lambda ign: d)
+
+    def test_parseResponseMissing(self):
+        results = [query.deferred for query in self.queries]
+        self.factory.parseResponse(
+            '[{"jsonrpc": "2.0", "result": "a", "id": 0}]')
+        return defer.gatherResults([
+            self.assertFailure(results[1], ValueError),
+            self.assertFailure(results[2], ValueError)])
+
+    def test_parseResponseRefused(self):
+        results = [query.deferred for query in self.queries]
+        self.factory.parseResponse(
+            '{"jsonrpc": "2.0", "error": {"code": -32600, '
+            '"message": "Fault", "data": "empty batch"}, "id": null}')
+        return defer.gatherResults(
+            [self.assertFailure(d, Fault) for d in results])
+
+
 class BaseProxyTestCase(TestCase):
 
     def test_creation(self):
@@ -102,3 +165,303 @@ class BaseProxyTestCase(TestCase):
         proxy = BaseProxy()
         factoryClass = proxy._getFactoryClass({"factoryClass": FakeFactory})
         self.assertEquals(factoryClass, FakeFactory)
+
+    def test_buildFactoryIds(self):
+        proxy = BaseProxy(VERSION_2, BaseQueryFactory)
+        ids = [proxy._buildFactory(BaseQueryFactory, "someMethod").id
+               for i in range(3)]
+        self.assertEquals(ids, [1, 2, 3])
+
+    def test_buildFactoryIdGenerator(self):
+        proxy = BaseProxy(idGenerator=PrefixedIdGenerator("p-"))
+        factory = proxy._buildFactory(BaseQueryFactory, "someMethod")
+        self.assertEquals(factory.id, "p-1")
+
+
+class FakeProxy(BaseProxy):
+
+    def __init__(self, *args, **kwargs):
+        BaseProxy.__init__(self, *args, **kwargs)
+        self.calls = []
+
+    def _callRemote(self, method, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((method, args, d))
+        return d
+
+
+class ProxySharingTestCase(TestCase):
+
+    def setUp(self):
+        self.proxy = FakeProxy()
+
+    def test_notCoalesced(self):
+        self.proxy.callRemote("echo", 1)
+        self.proxy.callRemote("echo", 1)
+        self.assertEquals(len(self.proxy.calls), 2)
+
+    def test_coalesced(self):
+        """
+        Identical calls made while one is waiting for its result share it.
+        """
+        self.proxy.coalesce = True
+        first = self.proxy.callRemote("echo", 1)
+        second = self.proxy.callRemote("echo", 1)
+        other = self.proxy.callRemote("echo", 2)
+        otherMethod = self.proxy.callRemote("other", 1)
+        self.assertEquals(
+            [(method, args) for method, args, d in self.proxy.calls],
+            [("echo", (1,)), ("echo", (2,)), ("other", (1,))])
+        for i, (method, args, d) in enumerate(self.proxy.calls):
+            d.callback(i)
+        self.assertEquals(
+            [self.successResultOf(d)
+             for d in (first, second, other, otherMethod)],
+            [0, 0, 1, 2])
+        self.proxy.callRemote("echo", 1)
+        self.assertEquals(len(self.proxy.calls), 4)
+
+    def test_coalescedCancel(self):
+        self.proxy.coalesce = True
+        first = self.proxy.callRemote("echo", 1)
+        second = self.proxy.callRemote("echo", 1)
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.assertFalse(self.proxy.calls[0][2].called)
+        second.cancel()
+        self.failureResultOf(second, defer.CancelledError)
+        self.assertTrue(self.proxy.calls[0][2].called)
+
+    def test_cached(self):
+        clock = task.Clock()
+        resultCache = self.proxy.cacheResults("lookup", ttl=10)
+        resultCache.clock = clock
+        self.assertIdentical(self.proxy.caches["lookup"], resultCache)
+        first = self.proxy.callRemote("lookup", 1)
+        self.proxy.calls[0][2].callback({"a": [1]})
+        self.assertEquals(self.successResultOf(first), {"a": [1]})
+        second = self.proxy.callRemote("lookup", 1)
+        self.assertEquals(self.successResultOf(second), {"a": [1]})
+        self.assertEquals(len(self.proxy.calls), 1)
+        self.assertEquals((resultCache.hits, resultCache.misses), (1, 1))
+        self.proxy.callRemote("lookup", 2)
+        self.proxy.callRemote("echo", 1)
+        self.assertEquals(len(self.proxy.calls), 3)
+        clock.advance(10)
+        self.proxy.callRemote("lookup", 1)
+        self.assertEquals(len(self.proxy.calls), 4)
+
+    def test_cachedCopies(self):
+        """
+        Each call answered from the cache gets a result of its own.
+        """
+        self.proxy.cacheResults("lookup")
+        self.proxy.callRemote("lookup").addCallback(lambda r: r.append(2))
+        self.proxy.calls[0][2].callback([1])
+        self.successResultOf(self.proxy.callRemote("lookup")).append(3)
+        self.assertEquals(
+            self.successResultOf(self.proxy.callRemote("lookup")), [1])
+
+    def test_faultNotCached(self):
+        self.proxy.cacheResults("lookup")
+        d = self.proxy.callRemote("lookup")
+        self.proxy.calls[0][2].errback(Fault(1, "failed"))
+        self.failureResultOf(d, Fault)
+        self.proxy.callRemote("lookup")
+        self.assertEquals(len(self.proxy.calls), 2)
+
+    def test_cachedAndCoalesced(self):
+        self.proxy.coalesce = True
+        resultCache = self.proxy.cacheResults("lookup")
+        first = self.proxy.callRemote("lookup", 1)
+        second = self.proxy.callRemote("lookup", 1)
+        self.proxy.calls[0][2].callback("result")
+        self.assertEquals(self.successResultOf(first), "result")
+        self.assertEquals(self.successResultOf(second), "result")
+        self.successResultOf(self.proxy.callRemote("lookup", 1))
+        self.assertEquals(len(self.proxy.calls), 1)
+        self.assertEquals((resultCache.hits, resultCache.misses), (1, 2))
+
+
+class IdGeneratorTestCase(TestCase):
+
+    def test_counter(self):
+        generator = CounterIdGenerator()
+        self.assertEquals([generator() for i in range(3)], [1, 2, 3])
+
+    def test_counterStart(self):
+        generator = CounterIdGenerator(10)
+        self.assertEquals(generator(), 10)
+
+    def test_prefixed(self):
+        generator = PrefixedIdGenerator("node1-")
+        self.assertEquals([generator(), generator()],
+                          ["node1-1", "node1-2"])
+
+    def test_prefixedDefault(self):
+        first, second = PrefixedIdGenerator(), PrefixedIdGenerator()
+        self.assertNotEquals(first.prefix, second.prefix)
+        self.assertTrue(first().endswith("-1"))
+
+    def test_random(self):
+        generator = RandomIdGenerator()
+        ids = set([generator() for i in range(1000)])
+        self.assertEquals(len(ids), 1000)
+        self.assertEquals(len(ids.pop()), 16)
+
+
+class Leaf(BaseSubhandler):
+
+    jsonrpc_notCallable = 1
+
+    def jsonrpc_echo(self, x):
+        return x
+
+
+class Custom(BaseSubhandler):
+
+    def _getFunction(self, functionPath):
+        return lambda: functionPath
+
+
+class BaseSubhandlerTestCase(TestCase):
+
+    def setUp(self):
+        self.root = Leaf()
+        self.middle = Leaf()
+        self.leaf = Leaf()
+        self.root.putSubHandler("a", self.middle)
+        self.middle.putSubHandler("b", self.leaf)
+
+    def test_getFunction(self):
+        self.assertEquals(self.root._getFunction("echo"),
+                          self.root.jsonrpc_echo)
+
+    def test_getFunctionNested(self):
+        self.assertEquals(self.root._getFunction("a.b.echo"),
+                          self.leaf.jsonrpc_echo)
+
+    def test_dispatchTable(self):
+        table = self.root._getDispatchTable()
+        self.assertEquals(table["a.b.echo"], (self.leaf.jsonrpc_echo, False))
+        self.assertEquals(table["a.echo"], (self.middle.jsonrpc_echo, False))
+        self.assertEquals(table["a.__dir__"][0](), ["echo"])
+        self.assertEquals(table["echo"], (Leaf.jsonrpc_echo.__func__, True))
+        self.assertNotIn("notCallable", table)
+        self.assertIdentical(self.root._getDispatchTable(), table)
+
+    def test_dispatchTableShared(self):
+        """
+        A copy of a handler shares its dispatch table, while its own
+        methods are bound to the copy.
+        """
+        table = self.root._getDispatchTable()
+        root = copy.copy(self.root)
+        self.assertIdentical(root._getDispatchTable(), table)
+        self.assertEquals(root._getFunction("echo"), root.jsonrpc_echo)
+        self.assertEquals(root._getFunction("a.echo"),
+                          self.middle.jsonrpc_echo)
+
+    def test_putSubHandlerInvalidates(self):
+        """
+        Adding a sub-handler anywhere in the tree makes its functions
+        available from the root.
+        """
+        self.root._getFunction("echo")
+        leaf = Leaf()
+        self.leaf.putSubHandler("c", leaf)
+        self.assertEquals(self.root._getFunction("a.b.c.echo"),
+                          leaf.jsonrpc_echo)
+
+    def test_clearDispatchTable(self):
+        self.root._getFunction("echo")
+        self.root.jsonrpc_echo = lambda x: x * 2
+        self.root._clearDispatchTable()
+        self.assertEquals(self.root._getFunction("echo")(2), 4)
+
+    def test_clearSubHandlerDispatchTable(self):
+        """
+        Clearing the dispatch table of a sub-handler also rebuilds the
+        tables of the handlers above it.
+        """
+        self.root._getFunction("a.echo")
+        self.middle.jsonrpc_echo = lambda x: x * 2
+        self.middle._clearDispatchTable()
+        self.assertEquals(self.root._getFunction("a.echo")(2), 4)
+
+    def test_overriddenGetFunction(self):
+        """
+        Sub-handlers which override _getFunction are still asked for their
+        functions.
+        """
+        self.middle.putSubHandler("custom", Custom())
+        self.assertNotIn("a.custom.anything", self.root._getDispatchTable())
+        self.assertEquals(self.root._getFunction("a.custom.anything")(),
+                          "anything")
+
+    def test_notFound(self):
+        for path in ["missing", "a.missing", "z.echo"]:
+            error = self.assertRaises(
+                NoSuchFunction, self.root._getFunction, path)
+            self.assertEquals(error.faultCode, METHOD_NOT_FOUND)
+
+    def test_notCallable(self):
+        error = self.assertRaises(
+            NoSuchFunction, self.root._getFunction, "a.notCallable")
+        self.assertEquals(error.faultCode, METHOD_NOT_CALLABLE)
+
+
+class TimeoutTestCase(TestCase):
+
+    def test_decorator(self):
+
+        @timeout(5)
+        def f():
+            pass
+        self.assertEquals(f.timeout, 5)
+
+    def test_getTimeout(self):
+
+        @timeout(5)
+        def f():
+            pass
+
+        def g():
+            pass
+        self.assertEquals(getTimeout(f), 5)
+        self.assertEquals(getTimeout(f, 10), 5)
+        self.assertEquals(getTimeout(f, 10, 2), 2)
+        self.assertEquals(getTimeout(g), None)
+        self.assertEquals(getTimeout(g, 10), 10)
+        self.assertEquals(getTimeout(g, None, 3), 3)
+
+    def test_addTimeout(self):
+        clock = task.Clock()
+        cancelled = []
+        d = addTimeout(defer.Deferred(cancelled.append), 5, clock)
+        clock.advance(5)
+        self.assertEquals(len(cancelled), 1)
+        error = self.failureResultOf(d, Fault).value
+        self.assertEquals(error.faultCode, REQUEST_TIMEOUT)
+
+    def test_addTimeoutInTime(self):
+        clock = task.Clock()
+        d = addTimeout(defer.Deferred(), 5, clock)
+        d.callback("result")
+        clock.advance(5)
+        self.assertEquals(self.successResultOf(d), "result")
+
+    def test_addTimeoutCancelled(self):
+        """
+        A call cancelled before its timeout fails with a
+        L{defer.CancelledError}, and the timeout is forgotten.
+        """
+        clock = task.Clock()
+        d = addTimeout(defer.Deferred(), 5, clock)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+    def test_addNoTimeout(self):
+        d = defer.Deferred()
+        self.assertIdentical(addTimeout(d, None), d)
@@ -1,7 +1,11 @@
+from datetime import datetime
+
 from twisted.trial.unittest import TestCase
 from twisted.internet import defer
+from txjsonrpc import jsonrpclib
 from txjsonrpc.jsonrpclib import (
-    Fault, VERSION_PRE1, VERSION_1, VERSION_2, dumps, loads)
+    Fault, RawJSON, ServerProxy, StdlibCodec, VERSION_PRE1, VERSION_1, VERSION_2,
+    dumps, getCodec, getparser, loads, registerCodec, setDefaultCodec)
 
 
 class DumpTestCase(TestCase):
@@ -63,6 +67,47 @@ class DumpTestCase(TestCase):
                 '"code": "code", "data": "message"}}'))
 
 
+class RawJSONTestCase(TestCase):
+
+    def test_generator(self):
+        result = dumps((i for i in range(3)), id=1, version=VERSION_2)
+        self.assertEquals(
+            result, '{"jsonrpc": "2.0", "result": [0, 1, 2], "id": 1}')
+
+    def test_version2(self):
+        result = dumps(RawJSON('{"some":"data"}'), id=3, version=VERSION_2)
+        self.assertEquals(
+            result, '{"jsonrpc": "2.0", "result": {"some":"data"}, "id": 3}')
+
+    def test_version1(self):
+        result = dumps(RawJSON('[1,2]'), id="a", version=VERSION_1)
+        self.assertEquals(
+            result, '{"id": "a", "result": [1,2], "error": null}')
+
+    def test_versionPre1(self):
+        self.assertEquals(dumps(RawJSON('[1,2]')), '[1,2]')
+
+    def test_nested(self):
+        result = dumps([RawJSON('{"a": 1}')], id=1, version=VERSION_2)
+        self.assertEquals(
+            result, '{"jsonrpc": "2.0", "result": [{"a": 1}], "id": 1}')
+
+    def test_sameAsEnvelope(self):
+        """
+        Splicing the result into the envelope gives the same response as
+        encoding the whole of it.
+        """
+        result = {"a": [1, "b"], "c": None}
+        self.assertEquals(
+            dumps(result, id="x", version=VERSION_2),
+            jsonrpclib.json.dumps(
+                {"jsonrpc": "2.0", "result": result, "id": "x"}))
+        self.assertEquals(
+            dumps(result, id=2, version=VERSION_1),
+            jsonrpclib.json.dumps(
+                {"result": result, "error": None, "id": 2}))
+
+
 class LoadsTestCase(TestCase):
 
     def test_loads(self):
@@ -86,3 +131,141 @@ class LoadsTestCase(TestCase):
 
             dl.append(d)
         return defer.DeferredList(dl, fireOnOneErrback=True)
+
+
+class ParserTestCase(TestCase):
+
+    def test_parse(self):
+        parser, unmarshaller = getparser()
+        parser.feed('{"jsonrpc": "2.0", "method": "add", ')
+        parser.feed('"params": [1, 2], "id": 5}')
+        parser.close()
+        self.assertEquals(unmarshaller.getmethodname(), "add")
+        self.assertEquals(unmarshaller.getid(), 5)
+        self.assertEquals(unmarshaller.getversion(), VERSION_2)
+        self.assertEquals(unmarshaller.close(), [1, 2])
+
+    def test_versions(self):
+        for request, version in [
+            ('{"method": "add", "params": []}', VERSION_PRE1),
+            ('{"method": "add", "params": [], "id": null}', VERSION_1),
+            ('{"method": "add", "params": [], "id": 0}', VERSION_1)]:
+            parser, unmarshaller = getparser()
+            parser.feed(request)
+            parser.close()
+            self.assertEquals(unmarshaller.getversion(), version)
+
+    def test_parseInPieces(self):
+        request = dumps({"method": "add", "params": range(1000)})
+        parser, unmarshaller = getparser()
+        for byte in request:
+            parser.feed(byte)
+        parser.close()
+        self.assertEquals(unmarshaller.close(), range(1000))
+
+    def test_emptyResponse(self):
+        parser, unmarshaller = getparser()
+        parser.close()
+        self.assertEquals(unmarshaller.close(), None)
+
+
+class ServerProxyTestCase(TestCase):
+
+    def test_versionedNotification(self):
+        for version, expected in [
+            (VERSION_PRE1, {"method": "m", "params": [1]}),
+            (VERSION_1, {"method": "m", "params": [1], "id": None}),
+            (VERSION_2, {"jsonrpc": "2.0", "method": "m", "params": [1],
+                         "id": None})]:
+            proxy = ServerProxy("http://127.0.0.1/", version=version)
+            self.assertEquals(
+                loads(proxy._getVersionedNotification("m", [1])), expected)
+
+
+class RecordingCodec(StdlibCodec):
+
+    name = "recording"
+
+    def __init__(self):
+        self.encoded = []
+        self.decoded = []
+
+    def encode(self, obj, **kwargs):
+        self.encoded.append(obj)
+        return StdlibCodec.encode(self, obj, **kwargs)
+
+    def decode(self, string, **kwargs):
+        self.decoded.append(string)
+        return StdlibCodec.decode(self, string, **kwargs)
+
+
+class CodecRegistryTestCase(TestCase):
+
+    def setUp(self):
+        self.codec = RecordingCodec()
+        registerCodec(self.codec)
+        self.addCleanup(jsonrpclib.codecs.pop, "recording")
+        self.addCleanup(setDefaultCodec, getCodec())
+
+    def test_default(self):
+        self.assertIdentical(getCodec(), getCodec("json"))
+
+    def test_byName(self):
+        self.assertIdentical(getCodec("recording"), self.codec)
+        self.assertIdentical(getCodec(self.codec), self.codec)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, getCodec, "nosuchcodec")
+
+    def test_dumpsAndLoads(self):
+        dumps([1], codec="recording")
+        loads("[2]", codec=self.codec)
+        self.assertEquals(self.codec.encoded, [[1]])
+        self.assertEquals(self.codec.decoded, ["[2]"])
+
+    def test_setDefaultCodec(self):
+        setDefaultCodec("recording")
+        dumps([1])
+        parser, unmarshaller = getparser()
+        parser.feed('{"method": "a", "params": []}')
+        parser.close()
+        self.assertEquals(self.codec.encoded, [[1]])
+        self.assertEquals(self.codec.decoded,
+                          ['{"method": "a", "params": []}'])
+
+
+class CodecTestsMixin:
+    """
+    Tests which every codec should pass.
+    """
+
+    def test_roundTrip(self):
+        obj = {"a": [1, 2.5, None, True], "b": u"\u00e9/"}
+        self.assertEquals(loads(dumps(obj, codec=self.codec),
+                                codec=self.codec), obj)
+
+    def test_datetime(self):
+        result = dumps(datetime(2012, 3, 4, 5, 6, 7), id=1,
+                       version=VERSION_2, codec=self.codec)
+        self.assertEquals(loads(result)["result"], "20120304T05:06:07")
+
+    def test_faultLoads(self):
+        response = dumps(Fault(12, "hi"), id=1, version=VERSION_1)
+        error = self.assertRaises(
+            Fault, loads, response, codec=self.codec)
+        self.assertEquals(error.faultCode, 12)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, loads, "{oops", codec=self.codec)
+
+
+class StdlibCodecTestCase(CodecTestsMixin, TestCase):
+
+    codec = "json"
+
+
+class UJSONCodecTestCase(CodecTestsMixin, TestCase):
+
+    codec = "ujson"
+    if jsonrpclib.ujson is None:
+        skip = "ujson is not installed"
@@ -0,0 +1,273 @@
+import os
+import signal
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.trial.unittest import TestCase
+from twisted.web import server
+
+from txjsonrpc import jsonrpclib
+from txjsonrpc.netstring import jsonrpc as netstring
+from txjsonrpc.prefork import Supervisor, Worker, getFactory
+from txjsonrpc.web import jsonrpc as web
+
+
+class WebPid(web.JSONRPC):
+
+    def jsonrpc_pid(self):
+        return os.getpid()
+
+
+class NetstringPid(netstring.JSONRPC):
+
+    def jsonrpc_pid(self):
+        return os.getpid()
+
+    def jsonrpc_sleep(self, seconds):
+        return task.deferLater(reactor, seconds, os.getpid)
+
+
+def makeSite():
+    return server.Site(WebPid())
+
+
+netstringFactory = netstring.RPCFactory(NetstringPid)
+
+
+class GetFactoryTestCase(TestCase):
+
+    def test_factory(self):
+        self.assertIdentical(
+            getFactory("txjsonrpc.test.test_prefork.netstringFactory"),
+            netstringFactory)
+
+    def test_callable(self):
+        site = getFactory("txjsonrpc.test.test_prefork.makeSite")
+        self.assertIsInstance(site.resource, WebPid)
+
+
+class DrainingReactor(object):
+    """
+    The reactor, except that stopping it only fires stopped.
+    """
+
+    def __init__(self):
+        self.stopped = defer.Deferred()
+
+    def seconds(self):
+        return reactor.seconds()
+
+    def callLater(self, *args, **kwargs):
+        return reactor.callLater(*args, **kwargs)
+
+    def stop(self):
+        self.stopped.callback(None)
+
+
+class WorkerTestCase(TestCase):
+
+    def setUp(self):
+        self.reactor = DrainingReactor()
+        self.worker = Worker(makeSite(), drainTimeout=10,
+                             reactor=self.reactor)
+        self.worker.port = reactor.listenTCP(0, self.worker.factory,
+                                             interface="127.0.0.1")
+        self.pool = web.ConnectionPool()
+        self.addCleanup(self.pool.closeCachedConnections)
+        self.proxy = web.Proxy(
+            "http://127.0.0.1:%d/" % (self.worker.port.getHost().port,),
+            pool=self.pool)
+
+    def test_drainIdleConnections(self):
+        """
+        Idle persistent connections, such as those kept in a connection
+        pool, are closed straight away when draining.
+        """
+        d = self.proxy.callRemote("pid")
+        d.addCallback(self.assertEquals, os.getpid())
+
+        def drain(ignored):
+            self.assertEquals(len(self.worker.factory.protocols), 1)
+            started = reactor.seconds()
+            self.worker.drain()
+            self.reactor.stopped.addCallback(
+                lambda ign: reactor.seconds() - started)
+            return self.reactor.stopped
+        d.addCallback(drain)
+
+        def check(elapsed):
+            self.assertEquals(self.worker.factory.protocols, {})
+            self.assertTrue(elapsed < 1, elapsed)
+        return d.addCallback(check)
+
+
+    def test_drainWaitsForRequest(self):
+        """
+        A connection which hasn't sent its request yet is left open.
+        """
+        d = protocol.ClientCreator(reactor, protocol.Protocol).connectTCP(
+            "127.0.0.1", self.worker.port.getHost().port)
+
+        def drain(client):
+            self.worker.drain()
+            d = task.deferLater(reactor, 0.3, lambda: None)
+            d.addCallback(lambda ign: self.assertEquals(
+                len(self.worker.factory.protocols), 1))
+            d.addCallback(lambda ign: client.transport.loseConnection())
+            d.addCallback(lambda ign: self.reactor.stopped)
+            return d
+        return d.addCallback(drain)
+
+
+class NetstringWorkerTestCase(TestCase):
+
+    def setUp(self):
+        self.reactor = DrainingReactor()
+        self.worker = Worker(netstring.RPCFactory(NetstringPid),
+                             drainTimeout=10, reactor=self.reactor)
+        self.worker.port = reactor.listenTCP(0, self.worker.factory,
+                                             interface="127.0.0.1")
+        self.proxy = netstring.MultiplexedProxy(
+            "127.0.0.1", self.worker.port.getHost().port)
+        self.addCleanup(self.proxy.disconnect)
+
+    def drain(self, ignored=None):
+        """
+        Drain the worker, returning a Deferred which fires with the time
+        it took to stop.
+        """
+        started = reactor.seconds()
+        self.worker.drain()
+        return self.reactor.stopped.addCallback(
+            lambda ign: reactor.seconds() - started)
+
+    def test_drainIdleConnections(self):
+        """
+        Idle multiplexed connections are closed straight away when
+        draining.
+        """
+        d = self.proxy.callRemote("pid")
+        d.addCallback(self.assertEquals, os.getpid())
+        d.addCallback(self.drain)
+
+        def check(elapsed):
+            self.assertEquals(self.worker.factory.protocols, {})
+            self.assertTrue(elapsed < 1, elapsed)
+        return d.addCallback(check)
+
+    def test_drainFinishesCalls(self):
+        """
+        A multiplexed connection with a call in progress is closed once the
+        call has been answered.
+        """
+        d = self.proxy.callRemote("pid")
+        calls = []
+
+        def drain(ignored):
+            calls.append(self.proxy.callRemote("sleep", 0.5))
+            return task.deferLater(reactor, 0.1, self.drain)
+        d.addCallback(drain)
+
+        def check(elapsed):
+            self.assertEquals(self.worker.factory.protocols, {})
+            self.assertTrue(0.2 < elapsed < 1, elapsed)
+            return calls[0]
+        d.addCallback(check)
+        return d.addCallback(self.assertEquals, os.getpid())
+
+
+class SupervisorTestCase(TestCase):
+
+    timeout = 30
+
+    def setUp(self):
+        self.supervisor = self.start("txjsonrpc.test.test_prefork.makeSite")
+
+    def start(self, factory):
+        supervisor = Supervisor(factory, 0, "127.0.0.1", 2)
+        supervisor.restartDelay = 0
+        supervisor.drainTimeout = 1
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+        return supervisor
+
+    def pids(self):
+        return set([worker.pid for worker in self.supervisor.workers])
+
+    def call(self, supervisor=None):
+        """
+        Ask a worker for its pid, checking that it is one of the workers.
+        """
+        if supervisor is None:
+            supervisor = self.supervisor
+        if supervisor.factory.endswith("makeSite"):
+            proxy = web.Proxy("http://127.0.0.1:%d/" % (supervisor.port,),
+                              version=jsonrpclib.VERSION_2)
+        else:
+            proxy = netstring.Proxy("127.0.0.1", supervisor.port,
+                                    version=jsonrpclib.VERSION_2)
+        d = proxy.callRemote("pid")
+
+        def check(pid):
+            self.assertIn(pid, [worker.pid for worker in supervisor.workers])
+            return pid
+        return d.addCallback(check)
+
+    def test_web(self):
+        self.assertEquals(len(self.supervisor.workers), 2)
+        return defer.gatherResults([self.call() for i in range(4)])
+
+    def test_netstring(self):
+        supervisor = self.start(
+            "txjsonrpc.test.test_prefork.netstringFactory")
+        return defer.gatherResults(
+            [self.call(supervisor) for i in range(4)])
+
+    def test_restartCrashed(self):
+        """
+        A worker which dies is replaced.
+        """
+        worker = self.supervisor.workers[0]
+        d = self.call()
+
+        def kill(ignored):
+            os.kill(worker.pid, signal.SIGKILL)
+            return worker.ended
+        d.addCallback(kill)
+        d.addCallback(lambda ign: task.deferLater(reactor, 0, lambda: None))
+        d.addCallback(lambda ign: self.assertEquals(
+            len(self.flushLoggedErrors()), 1))
+        d.addCallback(lambda ign: self.assertEquals(
+            len(self.supervisor.workers), 2))
+        d.addCallback(lambda ign: self.assertNotIn(worker,
+                                                   self.supervisor.workers))
+        d.addCallback(lambda ign: self.call())
+        return d
+
+    def test_rollingRestart(self):
+        """
+        Every worker is replaced, and calls keep being answered meanwhile.
+        """
+        before = self.pids()
+        calls = []
+        d = self.call()
+
+        def restart(ignored):
+            restarted = self.supervisor.restart()
+            calls.append(self.call())
+            return restarted
+        d.addCallback(restart)
+        d.addCallback(lambda ign: self.assertEquals(len(self.pids()), 2))
+        d.addCallback(lambda ign: self.assertEquals(
+            self.pids() & before, set()))
+        d.addCallback(lambda ign: self.assertEquals(self.flushLoggedErrors(),
+                                                    []))
+        d.addCallback(lambda ign: defer.gatherResults(calls))
+        d.addCallback(lambda ign: self.call())
+        return d
+
+    def test_stop(self):
+        d = self.call()
+        d.addCallback(lambda ign: self.supervisor.stop())
+        d.addCallback(lambda ign: self.assertEquals(self.supervisor.workers,
+                                                    []))
+        return d
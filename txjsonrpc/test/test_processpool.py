@@ -0,0 +1,149 @@
+import os
+import signal
+
+from twisted.internet import defer, error
+from twisted.trial.unittest import TestCase
+
+from txjsonrpc import processpool
+from txjsonrpc.jsonrpc import BaseSubhandler, callFunction
+from txjsonrpc.jsonrpclib import Fault
+from txjsonrpc.processpool import (
+    ProcessPool, getProcessPool, in_process, setDefaultProcessPool)
+
+
+class Unpicklable(Exception):
+
+    def __reduce__(self):
+        raise TypeError("can't pickle")
+
+
+class Worker(BaseSubhandler):
+
+    @in_process
+    def jsonrpc_pid(self):
+        return os.getpid()
+
+    @in_process
+    def jsonrpc_add(self, a, b):
+        return a + b
+
+    @in_process
+    def jsonrpc_fault(self):
+        raise Fault(12, "hello")
+
+    @in_process
+    def jsonrpc_fail(self):
+        raise ValueError("failed")
+
+    @in_process
+    def jsonrpc_unpicklable(self):
+        raise Unpicklable()
+
+    @in_process
+    def jsonrpc_exit(self):
+        os._exit(1)
+
+    def jsonrpc_here(self):
+        return os.getpid()
+
+
+class ProcessPoolTestCase(TestCase):
+
+    timeout = 30
+
+    def setUp(self):
+        self.pool = ProcessPool(2)
+        self.pool.restartDelay = 0
+        self.worker = Worker()
+        self.worker.processPool = self.pool
+
+    def tearDown(self):
+        return self.pool.stop()
+
+    def test_decorator(self):
+        self.assertTrue(Worker.jsonrpc_pid.in_process)
+        self.assertFalse(hasattr(Worker.jsonrpc_here, "in_process"))
+
+    def test_getProcessPool(self):
+        self.assertIdentical(getProcessPool(self.worker.jsonrpc_pid),
+                             self.pool)
+        self.assertIdentical(getProcessPool(Worker().jsonrpc_pid),
+                             processpool.defaultProcessPool)
+
+    def test_setDefaultProcessPool(self):
+        self.addCleanup(setDefaultProcessPool, processpool.defaultProcessPool)
+        setDefaultProcessPool(self.pool)
+        self.assertIdentical(getProcessPool(Worker().jsonrpc_pid), self.pool)
+
+    def test_call(self):
+        d = callFunction(self.worker.jsonrpc_add, 2, 3)
+        return d.addCallback(self.assertEquals, 5)
+
+    def test_inWorker(self):
+        d = callFunction(self.worker.jsonrpc_pid)
+        d.addCallback(self.assertNotEquals, os.getpid())
+        d.addCallback(lambda ign: callFunction(self.worker.jsonrpc_here))
+        d.addCallback(self.assertEquals, os.getpid())
+        return d
+
+    def test_leastLoaded(self):
+        """
+        Calls are spread over the workers, each going to the one with the
+        fewest calls in progress.
+        """
+        d = defer.gatherResults(
+            [callFunction(self.worker.jsonrpc_pid) for i in range(4)])
+        self.assertEquals(
+            [len(worker.pending) for worker in self.pool.workers], [2, 2])
+        d.addCallback(lambda pids: self.assertEquals(len(set(pids)), 2))
+        return d
+
+    def test_fault(self):
+        d = self.assertFailure(callFunction(self.worker.jsonrpc_fault), Fault)
+        d.addCallback(lambda f: self.assertEquals(
+            (f.faultCode, f.faultString), (12, "hello")))
+        return d
+
+    def test_error(self):
+        d = callFunction(self.worker.jsonrpc_fail)
+        d = self.assertFailure(d, ValueError)
+        d.addCallback(lambda e: self.assertEquals(str(e), "failed"))
+        return d
+
+    def test_unpicklableError(self):
+        d = callFunction(self.worker.jsonrpc_unpicklable)
+        d = self.assertFailure(d, RuntimeError)
+        d.addCallback(lambda e: self.assertIn("Unpicklable", str(e)))
+        return d
+
+    def test_restart(self):
+        """
+        A worker which dies fails the calls it was running, and is replaced.
+        """
+        d = callFunction(self.worker.jsonrpc_exit)
+        d = self.assertFailure(d, error.ProcessTerminated)
+        d.addCallback(lambda ign: callFunction(self.worker.jsonrpc_add, 1, 2))
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda ign: self.assertEquals(len(self.pool.workers), 2))
+        d.addCallback(lambda ign: self.assertEquals(
+            len(self.flushLoggedErrors(error.ProcessTerminated)), 1))
+        return d
+
+    def test_killed(self):
+        d = callFunction(self.worker.jsonrpc_pid)
+
+        def kill(pid):
+            os.kill(pid, signal.SIGKILL)
+            ended = [worker.ended for worker in self.pool.workers]
+            return defer.DeferredList(ended, fireOnOneCallback=True)
+        d.addCallback(kill)
+        d.addCallback(lambda ign: self.flushLoggedErrors(
+            error.ProcessTerminated))
+        d.addCallback(lambda ign: self.assertEquals(len(self.pool.workers), 1))
+        return d
+
+    def test_stop(self):
+        d = callFunction(self.worker.jsonrpc_add, 1, 2)
+        d.addCallback(lambda ign: self.pool.stop())
+        d.addCallback(lambda ign: self.assertEquals(self.pool.workers, []))
+        return d
@@ -0,0 +1,77 @@
+import threading
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from txjsonrpc import threadpool
+from txjsonrpc.jsonrpc import BaseSubhandler
+from txjsonrpc.threadpool import (
+    ThreadPool, getThreadPool, in_thread, maybeDeferToThread,
+    setDefaultThreadPool)
+
+
+class Handler(BaseSubhandler):
+
+    @in_thread
+    def jsonrpc_thread(self):
+        return threading.currentThread().getName()
+
+    def jsonrpc_reactor(self):
+        return threading.currentThread().getName()
+
+
+class ThreadPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(maxthreads=1, name="test")
+        self.addCleanup(self.pool._stopIfStarted)
+
+    def test_decorator(self):
+        self.assertTrue(Handler.jsonrpc_thread.in_thread)
+        self.assertFalse(hasattr(Handler.jsonrpc_reactor, "in_thread"))
+
+    def test_startedOnDemand(self):
+        self.assertFalse(self.pool.started)
+        d = self.pool.deferToThread(lambda: 1)
+        self.assertTrue(self.pool.started)
+        return d.addCallback(self.assertEquals, 1)
+
+    def test_failure(self):
+        d = self.pool.deferToThread(lambda: 1 / 0)
+        return self.assertFailure(d, ZeroDivisionError)
+
+    def test_queueDepth(self):
+        """
+        Calls made while every thread is busy wait for one, and are counted
+        in the queue depth.
+        """
+        release = threading.Event()
+        dl = [self.pool.deferToThread(release.wait) for i in range(3)]
+        self.assertEquals(self.pool.queueDepth, 2)
+        release.set()
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda ign: self.assertEquals(self.pool.queueDepth, 0))
+        return d
+
+    def test_handlerPool(self):
+        handler = Handler()
+        self.assertIdentical(getThreadPool(handler.jsonrpc_thread),
+                             threadpool.defaultThreadPool)
+        handler.threadPool = self.pool
+        self.assertIdentical(getThreadPool(handler.jsonrpc_thread), self.pool)
+
+    def test_setDefaultThreadPool(self):
+        self.addCleanup(setDefaultThreadPool, threadpool.defaultThreadPool)
+        setDefaultThreadPool(self.pool)
+        self.assertIdentical(getThreadPool(Handler().jsonrpc_thread),
+                             self.pool)
+
+    def test_maybeDeferToThread(self):
+        handler = Handler()
+        handler.threadPool = self.pool
+        d = maybeDeferToThread(handler.jsonrpc_thread)
+        d.addCallback(self.assertNotEquals, "MainThread")
+        d.addCallback(
+            lambda ign: maybeDeferToThread(handler.jsonrpc_reactor))
+        d.addCallback(self.assertEquals, "MainThread")
+        return d
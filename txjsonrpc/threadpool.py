@@ -0,0 +1,98 @@
+"""
+Running the blocking functions of JSON-RPC handlers in threads, so that
+they don't hold up every other call the reactor is serving.
+"""
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+
+def in_thread(method):
+    """
+    Decorator to run a method in a thread from the pool of its handler (see
+    L{getThreadPool}) instead of in the reactor thread.
+    """
+    method.in_thread = True
+    return method
+
+
+class ThreadPool(threadpool.ThreadPool):
+    """
+    A bounded pool of threads for the blocking functions of handlers.
+
+    The pool is started when it is first given a call, and stopped when the
+    reactor shuts down. Calls made while all of its threads are busy wait
+    in line for one; L{queueDepth} tells how many are waiting.
+    """
+
+    def __init__(self, maxthreads=10, name=None, reactor=reactor):
+        """
+        @type maxthreads: C{int}
+        @param maxthreads: The most threads the pool runs at once.
+
+        @type name: C{str} or None
+        @param name: The name of the pool, which its threads are named
+        after.
+        """
+        threadpool.ThreadPool.__init__(self, 0, maxthreads, name)
+        self.reactor = reactor
+        self._shutdownTrigger = None
+
+    @property
+    def queueDepth(self):
+        """
+        The number of calls waiting for a thread to become free.
+        """
+        return self.q.qsize()
+
+    def deferToThread(self, function, *args, **kwargs):
+        """
+        Call function with args and kwargs in one of the threads of the
+        pool.
+
+        @return: a Deferred which fires with the result of the call.
+        """
+        if not self.started:
+            self.start()
+            if self._shutdownTrigger is None:
+                self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                    "during", "shutdown", self._stopIfStarted)
+        return threads.deferToThreadPool(
+            self.reactor, self, function, *args, **kwargs)
+
+    def _stopIfStarted(self):
+        if self.started:
+            self.stop()
+
+
+defaultThreadPool = ThreadPool(name="txjsonrpc")
+
+
+def setDefaultThreadPool(pool):
+    """
+    Run the functions decorated with L{in_thread} whose handlers have no
+    pool of their own in pool.
+    """
+    global defaultThreadPool
+    defaultThreadPool = pool
+
+
+def getThreadPool(function):
+    """
+    Return the pool function is run in: the C{threadPool} of the handler it
+    is a method of, if it has one, or the default pool.
+    """
+    pool = getattr(getattr(function, "im_self", None), "threadPool", None)
+    if pool is None:
+        pool = defaultThreadPool
+    return pool
+
+
+def maybeDeferToThread(function, *args, **kwargs):
+    """
+    Call function like C{defer.maybeDeferred} does, but in a thread of its
+    pool if it was decorated with L{in_thread}.
+    """
+    if getattr(function, "in_thread", False):
+        return getThreadPool(function).deferToThread(
+            function, *args, **kwargs)
+    return defer.maybeDeferred(function, *args, **kwargs)
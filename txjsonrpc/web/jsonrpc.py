@@ -21,13 +21,27 @@ try:
 except ImportError:
     import xmlrpc.client as xmlrpclib
 
+import math
+from collections import deque
+
+from zope.interface import implementer
+
 from twisted.web import resource, server
-from twisted.internet import defer, reactor
+from twisted.internet import defer, protocol, reactor, task
+from twisted.internet.interfaces import IPushProducer
+from twisted.protocols import basic
 from twisted.python import log, context
 from twisted.web import http
+from twisted.web.iweb import IBodyProducer
 
 from txjsonrpc import jsonrpclib
-from txjsonrpc.jsonrpc import BaseProxy, BaseQueryFactory, BaseSubhandler
+from txjsonrpc.admission import ServerBusy, concurrency_limit, priority
+from txjsonrpc.jsonrpc import (
+    BaseBatchQueryFactory, BaseProxy, BaseQueryFactory, BaseSubhandler,
+    _callWithCodec, timeout)
+from txjsonrpc.cache import cached, coalesced
+from txjsonrpc.processpool import in_process
+from txjsonrpc.threadpool import in_thread
 
 
 # Useful so people don't need to import xmlrpclib directly.
@@ -93,6 +107,135 @@ class Handler:
             NotImplementedError("Implement run() in subclasses"))
 
 
+class RequestContext(object):
+    """
+    The state of one JSON-RPC call being handled by a L{JSONRPC} resource.
+
+    A resource serves many requests at once, so anything which has to live
+    until a call's Deferred fires is carried along in one of these rather
+    than kept on the resource.
+
+    @ivar request: the L{server.Request} the call came in.
+    @ivar id: the id of the call, or C{None} for a notification.
+    @ivar version: the JSON-RPC version of the call.
+    @ivar callback: the name of the JSONP callback to wrap the response in,
+        or C{None}.
+    @ivar token: the value of the resource's auth token header, or C{None}.
+    @ivar started: the time, as given by C{reactor.seconds}, at which the
+        request was received.
+    @ivar requestedTimeout: the number of seconds the client is prepared to
+        wait for the response, or C{None}.
+    @ivar lost: whether the connection the request came in on was lost
+        before the response was written.
+    """
+    __slots__ = ("request", "id", "version", "callback", "token", "started",
+                 "requestedTimeout", "lost")
+
+    def __init__(self, request, id=None, version=jsonrpclib.VERSION_PRE1,
+                 callback=None, token=None, started=None,
+                 requestedTimeout=None):
+        self.request = request
+        self.id = id
+        self.version = version
+        self.callback = callback
+        self.token = token
+        self.started = started
+        self.requestedTimeout = requestedTimeout
+        self.lost = False
+
+    @property
+    def is_jsonp(self):
+        return self.callback is not None
+
+    def forCall(self, id, version):
+        """
+        Return a context for one call of a batch carried by this request.
+        """
+        return RequestContext(self.request, id, version, self.callback,
+                              self.token, self.started,
+                              self.requestedTimeout)
+
+
+@implementer(IPushProducer)
+class ResultStreamer(object):
+    """
+    Write the items produced by an iterator to a request as a JSON array,
+    a few at a time, and stop whenever the request's transport asks the
+    producer to pause.
+
+    @ivar batchSize: the number of items encoded for each write.
+    """
+    batchSize = 100
+
+    def __init__(self, iterator, request, encode, cooperate=task.cooperate):
+        self.iterator = iterator
+        self.request = request
+        self.encode = encode
+        self._cooperate = cooperate
+        self._task = None
+
+    def start(self, prefix, suffix):
+        """
+        Write prefix, the array and suffix, then finish the request.
+
+        @return: a Deferred which fires when the request is finished, or has
+        been abandoned.
+        """
+        self._suffix = suffix
+        self.request.write(prefix + "[")
+        self.request.registerProducer(self, True)
+        self._task = self._cooperate(self._produce())
+        self.request.notifyFinish().addErrback(self._requestFailed)
+        return self._task.whenDone().addCallbacks(self._done, self._failed)
+
+    def _produce(self):
+        write, encode = self.request.write, self.encode
+        separator = ""
+        batch = []
+        for item in self.iterator:
+            batch.append(encode(item))
+            if len(batch) >= self.batchSize:
+                write(separator + ", ".join(batch))
+                separator, batch = ", ", []
+                yield None
+        if batch:
+            write(separator + ", ".join(batch))
+
+    def _done(self, ignored):
+        self.request.unregisterProducer()
+        self.request.write("]" + self._suffix)
+        self.request.finish()
+
+    def _failed(self, failure):
+        if failure.check(task.TaskStopped):
+            # The request went away first.
+            return
+        log.err(failure, "Error streaming JSON-RPC result")
+        # The response has been started, so all that can be done is to
+        # leave it unfinished.
+        self.request.unregisterProducer()
+        self.request.loseConnection()
+
+    def _requestFailed(self, reason):
+        if self._task is not None:
+            self.stopProducing()
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        try:
+            self._task.stop()
+        except (task.TaskDone, task.TaskFailed, task.TaskStopped):
+            return
+        close = getattr(self.iterator, "close", None)
+        if close is not None:
+            close()
+
+
 class JSONRPC(resource.Resource, BaseSubhandler):
     """
     A resource that implements JSON-RPC.
@@ -101,6 +244,22 @@ class JSONRPC(resource.Resource, BaseSubhandler):
     Binary, Boolean, DateTime, Deferreds, or Handler instances.
 
     By default methods beginning with 'jsonrpc_' are published.
+
+    Requests are decoded, and responses encoded, with codec: the name of a
+    codec registered with L{jsonrpclib.registerCodec}, or a codec itself.
+    None means the process default.
+
+    Methods may also return an iterator, such as a generator, whose items
+    are streamed to the client as a JSON array, or an L{IBodyProducer}
+    which writes an already encoded JSON result. The response is then sent
+    without a content-length (chunked, over HTTP/1.1), and is produced only
+    as fast as the client reads it. Within batches, iterators are encoded
+    in one go.
+
+    Calls which take longer than callTimeout seconds, or than the time given
+    by a method's L{timeout} decorator, are cancelled and fail with a
+    C{REQUEST_TIMEOUT} Fault. Clients may ask for a shorter timeout with the
+    timeout_header header.
     """
 
     # Error codes for Twisted, if they conflict with yours then
@@ -111,21 +270,75 @@ class JSONRPC(resource.Resource, BaseSubhandler):
     isLeaf = 1
     except_map = {}
     auth_token = "Auth-Token"
+    timeout_header = "Request-Timeout"
+    codec = None
+    callTimeout = None
 
     def __init__(self):
         resource.Resource.__init__(self)
         BaseSubhandler.__init__(self)
 
     def render(self, request):
+        ctx = RequestContext(request, started=reactor.seconds())
+        if request.args.has_key('callback'):
+            ctx.callback = request.args['callback'][0]
+        if request.requestHeaders.hasHeader(self.auth_token):
+            ctx.token = request.requestHeaders.getRawHeaders(
+                self.auth_token)[0]
+        if request.requestHeaders.hasHeader(self.timeout_header):
+            ctx.requestedTimeout = jsonrpclib.parseTimeout(
+                request.requestHeaders.getRawHeaders(self.timeout_header)[0])
+        parsed = self._parseRequest(request)
+        if isinstance(parsed, list):
+            return self._renderBatch(ctx, parsed)
+        functionPath, args, kwargs, ctx.id, ctx.version = self._parseCall(
+            parsed)
+        if ctx.id is None and ctx.version != jsonrpclib.VERSION_PRE1:
+            return self._renderNotification(ctx, functionPath, args, kwargs)
+        try:
+            d = self._callFunction(ctx, functionPath, args, kwargs)
+        except jsonrpclib.Fault as f:
+            if isinstance(f, ServerBusy):
+                request.setHeader("Retry-After",
+                                  str(int(math.ceil(f.retryAfter))))
+            self._cbRender(f, ctx)
+        else:
+            self._setContentType(ctx)
+            d.addErrback(self._ebLost, ctx)
+            d.addErrback(self._ebRender, ctx.id)
+            d.addCallback(self._cbRender, ctx)
+
+            def _responseFailed(err, call):
+                ctx.lost = True
+                call.cancel()
+            request.notifyFinish().addErrback(_responseFailed, d)
+        return server.NOT_DONE_YET
+
+    def _parseRequest(self, request):
+        """
+        Decode the JSON-RPC data in the body of request, or in its
+        C{request} argument for a GET.
+
+        The body is read in one piece, which the parser decodes without
+        copying it, and only the size of it is logged, so that a large body
+        isn't copied on the way to being decoded.
+        """
+        parser, unmarshaller = jsonrpclib.getparser(self.codec)
         request.content.seek(0, 0)
-        # Unmarshal the JSON-RPC data.
         content = request.content.read()
-        log.msg("Client({}): {}".format(request.client, content))
-        if not content and request.method=='GET' and request.args.has_key('request'):
-            content=request.args['request'][0]
-        self.callback = request.args['callback'][0] if request.args.has_key('callback') else None
-        self.is_jsonp = True if self.callback else False
-        parsed = jsonrpclib.loads(content)
+        if (not content and request.method == 'GET' and
+            'request' in request.args):
+            content = request.args['request'][0]
+        log.msg("Client(%s): %d bytes" % (request.client, len(content)))
+        parser.feed(content)
+        parser.close()
+        return parser.data
+
+    def _parseCall(self, parsed):
+        """
+        Return the method, positional and keyword arguments, id and version
+        of a decoded JSON-RPC request.
+        """
         functionPath = parsed.get("method")
         params = parsed.get('params', {})
         args, kwargs = [], {}
@@ -134,66 +347,219 @@ class JSONRPC(resource.Resource, BaseSubhandler):
         else:
             kwargs = params
         id = parsed.get('id')
-        token = None
-        if request.requestHeaders.hasHeader(self.auth_token):
-            token = request.requestHeaders.getRawHeaders(self.auth_token)[0]
         version = parsed.get('jsonrpc')
         if version:
             version = int(float(version))
-        elif id and not version:
+        elif 'id' in parsed:
             version = jsonrpclib.VERSION_1
         else:
             version = jsonrpclib.VERSION_PRE1
-        # XXX this all needs to be re-worked to support logic for multiple
-        # versions...
-        try:
-            function = self._getFunction(functionPath)
-            d = None
+        return functionPath, args, kwargs, id, version
+
+    def _callFunction(self, ctx, functionPath, args, kwargs):
+        """
+        Look up and call the function for functionPath, returning a Deferred
+        which fires with its result. Raise a Fault if there is no such
+        function.
+        """
+        function = self._getFunction(functionPath)
+        if hasattr(function, 'with_request'):
+            args = [ctx.request] + args
+
+        def call():
             if hasattr(function, 'requires_auth'):
-                d = defer.maybeDeferred(self.auth, token, functionPath)
+                d = defer.maybeDeferred(self.auth, ctx.token, functionPath)
+                return d.addCallback(context.call, _callWithCodec, self.codec,
+                                     function, *args, **kwargs)
+            return _callWithCodec(self.codec, function, *args, **kwargs)
+        return self._callAdmitted(
+            functionPath, function, ctx.requestedTimeout, call)
+
+    def _renderNotification(self, ctx, functionPath, args, kwargs):
+        """
+        Call the function for a notification, without waiting for it to
+        finish: nothing is sent back but an empty response.
+        """
+        try:
+            d = self._callFunction(ctx, functionPath, args, kwargs)
         except jsonrpclib.Fault as f:
-            self._cbRender(f, request, id, version)
-        else:
-            if not self.is_jsonp:
-                request.setHeader("content-type", "application/json")
-            else:
-                request.setHeader("content-type", "text/javascript")
+            d = defer.fail(f)
+        d.addErrback(self._ebRender, None)
+        self._writeEmpty(ctx)
+        return server.NOT_DONE_YET
 
-            if hasattr(function, 'with_request'):
-                args = [request] + args
-            elif d:
-                d.addCallback(context.call, function, *args, **kwargs)
-            else:
-                d = defer.maybeDeferred(function, *args, **kwargs)
-            d.addErrback(self._ebRender, id)
-            d.addCallback(self._cbRender, request, id, version)
+    def _renderBatch(self, ctx, batch):
+        """
+        Call every request in a JSON-RPC 2.0 batch at once, and write their
+        responses in a single array once they have all finished.
+        """
+        if not batch:
+            ctx.version = jsonrpclib.VERSION_2
+            f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "empty batch")
+            self._cbRender(f, ctx)
+            return server.NOT_DONE_YET
+        calls = [self._batchCall(ctx, parsed) for parsed in batch]
+        self._setContentType(ctx)
+        d = defer.gatherResults(calls)
+        d.addCallback(self._cbRenderBatch, ctx)
 
-            def _responseFailed(err, call):
+        def _responseFailed(err):
+            ctx.lost = True
+            for call in calls:
                 call.cancel()
-            request.notifyFinish().addErrback(_responseFailed, d)
+        ctx.request.notifyFinish().addErrback(_responseFailed)
         return server.NOT_DONE_YET
 
-    def _cbRender(self, original_result, request, id, version):
-        result = original_result
+    def _batchCall(self, batchContext, parsed):
+        """
+        Start one call of a batch, returning a Deferred which fires with its
+        serialized response, or None if it is a notification.
+        """
+        if not isinstance(parsed, dict):
+            f = jsonrpclib.Fault(jsonrpclib.INVALID_JSONRPC, "invalid request")
+            ctx = batchContext.forCall(None, jsonrpclib.VERSION_2)
+            return defer.succeed(self._serialize(f, ctx))
+        functionPath, args, kwargs, id, version = self._parseCall(parsed)
+        ctx = batchContext.forCall(id, version)
+        try:
+            d = self._callFunction(ctx, functionPath, args, kwargs)
+        except jsonrpclib.Fault as f:
+            d = defer.succeed(f)
+        d.addErrback(self._ebLost, batchContext)
+        d.addErrback(self._ebRender, id)
+        if id is None:
+            d.addCallback(lambda result: None)
+        else:
+            d.addCallback(self._serialize, ctx)
+        return d
+
+    def _cbRenderBatch(self, responses, ctx):
+        responses = [response for response in responses
+                     if response is not None]
+        if not responses:
+            # A batch of notifications gets no response at all.
+            self._writeEmpty(ctx)
+            return
+        self._write(ctx, "[%s]" % (", ".join(responses),))
+
+    def _writeEmpty(self, ctx):
+        if ctx.lost:
+            return
+        ctx.request.setHeader("content-length", "0")
+        ctx.request.finish()
+
+    def _setContentType(self, ctx):
+        if not ctx.is_jsonp:
+            ctx.request.setHeader("content-type", "application/json")
+        else:
+            ctx.request.setHeader("content-type", "text/javascript")
+
+    def _serialize(self, result, ctx):
+        """
+        Convert the result (python) of a call to a JSON-RPC response.
+        """
         if isinstance(result, Handler):
             result = result.result
-        if version == jsonrpclib.VERSION_PRE1:
-            if not isinstance(result, jsonrpclib.Fault):
+        if ctx.version == jsonrpclib.VERSION_PRE1:
+            if isinstance(result, jsonrpclib.RawJSON):
+                result = jsonrpclib.RawJSON("[%s]" % (result.encoded,))
+            elif not isinstance(result, jsonrpclib.Fault):
                 result = (result,)
-            # Convert the result (python) to JSON-RPC
         try:
-            s = jsonrpclib.dumps(result, id=id, version=version) if not self.is_jsonp else "%s(%s)" %(self.callback,jsonrpclib.dumps(result, id=id, version=version))
+            return jsonrpclib.dumps(result, id=ctx.id, version=ctx.version,
+                                    codec=self.codec)
         except:
             f = jsonrpclib.Fault(self.FAILURE, "can't serialize output")
-            s = jsonrpclib.dumps(f, id=id, version=version) if not self.is_jsonp else "%s(%s)" %(self.callback,jsonrpclib.dumps(f, id=id, version=version))
-        request.setHeader("content-length", str(len(s)))
-        request.write(s)
-        request.finish()
+            return jsonrpclib.dumps(f, id=ctx.id, version=ctx.version,
+                                    codec=self.codec)
+
+    def _write(self, ctx, s):
+        if ctx.lost:
+            return
+        if ctx.is_jsonp:
+            s = "%s(%s)" % (ctx.callback, s)
+        ctx.request.setHeader("content-length", str(len(s)))
+        ctx.request.write(s)
+        ctx.request.finish()
+
+    def _cbRender(self, original_result, ctx):
+        if ctx.lost:
+            pass
+        elif jsonrpclib._isIterator(original_result):
+            self._stream(original_result, ctx)
+        elif IBodyProducer.providedBy(original_result):
+            self._produce(original_result, ctx)
+        else:
+            self._write(ctx, self._serialize(original_result, ctx))
         return original_result
 
+    def _streamEnvelope(self, ctx):
+        """
+        Return the text which goes before and after a streamed result.
+        """
+        prefix, suffix = jsonrpclib.responseEnvelope(
+            ctx.id, ctx.version, self.codec)
+        if ctx.version == jsonrpclib.VERSION_PRE1:
+            prefix, suffix = prefix + "[", "]" + suffix
+        if ctx.is_jsonp:
+            prefix, suffix = "%s(%s" % (ctx.callback, prefix), suffix + ")"
+        return prefix, suffix
+
+    def _encodeItem(self, item):
+        if isinstance(item, jsonrpclib.RawJSON):
+            return item.encoded
+        return jsonrpclib.getCodec(self.codec).encode(item)
+
+    def _stream(self, iterator, ctx):
+        """
+        Stream the items of iterator as the result of a call.
+        """
+        prefix, suffix = self._streamEnvelope(ctx)
+        streamer = ResultStreamer(iterator, ctx.request, self._encodeItem)
+        return streamer.start(prefix, suffix)
+
+    def _produce(self, producer, ctx):
+        """
+        Stream what producer writes as the (encoded) result of a call.
+        """
+        request = ctx.request
+        prefix, suffix = self._streamEnvelope(ctx)
+        request.write(prefix)
+        request.registerProducer(producer, True)
+        lost = []
+
+        def done(ignored):
+            if not lost:
+                request.unregisterProducer()
+                request.write(suffix)
+                request.finish()
+
+        def failed(failure):
+            if lost:
+                return
+            log.err(failure, "Error producing JSON-RPC result")
+            request.unregisterProducer()
+            request.loseConnection()
+
+        def requestFailed(reason):
+            lost.append(reason)
+            producer.stopProducing()
+        d = producer.startProducing(request)
+        request.notifyFinish().addErrback(requestFailed)
+        return d.addCallbacks(done, failed)
+
     def _map_exception(self, exception):
         return self.except_map.get(exception, self.FAILURE)
 
+    def _ebLost(self, failure, ctx):
+        """
+        Drop the failure of a call cancelled because the client went away:
+        there is nobody left to report it to.
+        """
+        if ctx.lost and failure.check(defer.CancelledError):
+            return None
+        return failure
+
     def _ebRender(self, failure, id):
         if isinstance(failure.value, jsonrpclib.Fault):
             return failure.value
@@ -206,6 +572,15 @@ class JSONRPC(resource.Resource, BaseSubhandler):
         return True
 
 
+def _basicAuth(user, password):
+    """
+    Return the value of a Basic I{Authorization} header for the given
+    credentials.
+    """
+    auth = '%s:%s' % (user, password)
+    return 'Basic %s' % (auth.encode('base64').replace('\n', ''),)
+
+
 class QueryProtocol(http.HTTPClient):
 
     def connectionMade(self):
@@ -215,14 +590,15 @@ class QueryProtocol(http.HTTPClient):
         self.sendHeader('Content-type', 'application/json')
         self.sendHeader('Content-length', str(len(self.factory.payload)))
         if self.factory.user:
-            auth = '%s:%s' % (self.factory.user, self.factory.password)
-            auth = auth.encode('base64').strip()
-            self.sendHeader('Authorization', 'Basic %s' % (auth,))
+            self.sendHeader('Authorization',
+                _basicAuth(self.factory.user, self.factory.password))
+        if self.factory.timeout is not None:
+            self.sendHeader('Request-Timeout', str(self.factory.timeout))
         self.endHeaders()
         self.transport.write(self.factory.payload)
 
     def handleStatus(self, version, status, message):
-        if status != '200':
+        if not status.startswith('2'):
             self.factory.badStatus(status, message)
 
     def handleResponse(self, contents):
@@ -235,12 +611,294 @@ class QueryFactory(BaseQueryFactory):
     protocol = QueryProtocol
 
     def __init__(self, path, host, method, user=None, password=None,
-                 version=jsonrpclib.VERSION_PRE1, *args):
-        BaseQueryFactory.__init__(self, method, version, *args)
+                 version=jsonrpclib.VERSION_PRE1, *args, **kwargs):
+        BaseQueryFactory.__init__(self, method, version, *args, **kwargs)
         self.path, self.host = path, host
         self.user, self.password = user, password
 
 
+class BatchQueryFactory(BaseBatchQueryFactory):
+
+    protocol = QueryProtocol
+
+    def __init__(self, path, host, queries, user=None, password=None):
+        BaseBatchQueryFactory.__init__(self, queries)
+        self.path, self.host = path, host
+        self.user, self.password = user, password
+
+
+class PersistentQueryProtocol(basic.LineReceiver):
+    """
+    An HTTP/1.1 client protocol which keeps its connection open after a
+    response has been received, so that its L{ConnectionPool} can send
+    further queries over it.
+
+    Queries are L{QueryFactory} instances; they are sent one at a time with
+    L{sendQuery} and get their C{parseResponse} or C{badStatus} methods
+    called just like they would when used with L{QueryProtocol}.
+    """
+    query = None
+
+    def connectionMade(self):
+        self.factory.pool._connectionMade(self, self.factory.query)
+
+    def sendQuery(self, query):
+        self.query = query
+        # The response can't be told apart from the next one if the query is
+        # cancelled, so the connection goes with it.
+        query._abort = self.transport.abortConnection
+        self._resetResponse()
+        headers = [
+            'POST %s HTTP/1.1' % (query.path,),
+            'User-Agent: Twisted/JSONRPClib',
+            'Host: %s' % (query.host,),
+            'Content-type: application/json',
+            'Content-length: %d' % (len(query.payload),)]
+        if query.user:
+            headers.append(
+                'Authorization: %s' % _basicAuth(query.user, query.password))
+        if query.timeout is not None:
+            headers.append('Request-Timeout: %s' % (query.timeout,))
+        self.transport.write('\r\n'.join(headers) + '\r\n\r\n')
+        self.transport.write(query.payload)
+
+    def _resetResponse(self):
+        self.status = None
+        self.message = None
+        self.length = None
+        self.persistent = True
+        self._body = []
+        self._decoder = None
+
+    def lineReceived(self, line):
+        if self.query is None:
+            # Nothing was asked for, the server is talking nonsense.
+            self.transport.loseConnection()
+            return
+        if self.status is None:
+            parts = line.split(None, 2)
+            if len(parts) < 2:
+                self.transport.loseConnection()
+                return
+            self.status = parts[1]
+            self.message = parts[2] if len(parts) > 2 else ''
+            self.persistent = (parts[0] == 'HTTP/1.1')
+            return
+        if line:
+            if ':' not in line:
+                return
+            key, value = line.split(':', 1)
+            key, value = key.strip().lower(), value.strip()
+            if key == 'content-length':
+                self.length = int(value)
+            elif key == 'transfer-encoding' and value.lower() == 'chunked':
+                self._decoder = http._ChunkedTransferDecoder(
+                    self._body.append, self._bodyFinished)
+            elif key == 'connection':
+                self.persistent = (value.lower() != 'close')
+            return
+        if not self.status.startswith('2'):
+            self.query.badStatus(self.status, self.message)
+        if self.status in ('204', '304'):
+            self.length = 0
+        if self._decoder is None and self.length == 0:
+            self._bodyFinished('')
+        else:
+            self.setRawMode()
+
+    def rawDataReceived(self, data):
+        if self._decoder is not None:
+            self._decoder.dataReceived(data)
+        elif self.length is None:
+            # No framing, the body ends when the connection does.
+            self._body.append(data)
+        else:
+            data, rest = data[:self.length], data[self.length:]
+            self._body.append(data)
+            self.length -= len(data)
+            if self.length == 0:
+                self._bodyFinished(rest)
+
+    def _bodyFinished(self, rest):
+        query, self.query = self.query, None
+        contents = ''.join(self._body)
+        persistent = self.persistent and not rest
+        self._resetResponse()
+        self.setLineMode()
+        # Hand the connection back before running the caller's callbacks,
+        # so that calls they make can go out over it.
+        if persistent:
+            self.factory.pool._connectionIdle(self)
+        else:
+            self.transport.loseConnection()
+        query.parseResponse(contents)
+
+    def connectionLost(self, reason):
+        query, self.query = self.query, None
+        if query is not None:
+            if (self.status is not None and self.length is None and
+                self._decoder is None):
+                query.parseResponse(''.join(self._body))
+            else:
+                query.clientConnectionLost(None, reason)
+        self.factory.pool._connectionLost(self)
+
+
+class _PoolConnectionFactory(protocol.ClientFactory):
+    """
+    Create a single L{PersistentQueryProtocol} for a L{ConnectionPool},
+    sending C{query} over it as soon as it is connected.
+    """
+    protocol = PersistentQueryProtocol
+
+    def __init__(self, pool, key, query):
+        self.pool = pool
+        self.key = key
+        self.query = query
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool._connectionFailed(self.key, self.query, reason)
+
+
+class ConnectionPool(object):
+    """
+    A pool of persistent HTTP/1.1 connections to JSON-RPC servers.
+
+    Pass an instance to L{Proxy} (several proxies may share one pool) and
+    calls will reuse open connections to the same host and port instead of
+    connecting anew each time. At most C{maxPerHost} connections are opened
+    to any one host; further calls wait in line for a free connection.
+    Connections which have been idle for C{idleTimeout} seconds are closed.
+    """
+    maxPerHost = 2
+    idleTimeout = 240
+
+    def __init__(self, maxPerHost=None, idleTimeout=None, reactor=reactor):
+        """
+        @type maxPerHost: C{int}
+        @param maxPerHost: The maximum number of connections open at the
+        same time to one host and port.
+
+        @type idleTimeout: C{int} or C{float}
+        @param idleTimeout: The number of seconds an unused connection is
+        kept open.
+        """
+        if maxPerHost is not None:
+            self.maxPerHost = maxPerHost
+        if idleTimeout is not None:
+            self.idleTimeout = idleTimeout
+        self.reactor = reactor
+        self._open = {}
+        self._idle = {}
+        self._waiting = {}
+        self._keys = {}
+        self._timers = {}
+        self._closing = {}
+
+    def submitQuery(self, query, host, port, contextFactory=None):
+        """
+        Send C{query} to C{host} and C{port}, over SSL if C{contextFactory}
+        is given, using an idle connection if there is one.
+
+        C{contextFactory} is the SSL client context factory class, called
+        for every new connection. Connections are only shared by queries
+        given the same one, so that proxies with different SSL settings
+        never use each other's connections.
+
+        Queries cancelled while they wait for a connection are dropped when
+        their turn comes.
+        """
+        key = (host, port, contextFactory)
+        idle = self._idle.get(key)
+        if idle:
+            connection = idle.pop()
+            self._timers.pop(connection).cancel()
+            connection.sendQuery(query)
+        elif self._open.get(key, 0) < self.maxPerHost:
+            self._connect(key, query)
+        else:
+            self._waiting.setdefault(key, deque()).append(query)
+
+    def closeCachedConnections(self):
+        """
+        Close all idle connections.
+
+        @return: a Deferred which fires when they have been closed.
+        """
+        closing = []
+        for connections in self._idle.values():
+            for connection in connections[:]:
+                d = defer.Deferred()
+                self._closing[connection] = d
+                closing.append(d)
+                connection.transport.loseConnection()
+        return defer.DeferredList(closing)
+
+    def _connect(self, key, query):
+        self._open[key] = self._open.get(key, 0) + 1
+        host, port, contextFactory = key
+        factory = _PoolConnectionFactory(self, key, query)
+        if contextFactory is not None:
+            self.reactor.connectSSL(host, port, factory, contextFactory())
+        else:
+            self.reactor.connectTCP(host, port, factory)
+
+    def _connectionMade(self, connection, query):
+        self._keys[connection] = connection.factory.key
+        if query.isCancelled():
+            # Cancelled while connecting; keep the connection for others.
+            self._connectionIdle(connection)
+        else:
+            connection.sendQuery(query)
+
+    def _connectionFailed(self, key, query, reason):
+        self._open[key] -= 1
+        query.clientConnectionFailed(None, reason)
+        self._processWaiting(key)
+
+    def _connectionIdle(self, connection):
+        key = self._keys[connection]
+        query = self._nextWaiting(key)
+        if query is not None:
+            connection.sendQuery(query)
+            return
+        self._idle.setdefault(key, []).append(connection)
+        self._timers[connection] = self.reactor.callLater(
+            self.idleTimeout, connection.transport.loseConnection)
+
+    def _connectionLost(self, connection):
+        key = self._keys.pop(connection, connection.factory.key)
+        self._open[key] -= 1
+        idle = self._idle.get(key, [])
+        if connection in idle:
+            idle.remove(connection)
+        timer = self._timers.pop(connection, None)
+        if timer is not None and timer.active():
+            timer.cancel()
+        closing = self._closing.pop(connection, None)
+        if closing is not None:
+            closing.callback(None)
+        self._processWaiting(key)
+
+    def _processWaiting(self, key):
+        while self._open.get(key, 0) < self.maxPerHost:
+            query = self._nextWaiting(key)
+            if query is None:
+                return
+            self._connect(key, query)
+
+    def _nextWaiting(self, key):
+        """
+        Return the next query waiting for a connection to C{key} which has
+        not been cancelled, or C{None}.
+        """
+        waiting = self._waiting.get(key)
+        while waiting:
+            query = waiting.popleft()
+            if not query.isCancelled():
+                return query
+
+
 class Proxy(BaseProxy):
     """
     A Proxy for making remote JSON-RPC calls.
@@ -252,7 +910,9 @@ class Proxy(BaseProxy):
     """
 
     def __init__(self, url, user=None, password=None,
-                 version=jsonrpclib.VERSION_PRE1, factoryClass=QueryFactory, ssl_ctx_factory = None):
+                 version=jsonrpclib.VERSION_PRE1, factoryClass=QueryFactory, ssl_ctx_factory = None,
+                 pool=None, idGenerator=None, batchWindow=None, codec=None,
+                 callTimeout=None):
         """
         @type url: C{str}
         @param url: The URL to which to post method calls.  Calls will be made
@@ -281,8 +941,37 @@ class Proxy(BaseProxy):
         @type ssl_ctx_factory: C{twisted.internet.ssl.ClientContextFactory} or None
         @param ssl_ctx_factory: SSL client context factory class to use instead
         of default twisted.internet.ssl.ClientContextFactory.
+
+        @type pool: L{ConnectionPool} or None
+        @param pool: A pool of persistent connections to send calls over. If
+        not specified, a new connection is made for every call.
+
+        @type idGenerator: C{callable} or None
+        @param idGenerator: A callable returning a new request id each time
+        it is called, such as a L{txjsonrpc.jsonrpc.CounterIdGenerator} (the
+        default), L{txjsonrpc.jsonrpc.PrefixedIdGenerator} or
+        L{txjsonrpc.jsonrpc.RandomIdGenerator}.
+
+        @type batchWindow: C{int} or C{float} or None
+        @param batchWindow: If given, JSON-RPC 2.0 calls made within this
+        many seconds of each other are sent together as a single batch
+        request. With 0, the calls made in the same reactor iteration are
+        batched.
+
+        @type codec: C{str} or codec or None
+        @param codec: The name of a codec registered with
+        L{jsonrpclib.registerCodec}, or a codec, to encode calls and decode
+        their responses with. If not specified, the process default is used.
+
+        @type callTimeout: C{int} or C{float} or None
+        @param callTimeout: The number of seconds after which calls which
+        have not been answered fail with a L{defer.TimeoutError}. The server
+        is sent it in a C{Request-Timeout} header; for a batch, the longest
+        timeout of its calls is sent. A call's own timeout keyword argument
+        takes precedence.
         """
-        BaseProxy.__init__(self, version, factoryClass)
+        BaseProxy.__init__(self, version, factoryClass, idGenerator,
+                           batchWindow, codec, callTimeout)
         scheme, netloc, path, params, query, fragment = urlparse.urlparse(url)
         netlocParts = netloc.split('@')
         if len(netlocParts) == 2:
@@ -310,21 +999,55 @@ class Proxy(BaseProxy):
             self.password = password
 
         self.ssl_ctx_factory = ssl_ctx_factory
+        self.pool = pool
+
+    def _callRemote(self, method, *args, **kwargs):
+        version = self._getVersion(kwargs)
+        factoryClass = self._getFactoryClass(kwargs)
+        factory = self._buildFactory(factoryClass, self.path, self.host,
+            method, self.user, self.password, version, *args)
+        self._setTimeout(factory, self._getTimeout(kwargs))
+        self._submitQuery(factory)
+        return factory.deferred
 
-    def callRemote(self, method, *args, **kwargs):
+    def notify(self, method, *args, **kwargs):
+        """
+        Send a notification: call method with args, without a result coming
+        back. The returned Deferred fires with None once the server has
+        accepted the notification.
+
+        Pre-1.0 JSON-RPC has no notifications, so with VERSION_PRE1 this
+        makes a regular call and discards its result.
+        """
         version = self._getVersion(kwargs)
-        # XXX generate unique id and pass it as a parameter
         factoryClass = self._getFactoryClass(kwargs)
-        factory = factoryClass(self.path, self.host, method, self.user,
-            self.password, version, *args)
+        factory = self._buildNotificationFactory(factoryClass, self.path,
+            self.host, method, self.user, self.password, version, *args)
+        self._setTimeout(factory, self._getTimeout(kwargs))
+        self._submitQuery(factory)
+        return factory.deferred
+
+    def _buildBatchFactory(self, queries):
+        return BatchQueryFactory(self.path, self.host, queries, self.user,
+                                 self.password)
+
+    def _sendQuery(self, factory):
         if self.secure:
             from twisted.internet import ssl
             if self.ssl_ctx_factory is None:
                 self.ssl_ctx_factory = ssl.ClientContextFactory
-            reactor.connectSSL(self.host, self.port or 443,
-                               factory, self.ssl_ctx_factory())
+            if self.pool is not None:
+                self.pool.submitQuery(factory, self.host, self.port or 443,
+                                      self.ssl_ctx_factory)
+            else:
+                reactor.connectSSL(self.host, self.port or 443,
+                                   factory, self.ssl_ctx_factory())
+        elif self.pool is not None:
+            self.pool.submitQuery(factory, self.host, self.port or 80)
         else:
             reactor.connectTCP(self.host, self.port or 80, factory)
-        return factory.deferred
 
-__all__ = ["JSONRPC", "Handler", "Proxy"]
+__all__ = [
+    "JSONRPC", "Handler", "RequestContext", "ResultStreamer", "Proxy",
+    "ConnectionPool", "timeout", "in_thread", "in_process", "cached",
+    "coalesced", "concurrency_limit", "priority"]
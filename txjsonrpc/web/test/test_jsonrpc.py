@@ -3,12 +3,26 @@
 """
 Test JSON-RPC support.
 """
-from twisted.internet import reactor, defer
+import os
+import threading
+from StringIO import StringIO
+
+from twisted.internet import reactor, defer, task
+from twisted.test.proto_helpers import MemoryReactor
 from twisted.trial import unittest
-from twisted.web import server, static
+from twisted.web import client, server, static
+from twisted.web.http_headers import Headers
+from twisted.web.test.requesthelper import DummyRequest
 
 from txjsonrpc import jsonrpclib
+from txjsonrpc.admission import AdmissionController
+from txjsonrpc.cache import getCache, getInFlightCalls
+from txjsonrpc.cluster import ClusterProxy, LeastOutstanding
 from txjsonrpc.jsonrpc import addIntrospection
+from txjsonrpc.processpool import ProcessPool
+from txjsonrpc.test.test_jsonrpclib import RecordingCodec
+from txjsonrpc.test.test_processpool import Worker
+from txjsonrpc.threadpool import ThreadPool
 from txjsonrpc.web import jsonrpc
 
 
@@ -74,6 +88,9 @@ class Test(jsonrpc.JSONRPC):
     def jsonrpc_none(self):
         return "null"
 
+    def jsonrpc_raw(self):
+        return jsonrpclib.RawJSON('{"raw": [1, 2]}')
+
     def _getFunction(self, functionPath):
         try:
             return jsonrpc.JSONRPC._getFunction(self, functionPath)
@@ -104,6 +121,26 @@ class TestAuthHeader(Test):
         return self.request.getUser(), self.request.getPassword()
 
 
+def post(port, body, headers=None):
+    """
+    Post a raw request body, returning a Deferred which fires with the
+    response code and decoded response body.
+    """
+    headers = Headers(headers or {})
+    headers.setRawHeaders("content-type", ["application/json"])
+    agent = client.Agent(reactor)
+    d = agent.request(
+        "POST", "http://127.0.0.1:%d/" % port, headers,
+        client.FileBodyProducer(StringIO(body)))
+
+    def cbResponse(response):
+        d = client.readBody(response)
+        d.addCallback(lambda body: (
+            response.code, body and jsonrpclib.json.loads(body)))
+        return d
+    return d.addCallback(cbResponse)
+
+
 class JSONRPCTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -143,6 +180,11 @@ class JSONRPCTestCase(unittest.TestCase):
             dl.append(d)
         return defer.DeferredList(dl, fireOnOneErrback=True)
 
+    def testRawJSON(self):
+        d = self.proxy().callRemote("raw")
+        d.addCallback(self.assertEquals, {"raw": [1, 2]})
+        return d
+
     def testErrors(self):
         dl = []
         for code, methodName in [(666, "fail"), (666, "deferFail"),
@@ -175,7 +217,8 @@ class JSONRPCTestIntrospection(JSONRPCTestCase):
                 meths,
                 ['add', 'complex', 'defer', 'deferFail',
                  'deferFault', 'dict', 'fail', 'fault',
-                 'none', 'pair', 'system.listMethods',
+                 'none', 'pair', 'raw', 'system.cacheStats',
+                 'system.listMethods',
                  'system.methodHelp',
                  'system.methodSignature'])
 
@@ -249,6 +292,146 @@ class ProxyVersion2TestCase(JSONRPCTestCase):
 
 
 
+class CodecTestCase(JSONRPCTestCase):
+    """
+    Test with the server and the proxy each using a codec of their own.
+    """
+    def setUp(self):
+        self.serverCodec = RecordingCodec()
+        self.clientCodec = RecordingCodec()
+        resource = Test()
+        resource.codec = self.serverCodec
+        self.p = reactor.listenTCP(0, server.Site(resource),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def proxy(self):
+        return jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                             version=jsonrpclib.VERSION_2,
+                             codec=self.clientCodec)
+
+    def testCodecsUsed(self):
+        d = self.proxy().callRemote("add", 2, 3)
+
+        def check(result):
+            self.assertEquals(result, 5)
+            self.assertEquals(len(self.clientCodec.encoded), 1)
+            self.assertEquals(len(self.clientCodec.decoded), 1)
+            self.assertEquals(self.serverCodec.decoded,
+                              [jsonrpclib.dumps(self.clientCodec.encoded[0])])
+            self.assertEquals(sorted(self.serverCodec.encoded), [1, 5])
+        return d.addCallback(check)
+
+
+class BatchingProxyTestCase(JSONRPCTestCase):
+    """
+    Test with a proxy sending the calls made in one reactor iteration as a
+    single batch request.
+    """
+    def proxy(self):
+        if not hasattr(self, "batching"):
+            url = "http://127.0.0.1:%d/" % self.port
+            self.batching = jsonrpc.Proxy(
+                url, version=jsonrpclib.VERSION_2, batchWindow=0)
+            self.sent = []
+            sendQuery = self.batching._sendQuery
+
+            def recordingSendQuery(factory):
+                self.sent.append(factory)
+                sendQuery(factory)
+            self.batching._sendQuery = recordingSendQuery
+        return self.batching
+
+    def testResults(self):
+        d = JSONRPCTestCase.testResults(self)
+        d.addCallback(lambda ign: self.assertEquals(len(self.sent), 1))
+        d.addCallback(lambda ign: self.assertEquals(
+            len(self.sent[0].queries), 6))
+        return d
+
+    def testMaxBatchSize(self):
+        proxy = self.proxy()
+        proxy.maxBatchSize = 2
+        d = defer.gatherResults(
+            [proxy.callRemote("add", i, 1) for i in range(5)])
+        d.addCallback(self.assertEquals, [1, 2, 3, 4, 5])
+        d.addCallback(lambda ign: self.assertEquals(
+            [len(getattr(f, "queries", [f])) for f in self.sent], [2, 2, 1]))
+        return d
+
+    def testOtherVersionsNotBatched(self):
+        proxy = self.proxy()
+        d = proxy.callRemote("add", 1, 2, version=jsonrpclib.VERSION_1)
+        self.assertEquals(len(self.sent), 1)
+        return d.addCallback(self.assertEquals, 3)
+
+
+class NotificationTest(Test):
+
+    def __init__(self):
+        Test.__init__(self)
+        self.notified = defer.Deferred()
+
+    def jsonrpc_notice(self, x):
+        self.notified.callback(x)
+        return "unwanted"
+
+
+class NotificationTestCase(unittest.TestCase):
+    """
+    Tests for sending notifications, which get no result.
+    """
+    version = jsonrpclib.VERSION_2
+
+    def setUp(self):
+        self.resource = NotificationTest()
+        self.p = reactor.listenTCP(0, server.Site(self.resource),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def tearDown(self):
+        return self.p.stopListening()
+
+    def proxy(self):
+        return jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                             version=self.version)
+
+    def testNotify(self):
+        d = self.proxy().notify("notice", "hello")
+        d.addCallback(self.assertEquals, None)
+        d.addCallback(lambda ign: self.resource.notified)
+        d.addCallback(self.assertEquals, "hello")
+        return d
+
+    def testNotifyFailure(self):
+        return self.proxy().notify("noSuchMethod").addCallback(
+            self.assertEquals, None)
+
+    def testNotifyPooled(self):
+        pool = jsonrpc.ConnectionPool()
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                              version=self.version, pool=pool)
+        d = proxy.notify("notice", "hello")
+        d.addCallback(self.assertEquals, None)
+        d.addCallback(lambda ign: proxy.callRemote("add", 1, 2))
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda ign: pool.closeCachedConnections())
+        return d
+
+    def testNotifyBatched(self):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                              version=self.version, batchWindow=0)
+        d = defer.gatherResults([proxy.notify("notice", "hello"),
+                                 proxy.callRemote("add", 1, 2)])
+        d.addCallback(self.assertEquals, [None, 3])
+        return d
+
+
+class Version1NotificationTestCase(NotificationTestCase):
+
+    version = jsonrpclib.VERSION_1
+
+
 class AuthenticatedProxyTestCase(JSONRPCTestCase):
     """
     Test with authenticated proxy. We run this with the same inout/ouput as
@@ -283,6 +466,991 @@ class AuthenticatedProxyTestCase(JSONRPCTestCase):
         return d.addCallback(self.assertEquals, [self.user, self.password])
 
 
+class TrackingSite(server.Site):
+    """
+    A site which can tell when all the connections made to it are closed.
+    """
+    def __init__(self, *args, **kwargs):
+        server.Site.__init__(self, *args, **kwargs)
+        self.closed = []
+
+    def buildProtocol(self, addr):
+        channel = server.Site.buildProtocol(self, addr)
+        closed = defer.Deferred()
+        self.closed.append(closed)
+        connectionLost = channel.connectionLost
+
+        def notifyClosed(reason):
+            connectionLost(reason)
+            closed.callback(None)
+        channel.connectionLost = notifyClosed
+        return channel
+
+
+class PooledProxyTestCase(JSONRPCTestCase):
+    """
+    Test with proxies sending their calls over a shared connection pool.
+    """
+    def setUp(self):
+        self.site = TrackingSite(Test())
+        self.p = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.port = self.p.getHost().port
+        self.key = ("127.0.0.1", self.port, None)
+        self.pool = jsonrpc.ConnectionPool()
+
+    def tearDown(self):
+        d = self.pool.closeCachedConnections()
+        d.addCallback(lambda ign: defer.DeferredList(self.site.closed))
+        d.addCallback(lambda ign: JSONRPCTestCase.tearDown(self))
+        return d
+
+    def proxy(self):
+        return jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                             version=jsonrpclib.VERSION_2, pool=self.pool)
+
+    def testConnectionReused(self):
+        proxy = self.proxy()
+
+        def secondCall(result):
+            self.assertEquals(result, 5)
+            d = proxy.callRemote("pair", "a", 1)
+            d.addCallback(self.assertEquals, ["a", 1])
+            return d
+
+        d = proxy.callRemote("add", 2, 3)
+        d.addCallback(secondCall)
+        d.addCallback(lambda ign: self.assertEquals(len(self.site.closed), 1))
+        return d
+
+    def testMaxPerHost(self):
+        self.pool.maxPerHost = 1
+        proxy = self.proxy()
+        dl = [proxy.callRemote("add", i, 1) for i in range(5)]
+        self.assertEquals(self.pool._open[self.key], 1)
+        self.assertEquals(len(self.pool._waiting[self.key]), 4)
+        d = defer.gatherResults(dl)
+        d.addCallback(self.assertEquals, [1, 2, 3, 4, 5])
+        d.addCallback(lambda ign: self.assertEquals(len(self.site.closed), 1))
+        return d
+
+    def testContextFactoriesNotShared(self):
+        """
+        Queries given different SSL context factories never share a
+        connection, while queries given the same one do.
+        """
+        class ContextFactory(object):
+            pass
+
+        class OtherContextFactory(object):
+            pass
+
+        memoryReactor = MemoryReactor()
+        pool = jsonrpc.ConnectionPool(maxPerHost=1, reactor=memoryReactor)
+        for contextFactory in [ContextFactory, ContextFactory,
+                               OtherContextFactory]:
+            pool.submitQuery(object(), "127.0.0.1", 443, contextFactory)
+        self.assertEquals(
+            [c[3].__class__ for c in memoryReactor.sslClients],
+            [ContextFactory, OtherContextFactory])
+        self.assertEquals(
+            len(pool._waiting[("127.0.0.1", 443, ContextFactory)]), 1)
+
+    def testIdleConnectionClosed(self):
+        self.pool.idleTimeout = 0
+        d = self.proxy().callRemote("add", 2, 3)
+        d.addCallback(lambda ign: self.assertEquals(
+            len(self.pool._idle[self.key]), 1))
+        d.addCallback(lambda ign: self.site.closed[0])
+        d.addCallback(lambda ign: self.assertEquals(
+            self.pool._idle[self.key], []))
+        return d
+
+
+class BatchTestCase(unittest.TestCase):
+    """
+    Tests for JSON-RPC 2.0 batch requests.
+    """
+    def setUp(self):
+        self.p = reactor.listenTCP(0, server.Site(Test()),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def tearDown(self):
+        return self.p.stopListening()
+
+    def post(self, body):
+        return post(self.port, body)
+
+    def call(self, method, params, id):
+        return {"jsonrpc": "2.0", "method": method, "params": params,
+                "id": id}
+
+    def testBatch(self):
+        batch = [self.call("add", [2, 3], 1),
+                 self.call("defer", ["a"], 2),
+                 self.call("pair", ["b", 4], 3)]
+
+        def check(result):
+            code, responses = result
+            self.assertEquals(code, 200)
+            self.assertEquals(
+                [(r["id"], r["result"]) for r in responses],
+                [(1, 5), (2, "a"), (3, ["b", 4])])
+        return self.post(jsonrpclib.json.dumps(batch)).addCallback(check)
+
+    def testBatchErrorsAndNotifications(self):
+        batch = [self.call("fault", [], 1),
+                 self.call("add", [1, 1], None),
+                 self.call("noSuchMethod", [], 2),
+                 "junk",
+                 self.call("add", [1, 2], 3)]
+
+        def check(result):
+            code, responses = result
+            self.assertEquals(code, 200)
+            self.assertEquals(len(responses), 4)
+            self.assertEquals(responses[0]["error"]["code"], 12)
+            self.assertEquals(responses[1]["error"]["code"], -32601)
+            self.assertEquals(responses[2]["error"]["code"], -32600)
+            self.assertEquals(responses[2]["id"], None)
+            self.assertEquals(responses[3]["result"], 3)
+        return self.post(jsonrpclib.json.dumps(batch)).addCallback(check)
+
+    def testBatchOfNotifications(self):
+        batch = [self.call("add", [1, 1], None),
+                 self.call("add", [1, 2], None)]
+        d = self.post(jsonrpclib.json.dumps(batch))
+        d.addCallback(self.assertEquals, (200, ""))
+        return d
+
+    def testEmptyBatch(self):
+
+        def check(result):
+            code, response = result
+            self.assertEquals(response["error"]["code"], -32600)
+        return self.post("[]").addCallback(check)
+
+
+class TimeoutTest(Test):
+
+    def jsonrpc_hang(self):
+        return defer.Deferred()
+
+    @jsonrpc.timeout(0.01)
+    def jsonrpc_quick(self):
+        return defer.Deferred()
+
+
+class TimeoutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = TimeoutTest()
+        self.site = TrackingSite(self.resource)
+        self.p = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def tearDown(self):
+        d = defer.DeferredList(self.site.closed)
+        d.addCallback(lambda ign: self.p.stopListening())
+        return d
+
+    def call(self, method, headers=None):
+        request = {"jsonrpc": "2.0", "method": method, "params": [], "id": 1}
+        d = post(self.port, jsonrpclib.json.dumps(request), headers)
+
+        def check(result):
+            code, response = result
+            self.assertEquals(response["error"]["code"],
+                              jsonrpclib.REQUEST_TIMEOUT)
+        return d.addCallback(check)
+
+    def testMethodTimeout(self):
+        return self.call("quick")
+
+    def testServerTimeout(self):
+        self.resource.callTimeout = 0.01
+        return self.call("hang")
+
+    def testRequestedTimeout(self):
+        return self.call("hang", {"Request-Timeout": ["0.01"]})
+
+    def testBatch(self):
+        self.resource.callTimeout = 0.01
+        batch = [{"jsonrpc": "2.0", "method": "hang", "params": [], "id": 1},
+                 {"jsonrpc": "2.0", "method": "add", "params": [1, 2],
+                  "id": 2}]
+        d = post(self.port, jsonrpclib.json.dumps(batch))
+
+        def check(result):
+            code, responses = result
+            self.assertEquals(responses[0]["error"]["code"],
+                              jsonrpclib.REQUEST_TIMEOUT)
+            self.assertEquals(responses[1]["result"], 3)
+        return d.addCallback(check)
+
+
+class AdmissionTest(Test):
+
+    def __init__(self):
+        Test.__init__(self)
+        self.waiting = []
+        self.admission = AdmissionController(maxInFlight=1, retryAfter=1.5)
+
+    def jsonrpc_wait(self):
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    @jsonrpc.priority
+    def jsonrpc_health(self):
+        return "ok"
+
+
+class AdmissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = AdmissionTest()
+        self.p = reactor.listenTCP(0, server.Site(self.resource),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+        self.proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                                   version=jsonrpclib.VERSION_2)
+
+    def tearDown(self):
+        return self.p.stopListening()
+
+    def wait(self, waiting):
+        """
+        Make a call which waits until it is released, adding its Deferred
+        to waiting, and return a Deferred firing once the server has it.
+        """
+        waiting.append(self.proxy.callRemote("wait"))
+
+        def check():
+            if not self.resource.waiting:
+                return task.deferLater(reactor, 0.01, check)
+        return check()
+
+    def testBusy(self):
+        """
+        A call made while too many are in progress is refused straight away,
+        while a priority method is still called.
+        """
+        waiting = []
+        d = defer.maybeDeferred(self.wait, waiting)
+        d.addCallback(lambda ign: self.assertFailure(
+            self.proxy.callRemote("add", 1, 2), jsonrpc.Fault))
+        d.addCallback(lambda f: self.assertEquals(f.faultCode,
+                                                  jsonrpclib.SERVER_BUSY))
+        d.addCallback(lambda ign: self.proxy.callRemote("health"))
+        d.addCallback(self.assertEquals, "ok")
+
+        def release(ign):
+            self.resource.waiting.pop().callback("done")
+            return waiting[0]
+        d.addCallback(release)
+        d.addCallback(self.assertEquals, "done")
+        d.addCallback(lambda ign: self.proxy.callRemote("add", 1, 2))
+        d.addCallback(self.assertEquals, 3)
+        return d
+
+    def testSynchronousFailure(self):
+        """
+        A call which fails before it is under way still makes room for
+        another.
+        """
+        def callWithCodec(codec, function, *args, **kwargs):
+            raise TestRuntimeError()
+        self.patch(jsonrpc, "_callWithCodec", callWithCodec)
+        ctx = jsonrpc.RequestContext(DummyRequest([""]))
+        self.assertRaises(TestRuntimeError, self.resource._callFunction,
+                          ctx, "add", [1, 2], {})
+        self.assertEquals(self.resource.admission.inFlight, 0)
+
+    def testRetryAfter(self):
+        waiting = []
+        d = defer.maybeDeferred(self.wait, waiting)
+        request = {"jsonrpc": "2.0", "method": "add", "params": [1, 2],
+                   "id": 1}
+
+        def call(ign):
+            agent = client.Agent(reactor)
+            return agent.request(
+                "POST", "http://127.0.0.1:%d/" % self.port, Headers({}),
+                client.FileBodyProducer(
+                    StringIO(jsonrpclib.json.dumps(request))))
+        d.addCallback(call)
+
+        def check(response):
+            self.assertEquals(response.headers.getRawHeaders("Retry-After"),
+                              ["2"])
+            return client.readBody(response)
+        d.addCallback(check)
+        d.addCallback(lambda body: self.assertEquals(
+            jsonrpclib.json.loads(body)["error"]["code"],
+            jsonrpclib.SERVER_BUSY))
+
+        def release(ign):
+            self.resource.waiting.pop().callback("done")
+            return waiting[0]
+        return d.addCallback(release)
+
+
+class ProxyTimeoutTestCase(unittest.TestCase):
+    """
+    Tests for calls which time out, or are cancelled, on the client.
+    """
+    def setUp(self):
+        self.resource = TimeoutTest()
+        self.resource.render = self.render
+        self.requested = []
+        self.site = TrackingSite(self.resource)
+        self.p = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.port = self.p.getHost().port
+        self.key = ("127.0.0.1", self.port, None)
+        self.pool = jsonrpc.ConnectionPool(maxPerHost=1)
+
+    def tearDown(self):
+        d = self.pool.closeCachedConnections()
+        d.addCallback(lambda ign: defer.DeferredList(self.site.closed))
+        d.addCallback(lambda ign: self.p.stopListening())
+        return d
+
+    def render(self, request):
+        self.requested.append(request.getHeader("Request-Timeout"))
+        return TimeoutTest.render(self.resource, request)
+
+    def proxy(self, pool=None, timeout=None):
+        return jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                             version=jsonrpclib.VERSION_2, pool=pool,
+                             callTimeout=timeout)
+
+    def testTimeout(self):
+        """
+        A call which isn't answered in time fails, and its connection is
+        closed.
+        """
+        d = self.proxy(timeout=0.05).callRemote("hang")
+        return self.assertFailure(d, defer.TimeoutError)
+
+    def testCallTimeout(self):
+        d = self.proxy(timeout=10).callRemote("hang", timeout=0.05)
+        return self.assertFailure(d, defer.TimeoutError)
+
+    def testTimeoutSent(self):
+        d = self.proxy(timeout=10).callRemote("add", 1, 2)
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda ign: self.assertEquals(self.requested, ["10"]))
+        return d
+
+    def testBatchTimeoutSent(self):
+        """
+        A batch is sent the longest timeout of its calls.
+        """
+        proxy = self.proxy(timeout=10)
+        proxy.batchWindow = 0
+        d = defer.gatherResults([proxy.callRemote("add", 1, 2),
+                                 proxy.callRemote("add", 3, 4, timeout=20)])
+        d.addCallback(self.assertEquals, [3, 7])
+        d.addCallback(lambda ign: self.assertEquals(self.requested, ["20"]))
+        return d
+
+    def testNoTimeoutSent(self):
+        d = self.proxy().callRemote("add", 1, 2)
+        d.addCallback(lambda ign: self.assertEquals(self.requested, [None]))
+        return d
+
+    def testCancel(self):
+        calls = []
+
+        def hang():
+            d = defer.Deferred()
+            calls.append(d)
+            call.cancel()
+            return d
+        self.resource.jsonrpc_hang = hang
+        call = self.proxy().callRemote("hang")
+        d = self.assertFailure(call, defer.CancelledError)
+        d.addCallback(lambda ign: self.site.closed[0])
+        d.addCallback(lambda ign: self.assertEquals(len(calls), 1))
+        return d
+
+    def testPooledTimeout(self):
+        """
+        A pooled connection whose call timed out is closed, and the next
+        call gets a new one.
+        """
+        proxy = self.proxy(self.pool, 0.05)
+        d = self.assertFailure(proxy.callRemote("hang"), defer.TimeoutError)
+        d.addCallback(lambda ign: proxy.callRemote("add", 1, 2))
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda ign: self.assertEquals(len(self.site.closed), 2))
+        d.addCallback(lambda ign: self.assertEquals(self.requested,
+                                                    ["0.05", "0.05"]))
+        return d
+
+    def testPooledCancelWaiting(self):
+        """
+        A call cancelled while waiting for a pooled connection is never
+        sent.
+        """
+        proxy = self.proxy(self.pool)
+        first = proxy.callRemote("add", 1, 2)
+        second = proxy.callRemote("add", 3, 4)
+        self.assertEquals(len(self.pool._waiting[self.key]), 1)
+        second.cancel()
+        d = self.assertFailure(second, defer.CancelledError)
+        d.addCallback(lambda ign: first)
+        d.addCallback(self.assertEquals, 3)
+        d.addCallback(lambda ign: self.assertEquals(len(self.requested), 1))
+        d.addCallback(lambda ign: self.assertEquals(
+            len(self.pool._idle[self.key]), 1))
+        return d
+
+
+class ThreadTest(Test):
+
+    @jsonrpc.in_thread
+    def jsonrpc_thread(self):
+        return threading.currentThread().getName()
+
+
+class ThreadTestCase(unittest.TestCase):
+    """
+    Tests for methods which run in a thread pool.
+    """
+    def setUp(self):
+        self.resource = ThreadTest()
+        sub = ThreadTest()
+        sub.threadPool = ThreadPool(maxthreads=1, name="sub")
+        self.addCleanup(sub.threadPool._stopIfStarted)
+        self.resource.putSubHandler("sub", sub)
+        self.p = reactor.listenTCP(0, server.Site(self.resource),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def tearDown(self):
+        return self.p.stopListening()
+
+    def proxy(self):
+        return jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                             version=jsonrpclib.VERSION_2)
+
+    def testDefaultPool(self):
+        d = self.proxy().callRemote("thread")
+        d.addCallback(lambda name: self.assertTrue(
+            name.startswith("PoolThread-txjsonrpc-"), name))
+        return d
+
+    def testSubHandlerPool(self):
+        d = self.proxy().callRemote("sub.thread")
+        d.addCallback(lambda name: self.assertTrue(
+            name.startswith("PoolThread-sub-"), name))
+        return d
+
+
+class ProcessTestCase(unittest.TestCase):
+    """
+    Tests for methods which run in a worker process.
+    """
+    def setUp(self):
+        self.pool = ProcessPool(1)
+        worker = Worker()
+        worker.processPool = self.pool
+        self.resource = Test()
+        self.resource.putSubHandler("worker", worker)
+        self.p = reactor.listenTCP(0, server.Site(self.resource),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def tearDown(self):
+        d = self.pool.stop()
+        d.addCallback(lambda ign: self.p.stopListening())
+        return d
+
+    def testInProcess(self):
+        proxy = jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                              version=jsonrpclib.VERSION_2)
+        d = proxy.callRemote("worker.pid")
+        d.addCallback(self.assertNotEquals, os.getpid())
+        d.addCallback(lambda ign: proxy.callRemote("worker.fault"))
+        d = self.assertFailure(d, jsonrpclib.Fault)
+        d.addCallback(lambda f: self.assertEquals(f.faultCode, 12))
+        return d
+
+
+class CacheTest(Test):
+
+    def __init__(self):
+        Test.__init__(self)
+        self.calls = 0
+
+    @jsonrpc.cached(ttl=60)
+    def jsonrpc_count(self, x):
+        self.calls += 1
+        return {"x": x, "calls": self.calls}
+
+    @jsonrpc.coalesced
+    def jsonrpc_slow(self, x):
+        self.calls += 1
+        return task.deferLater(reactor, 0.05, lambda: [x, self.calls])
+
+    @jsonrpc.coalesced
+    def jsonrpc_rows(self, n):
+        return task.deferLater(reactor, 0.05, lambda: iter(range(n)))
+
+
+class CacheTestCase(unittest.TestCase):
+    """
+    Tests for methods whose results are cached.
+    """
+    def setUp(self):
+        self.resource = CacheTest()
+        addIntrospection(self.resource)
+        self.p = reactor.listenTCP(0, server.Site(self.resource),
+                                   interface="127.0.0.1")
+        self.port = self.p.getHost().port
+
+    def tearDown(self):
+        return self.p.stopListening()
+
+    def proxy(self, version=jsonrpclib.VERSION_2):
+        return jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                             version=version)
+
+    def testCached(self):
+        proxy = self.proxy()
+        d = proxy.callRemote("count", 1)
+        d.addCallback(self.assertEquals, {"x": 1, "calls": 1})
+        d.addCallback(lambda ign: proxy.callRemote("count", 1))
+        d.addCallback(self.assertEquals, {"x": 1, "calls": 1})
+        d.addCallback(lambda ign: proxy.callRemote("count", 2))
+        d.addCallback(self.assertEquals, {"x": 2, "calls": 2})
+        d.addCallback(lambda ign: proxy.callRemote("system.cacheStats",
+                                                   "count"))
+        d.addCallback(lambda stats: self.assertEquals(
+            (stats["hits"], stats["misses"], stats["entries"]), (1, 2, 2)))
+        return d
+
+    def testCodec(self):
+        """
+        Results are cached encoded with the codec of the resource.
+        """
+        codec = self.resource.codec = RecordingCodec()
+        proxy = self.proxy()
+        d = proxy.callRemote("count", 1)
+        d.addCallback(lambda ign: proxy.callRemote("count", 1))
+        d.addCallback(self.assertEquals, {"x": 1, "calls": 1})
+        d.addCallback(lambda ign: self.assertIn(
+            {"x": 1, "calls": 1}, codec.encoded))
+        return d
+
+    def testPreVersion1(self):
+        d = self.proxy(jsonrpclib.VERSION_PRE1).callRemote("count", 1)
+        d.addCallback(lambda ign: self.proxy(
+            jsonrpclib.VERSION_PRE1).callRemote("count", 1))
+        d.addCallback(self.assertEquals, {"x": 1, "calls": 1})
+        return d
+
+    def testInvalidate(self):
+        proxy = self.proxy()
+        d = proxy.callRemote("count", 1)
+        d.addCallback(
+            lambda ign: getCache(self.resource.jsonrpc_count).invalidate(1))
+        d.addCallback(lambda ign: proxy.callRemote("count", 1))
+        d.addCallback(self.assertEquals, {"x": 1, "calls": 2})
+        return d
+
+    def testNotCached(self):
+        d = self.proxy().callRemote("system.cacheStats", "add")
+        d.addCallback(self.assertEquals, "")
+        return d
+
+    def testCoalesced(self):
+        """
+        Identical calls made at the same time share one result, each in a
+        response of its own.
+        """
+        first = self.proxy().callRemote("slow", 1)
+        second = self.proxy().callRemote("slow", 1)
+        d = defer.gatherResults([first, second])
+        d.addCallback(self.assertEquals, [[1, 1], [1, 1]])
+        d.addCallback(lambda ign: self.assertEquals(
+            getInFlightCalls(self.resource.jsonrpc_slow).coalesced, 1))
+        return d
+
+    def testCoalescedIterator(self):
+        """
+        Identical calls sharing an iterator result each get all of it.
+        """
+        first = self.proxy().callRemote("rows", 300)
+        second = self.proxy().callRemote("rows", 300)
+        d = defer.gatherResults([first, second])
+        d.addCallback(self.assertEquals, [range(300), range(300)])
+        return d
+
+    def testCoalescedByProxy(self):
+        """
+        Identical calls made through a proxy which coalesces them are sent
+        once.
+        """
+        proxy = self.proxy()
+        proxy.coalesce = True
+        d = defer.gatherResults([proxy.callRemote("slow", 3)
+                                 for i in range(3)])
+        d.addCallback(self.assertEquals, [[3, 1]] * 3)
+        d.addCallback(lambda ign: self.assertEquals(
+            (self.resource.calls,
+             getInFlightCalls(self.resource.jsonrpc_slow).coalesced),
+            (1, 0)))
+        return d
+
+    def testCachedByProxy(self):
+        proxy = self.proxy()
+        proxy.cacheResults("slow", ttl=60)
+        d = proxy.callRemote("slow", 4)
+        d.addCallback(lambda ign: proxy.callRemote("slow", 4))
+        d.addCallback(self.assertEquals, [4, 1])
+        d.addCallback(lambda ign: self.assertEquals(self.resource.calls, 1))
+        return d
+
+    def testCoalescedInBatch(self):
+        batch = [{"jsonrpc": "2.0", "method": "slow", "params": [2], "id": 1},
+                 {"jsonrpc": "2.0", "method": "slow", "params": [2], "id": 2}]
+        d = post(self.port, jsonrpclib.json.dumps(batch))
+
+        def check(result):
+            code, responses = result
+            self.assertEquals(
+                [(response["id"], response["result"])
+                 for response in responses],
+                [(1, [2, 1]), (2, [2, 1])])
+        return d.addCallback(check)
+
+
+class ClusterTest(Test):
+
+    def __init__(self, name, delay=0):
+        Test.__init__(self)
+        self.name = name
+        self.delay = delay
+
+    def jsonrpc_name(self):
+        return task.deferLater(reactor, self.delay, lambda: self.name)
+
+
+class ClusterTestCase(unittest.TestCase):
+    """
+    Tests for calls spread over several servers.
+    """
+    def setUp(self):
+        self.ports = {}
+        for name, delay in [("a", 0), ("b", 0), ("slow", 10), ("down", 0)]:
+            p = reactor.listenTCP(0, server.Site(ClusterTest(name, delay)),
+                                  interface="127.0.0.1")
+            self.ports[name] = p.getHost().port
+            if name == "down":
+                return p.stopListening()
+            self.addCleanup(p.stopListening)
+
+    def proxy(self, *names):
+        return ClusterProxy(
+            [jsonrpc.Proxy("http://127.0.0.1:%d/" % self.ports[name])
+             for name in names], LeastOutstanding())
+
+    def testSpread(self):
+        cluster = self.proxy("a", "b")
+        d = defer.gatherResults(
+            [cluster.callRemote("name") for i in range(4)])
+        d.addCallback(lambda names: self.assertEquals(
+            sorted(names), ["a", "a", "b", "b"]))
+        return d
+
+    def testFailover(self):
+        """
+        Calls sent to a server which isn't listening are sent to another
+        one, and the server is left out after failing too often.
+        """
+        cluster = self.proxy("a", "down", "b")
+        cluster.maxFailures = 2
+        down = cluster.endpoints[1]
+        d = defer.succeed(None)
+        names = []
+        for i in range(6):
+            d.addCallback(lambda ign: cluster.callRemote("name"))
+            d.addCallback(names.append)
+
+        def check(ign):
+            self.assertEquals(sorted(set(names)), ["a", "b"])
+            self.assertEquals(down.failures, 2)
+            self.assertNotEquals(down.ejectedUntil, None)
+        return d.addCallback(check)
+
+    def testHedged(self):
+        """
+        A call which the first server is slow to answer is answered by
+        another one, and the slow call is dropped.
+        """
+        cluster = self.proxy("slow", "a")
+        hedging = cluster.hedgeCalls("name", budget=1, minSamples=1)
+        hedging.record(0.05)
+        d = cluster.callRemote("name")
+        d.addCallback(self.assertEquals, "a")
+        d.addCallback(lambda ign: self.assertEquals(
+            [endpoint.outstanding for endpoint in cluster.endpoints], [0, 0]))
+        return d
+
+
+class ConcurrentRenderTestCase(unittest.TestCase):
+    """
+    Tests for requests in progress on the same resource at the same time.
+    """
+    def setUp(self):
+        self.calls = []
+        self.resource = Test()
+        self.resource.jsonrpc_wait = self.wait
+
+    def wait(self):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+    def render(self, callback=None):
+        request = DummyRequest([""])
+        request.method = "POST"
+        request.content = StringIO(jsonrpclib.json.dumps(
+            {"jsonrpc": "2.0", "method": "wait", "id": 1}))
+        if callback is not None:
+            request.args["callback"] = [callback]
+        self.assertEquals(self.resource.render(request), server.NOT_DONE_YET)
+        return request
+
+    def testJSONPAndPlainRequests(self):
+        """
+        Each response is framed according to its own request, whatever order
+        the calls finish in.
+        """
+        plain = self.render()
+        jsonp = self.render("cb")
+        self.calls[1].callback("b")
+        self.calls[0].callback("a")
+        self.assertEquals(
+            "".join(jsonp.written),
+            'cb({"jsonrpc": "2.0", "result": "b", "id": 1})')
+        self.assertEquals(
+            jsonp.responseHeaders.getRawHeaders("content-type"),
+            ["text/javascript"])
+        self.assertEquals(
+            "".join(plain.written),
+            '{"jsonrpc": "2.0", "result": "a", "id": 1}')
+        self.assertEquals(
+            plain.responseHeaders.getRawHeaders("content-type"),
+            ["application/json"])
+
+
+class ParseRequestTestCase(unittest.TestCase):
+    """
+    Tests for decoding the JSON-RPC data of a request.
+    """
+    def setUp(self):
+        self.resource = Test()
+        self.resource.codec = RecordingCodec()
+
+    def test_body(self):
+        """
+        The body is read once, and the string read is what gets decoded,
+        rather than a copy of it.
+        """
+        call = {"method": "add", "params": range(100), "id": 1}
+        reads = []
+
+        class Content(StringIO):
+            def read(self, *args):
+                reads.append(StringIO.read(self, *args))
+                return reads[-1]
+        request = DummyRequest([""])
+        request.method = "POST"
+        request.content = Content(jsonrpclib.json.dumps(call))
+        self.assertEquals(self.resource._parseRequest(request), call)
+        self.assertEquals(len(reads), 1)
+        self.assertIdentical(self.resource.codec.decoded[0], reads[0])
+
+    def test_get(self):
+        call = {"method": "add", "params": [1, 2], "id": 1}
+        request = DummyRequest([""])
+        request.content = StringIO("")
+        request.args["request"] = [jsonrpclib.json.dumps(call)]
+        self.assertEquals(self.resource._parseRequest(request), call)
+
+
+class StreamTest(Test):
+    """
+    A resource with methods whose results are streamed.
+    """
+
+    def jsonrpc_stream(self, count):
+        return (i * 2 for i in xrange(count))
+
+    def jsonrpc_iterate(self):
+        return iter([1, jsonrpclib.RawJSON('{"a": 1}')])
+
+    def jsonrpc_produce(self):
+        return client.FileBodyProducer(StringIO('{"produced": true}'))
+
+    def jsonrpc_streamFail(self):
+        yield 1
+        raise TestValueError()
+
+
+class StreamingTestCase(unittest.TestCase):
+    """
+    Tests for results which are streamed to the client.
+    """
+    def setUp(self):
+        self.site = TrackingSite(StreamTest())
+        self.p = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.port = self.p.getHost().port
+        self.pool = jsonrpc.ConnectionPool()
+
+    def tearDown(self):
+        d = self.pool.closeCachedConnections()
+        d.addCallback(lambda ign: defer.DeferredList(self.site.closed))
+        d.addCallback(lambda ign: self.p.stopListening())
+        return d
+
+    def proxy(self, version=jsonrpclib.VERSION_2, pool=None):
+        return jsonrpc.Proxy("http://127.0.0.1:%d/" % self.port,
+                             version=version, pool=pool)
+
+    def testChunked(self):
+        """
+        Over HTTP/1.1 the results are sent with chunked transfer encoding.
+        """
+        d = self.proxy(pool=self.pool).callRemote("stream", 250)
+        d.addCallback(self.assertEquals, range(0, 500, 2))
+        return d
+
+    def testVersions(self):
+        dl = []
+        for version in [jsonrpclib.VERSION_PRE1, jsonrpclib.VERSION_1,
+                        jsonrpclib.VERSION_2]:
+            d = self.proxy(version).callRemote("stream", 3)
+            d.addCallback(self.assertEquals, [0, 2, 4])
+            dl.append(d)
+        return defer.gatherResults(dl)
+
+    def testIterator(self):
+        d = self.proxy(pool=self.pool).callRemote("iterate")
+        d.addCallback(self.assertEquals, [1, {"a": 1}])
+        return d
+
+    def testIteratorInBatch(self):
+        """
+        Within a batch, generators and other iterators are encoded as
+        arrays.
+        """
+        batch = [{"jsonrpc": "2.0", "method": "iterate", "id": 1},
+                 {"jsonrpc": "2.0", "method": "stream", "params": [2],
+                  "id": 2}]
+        d = post(self.port, jsonrpclib.json.dumps(batch))
+
+        def check(result):
+            code, responses = result
+            self.assertEquals([r["result"] for r in responses],
+                              [[1, {"a": 1}], [0, 2]])
+        return d.addCallback(check)
+
+    def testProducer(self):
+        d = self.proxy(pool=self.pool).callRemote("produce")
+        d.addCallback(self.assertEquals, {"produced": True})
+        return d
+
+    def testFailure(self):
+        """
+        If the iterator fails part way through, the response is left
+        unfinished.
+        """
+        d = self.proxy(pool=self.pool).callRemote("streamFail")
+
+        def cbFailed(result):
+            self.fail("Got a result: %r" % (result,))
+
+        def ebFailed(failure):
+            self.assertEquals(len(self.flushLoggedErrors(TestValueError)), 1)
+        return d.addCallbacks(cbFailed, ebFailed)
+
+
+class FakeRequest(object):
+    """
+    Just enough of a request to stream a result to.
+    """
+    def __init__(self):
+        self.written = []
+        self.finished = False
+        self.producer = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def notifyFinish(self):
+        self.notification = defer.Deferred()
+        return self.notification
+
+    def finish(self):
+        self.finished = True
+
+
+class ResultStreamerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cooperator = task.Cooperator(
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=lambda f: self.clock.callLater(1, f))
+        self.request = FakeRequest()
+        self.streamer = jsonrpc.ResultStreamer(
+            iter(range(5)), self.request, str, self.cooperator.cooperate)
+        self.streamer.batchSize = 2
+        self.done = self.streamer.start("(", ")")
+
+    def test_stream(self):
+        self.assertIdentical(self.request.producer, self.streamer)
+        self.assertEquals(self.request.written, ["(["])
+        self.clock.advance(1)
+        self.assertEquals(self.request.written, ["([", "0, 1"])
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEquals("".join(self.request.written), "([0, 1, 2, 3, 4])")
+        self.assertTrue(self.request.finished)
+        self.assertIdentical(self.request.producer, None)
+
+    def test_pause(self):
+        self.clock.advance(1)
+        self.streamer.pauseProducing()
+        self.clock.advance(1)
+        self.assertEquals(len(self.request.written), 2)
+        self.streamer.resumeProducing()
+        self.clock.advance(1)
+        self.assertEquals(len(self.request.written), 3)
+
+    def test_requestFailed(self):
+        """
+        Nothing more is written once the request has gone away.
+        """
+        self.clock.advance(1)
+        self.request.notification.errback(Exception("gone"))
+        self.clock.advance(1)
+        self.assertEquals(len(self.request.written), 2)
+        self.assertFalse(self.request.finished)
+        return self.done
+
+
 class ProxyErrorHandlingTestCase(unittest.TestCase):
 
     def setUp(self):